@@ -16,6 +16,7 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import abc
 import pdb
@@ -30,8 +31,9 @@ from openquake.hazardlib.geo import geodetic
 from openquake.baselib import general
 from openquake.baselib.performance import DummyMonitor
 from openquake.commonlib import (
-    readinput, datastore, logictree, export, source, __version__)
-from openquake.commonlib.oqvalidation import OqParam
+    readinput, datastore, catalog, logictree, export, source, parallel,
+    __version__)
+from openquake.commonlib.oqvalidation import OqParam, HAZARD_CALCULATORS
 from openquake.commonlib.parallel import apply_reduce
 from openquake.risklib import riskinput
 from openquake.baselib.python3compat import with_metaclass
@@ -75,6 +77,7 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
     csm = datastore.persistent_attribute('composite_source_model')
     pre_calculator = None  # to be overridden
     is_stochastic = False  # True for scenario and event based calculators
+    distribute = None  # the executor, if not the default one
 
     def __init__(self, oqparam, monitor=DummyMonitor(), calc_id=None,
                  persistent=True):
@@ -86,9 +89,22 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
             self.datastore.hdf5 = {}
             self.datastore.attrs = {}
         self.datastore.export_dir = oqparam.export_dir
+        # the datasets can be compressed with `hdf5_filters` in the job.ini
+        self.datastore.filters = oqparam.hdf5_filters
+        # the persistent attributes are cached within a memory budget
+        datastore.get_cache(self.datastore).maxbytes = int(
+            (oqparam.attribute_cache_mb or 0) * 1024 ** 2)
         self.oqparam = oqparam
         self.persistent = persistent
 
+    def release(self, *names):
+        """
+        Remove the given persistent attributes from the cache, to free
+        memory when they are not needed anymore; they will be read again
+        from the datastore if accessed.
+        """
+        datastore.get_cache(self.datastore).release(*names)
+
     def save_params(self, **kw):
         """
         Update the current calculation parameters
@@ -107,7 +123,25 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
         if concurrent_tasks is not None:
             self.oqparam.concurrent_tasks = concurrent_tasks
         self.save_params(**kw)
+        self.register('executing')
         exported = {}
+        oq = self.oqparam
+        tm = parallel.TaskManager
+        saved = dict(distribute=tm.distribute, adaptive=tm.adaptive,
+                     max_tasks_per_worker=tm.max_tasks_per_worker,
+                     max_worker_rss_growth=tm.max_worker_rss_growth)
+        # the executor can be set in the job.ini with the parameter
+        # `distribute` or by overriding the attribute in a subclass
+        tm.distribute = oq.distribute or self.distribute or tm.distribute
+        # with `adaptive_chunks = true` the chunks are sized by
+        # measuring the time spent in a first wave of small tasks
+        tm.adaptive = oq.adaptive_chunks or tm.adaptive
+        # the workers of the process pool can be recycled after a number
+        # of tasks or a growth of their memory
+        tm.max_tasks_per_worker = (
+            oq.max_tasks_per_worker or tm.max_tasks_per_worker)
+        tm.max_worker_rss_growth = (
+            oq.max_worker_rss_growth or tm.max_worker_rss_growth)
         try:
             if pre_execute:
                 with self.monitor('pre_execute', autoflush=True):
@@ -119,19 +153,57 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
             with self.monitor('export', autoflush=True):
                 exported = self.export()
         except:
+            self.register('failed')
             if kw.get('pdb'):  # post-mortem debug
                 tb = sys.exc_info()[2]
                 traceback.print_exc(tb)
                 pdb.post_mortem(tb)
+                return exported  # the calculation is not complete
             else:
                 logging.critical('', exc_info=True)
                 raise
+        finally:
+            for name, value in saved.items():
+                setattr(tm, name, value)
+            if type(self) is calculators.get(oq.calculation_mode):
+                # release the listener and the threads serving the
+                # workers, unless a precalculator is running
+                tm.shutdown_workqueue()
         # don't cleanup if there is a critical error, otherwise
         # there will likely be a cleanup error covering the real one
         if clean_up:
             self.clean_up()
+            if self.oqparam.repack and self.persistent:
+                self.repack()
+        self.register('complete')
         return exported
 
+    def register(self, status):
+        """
+        Update the status of the calculation in the catalog of the
+        data directory, used by the commands `show` and `purge`.
+        A failure in updating the catalog does not stop the calculation.
+
+        Only the top level calculator is registered, not the
+        precalculator running on the same calculation ID.
+
+        :param status: 'executing', 'complete' or 'failed'
+        """
+        if not self.persistent or type(self) is not calculators.get(
+                self.oqparam.calculation_mode):
+            return
+        dstore = self.datastore
+        try:
+            cat = catalog.Catalog(dstore.datadir)
+            if status == 'executing':
+                cat.start(dstore.calc_id, self.oqparam.calculation_mode,
+                          self.oqparam.description)
+            else:
+                cat.finish(dstore.calc_id, status,
+                           os.path.getsize(dstore.hdf5path))
+        except (catalog.sqlite3.Error, OSError) as exc:
+            logging.warn('Could not update the catalog: %s', exc)
+
     def core_func(*args):
         """
         Core routine running on the workers.
@@ -192,9 +264,31 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
                 rlz_dt)
         performance = self.monitor.collect_performance()
         if performance is not None:
-            self.performance = performance
+            # add the peak size of the cache of the persistent attributes
+            cache = datastore.get_cache(self.datastore)
+            row = numpy.zeros(1, performance.dtype)
+            row['operation'] = 'attribute cache'
+            row['memory_mb'] = cache.max_nbytes / 1024. ** 2
+            self.performance = numpy.concatenate([performance, row])
+            logging.info('Peak size of the attribute cache: %s',
+                         general.humansize(cache.max_nbytes))
         # the datastore must not be closed, it will be closed automatically
 
+    def repack(self):
+        """
+        Close the datastore, repack the underlying file by applying the
+        `hdf5_filters` and open it again. Since the file is replaced,
+        the repacking is performed only when it is not open for writing.
+        """
+        dstore = self.datastore
+        dstore.close()
+        before, after = datastore.repack(dstore.hdf5path, dstore.filters)
+        logging.info('Repacked %s: recovered %s', dstore.hdf5path,
+                     general.humansize(max(before - after, 0)))
+        self.datastore = dstore.reopen()
+        get_cache = datastore.get_cache
+        get_cache(self.datastore).maxbytes = get_cache(dstore).maxbytes
+
 
 class HazardCalculator(BaseCalculator):
     """
@@ -243,20 +337,33 @@ class HazardCalculator(BaseCalculator):
         Check if there is a pre_calculator or a previous calculation ID.
         If yes, read the inputs by invoking the precalculator or by retrieving
         the previous calculation; if not, read the inputs directly.
+        With `reuse_hazard = true` a previous calculation with the same
+        hazard fingerprint is used, if any.
         """
+        oq = self.oqparam
         if self.pre_calculator is not None:
             # the parameter hazard_calculation_id is only meaningful if
             # there is a precalculator
-            precalc_id = self.oqparam.hazard_calculation_id
+            precalc_id = oq.hazard_calculation_id
+            if precalc_id is None:
+                precalc_id = self.find_hazard(self.pre_calculator)
             if precalc_id is None:  # recompute everything
                 precalc = calculators[self.pre_calculator](
                     self.oqparam, self.monitor('precalculator'),
                     self.datastore.calc_id)
                 precalc.run(clean_up=False)
+                self.save_fingerprint(self.pre_calculator)
+                # do not carry the memory of the precalculator workers
+                # in the next phase
+                parallel.TaskManager.recycle_if_needed()
                 if 'scenario' not in self.oqparam.calculation_mode:
                     self.csm = precalc.csm
+                # the precalculator wrote in the same file with its own
+                # handle, which must not survive a repack
+                precalc.datastore.close()
             else:  # read previously computed data
-                self.datastore.set_parent(datastore.DataStore(precalc_id))
+                self.datastore.set_parent(
+                    datastore.DataStore(precalc_id, mode='r'))
                 # update oqparam with the attributes saved in the datastore
                 self.oqparam = OqParam.from_(self.datastore.attrs)
                 self.read_exposure_sitecol()
@@ -264,8 +371,61 @@ class HazardCalculator(BaseCalculator):
         else:  # we are in a basic calculator
             self.read_exposure_sitecol()
             self.read_sources()
+        if (oq.calculation_mode in HAZARD_CALCULATORS and
+                oq.hazard_calculation_id is None):
+            # all the hazard is in this datastore, it can be reused
+            self.save_fingerprint(oq.calculation_mode)
         self.datastore.hdf5.flush()
 
+    def _fingerprint(self, calculation_mode):
+        # the hazard is fingerprinted only with `reuse_hazard = true` and
+        # only by the requested calculator, not by its precalculators
+        oq = self.oqparam
+        if (self.persistent and oq.reuse_hazard and
+                type(self) is calculators[oq.calculation_mode]):
+            return oq.hazard_fingerprint(calculation_mode)
+
+    def find_hazard(self, calculation_mode):
+        """
+        Look in the catalog of the data directory for a complete
+        calculation with the same hazard fingerprint and, if found, make
+        it the hazard calculation of the current one.
+
+        :param calculation_mode: the name of the hazard calculator
+        :returns: the ID of the calculation to reuse, or None
+        """
+        fingerprint = self._fingerprint(calculation_mode)
+        if fingerprint is None:
+            return
+        try:
+            calc_id = catalog.Catalog(self.datastore.datadir).find(
+                fingerprint)
+        except catalog.sqlite3.Error as exc:
+            logging.warn('Could not read the catalog: %s', exc)
+            return
+        if calc_id is not None:
+            logging.info('Reusing the hazard of calculation #%d', calc_id)
+            self.oqparam.hazard_calculation_id = calc_id
+            self.datastore.attrs['hazard_calculation_id'] = repr(calc_id)
+        return calc_id
+
+    def save_fingerprint(self, calculation_mode):
+        """
+        Register in the catalog of the data directory the fingerprint
+        of the hazard computed by the current calculation, so that it
+        can be reused when the calculation is complete.
+
+        :param calculation_mode: the name of the hazard calculator
+        """
+        fingerprint = self._fingerprint(calculation_mode)
+        if fingerprint is None:
+            return
+        try:
+            catalog.Catalog(self.datastore.datadir).set_fingerprint(
+                self.datastore.calc_id, fingerprint)
+        except catalog.sqlite3.Error as exc:
+            logging.warn('Could not update the catalog: %s', exc)
+
     def read_exposure_sitecol(self):
         """
         Read the exposure (if any) and then the site collection, possibly
@@ -485,7 +645,8 @@ def get_gmfs(calc):
         return sitecol, {(0, 'FromFile'): gmfs_by_imt}
 
     # else from rupture
-    gmf = calc.datastore['gmfs/col00'].value
+    gmf = calc.datastore['gmfs/col00']
+    index = logictree.get_gmf_index(calc.datastore)
     # NB: if the hazard site collection has N sites, the hazard
     # filtered site collection for the nonzero GMFs has N' <= N sites
     # whereas the risk site collection associated to the assets
@@ -494,19 +655,19 @@ def get_gmfs(calc):
         haz_sitecol = calc.datastore.parent['sitecol']  # N' values
     else:
         haz_sitecol = calc.sitecol
-    risk_indices = set(calc.sitecol.indices)  # N'' values
+    haz_indices = numpy.array(haz_sitecol.indices)
+    ok = numpy.in1d(haz_indices, calc.sitecol.indices)  # N'' values
     N = len(haz_sitecol.complete)
     imt_dt = numpy.dtype([(imt, float) for imt in calc.oqparam.imtls])
-    gmf_by_idx = general.groupby(gmf, lambda row: row['idx'])
-    R = len(gmf_by_idx)
+    rupids = numpy.flatnonzero(index['stop'] > index['start'])
+    R = len(rupids)
     # build a matrix N x R for each GSIM realization
     gmfs = {(trt_id, gsim): numpy.zeros((N, R), imt_dt)
             for trt_id, gsim in calc.rlzs_assoc}
-    for rupid, rows in sorted(gmf_by_idx.items()):
-        assert len(haz_sitecol.indices) == len(rows), (
-            len(haz_sitecol.indices), len(rows))
-        for sid, gmv in zip(haz_sitecol.indices, rows):
-            if sid in risk_indices:
-                for trt_id, gsim in gmfs:
-                    gmfs[trt_id, gsim][sid, rupid] = gmv[gsim]
+    for rupid in rupids:
+        # the rows of each rupture are in the order of the hazard sites
+        rows = gmf[int(index['start'][rupid]):int(index['stop'][rupid])]
+        assert len(haz_indices) == len(rows), (len(haz_indices), len(rows))
+        for trt_id, gsim in gmfs:
+            gmfs[trt_id, gsim][haz_indices[ok], rupid] = rows[gsim][ok]
     return haz_sitecol, gmfs
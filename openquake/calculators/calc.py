@@ -219,6 +219,57 @@ def gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
     return poes
 
 
+def count_exceedances(gmvs, sids, num_sites, imls):
+    """
+    Vectorized version of the counting performed in
+    :func:`gmvs_to_haz_curve`, working on all the sites at once.
+
+    :param gmvs:
+        an array of ground motion values
+    :param sids:
+        an array of site indices, one for each ground motion value
+    :param num_sites:
+        the total number of sites
+    :param imls:
+        a sorted list of intensity measure levels
+    :returns:
+        an array of shape (num_sites, num_levels) with the number of
+        ground motion values exceeding each level, site by site
+
+    >>> count_exceedances([0.04, 0.1, 0.01], [0, 0, 2], 3, [0.03, 0.05])
+    array([[2, 1],
+           [0, 0],
+           [0, 0]])
+    """
+    L = len(imls)
+    # number of levels exceeded by each gmv, i.e. with gmv >= iml
+    nlevels = numpy.searchsorted(imls, gmvs, side='right')
+    # hist[sid, n] is the number of gmvs exceeding exactly n levels
+    hist = numpy.bincount(
+        numpy.asarray(sids) * (L + 1) + nlevels,
+        minlength=num_sites * (L + 1)).reshape(num_sites, L + 1)
+    # the number of gmvs exceeding level l is sum(hist[:, l + 1:])
+    return hist[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+
+
+def counts_to_poes(counts, invest_time, duration):
+    """
+    Convert a composite array of exceedance counts, as returned by
+    :func:`count_exceedances`, into a composite array of PoEs.
+    Since the counts are additive, they can be summed across tasks and
+    converted only once at the end of the calculation.
+
+    :param counts: a composite array imt -> counts of shape (N, L)
+    :param float invest_time: the investigation time
+    :param float duration: investigation time * number of SES
+    :returns: a composite array imt -> PoEs of the same shape
+    """
+    poes = numpy.zeros_like(counts)
+    for imt in counts.dtype.fields:
+        poes[imt] = 1 - numpy.exp(- (invest_time / duration) * counts[imt])
+    return poes
+
+
 # ################## utilities for classical calculators ################ #
 
 def make_uhs(maps):
@@ -83,6 +83,10 @@ def agg_dicts(acc, val):
 source_info_dt = numpy.dtype(
     [('trt_model_id', numpy.uint32),
      ('source_id', (bytes, 20)),
+     ('source_class', (bytes, 20)),
+     ('weight', numpy.float32),
+     ('num_gsims', numpy.uint32),
+     ('num_sites', numpy.uint32),
      ('calc_time', numpy.float32)])
 
 
@@ -131,11 +135,26 @@ class ClassicalCalculator(base.HazardCalculator):
             agg=agg_dicts, acc=zerodict,
             concurrent_tasks=self.oqparam.concurrent_tasks,
             weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('trt_model_id'))
+            key=operator.attrgetter('trt_model_id'),
+            result_nbytes=self.result_nbytes)
         if self.persistent:
             store_source_chunks(self.datastore)
         return curves_by_trt_gsim
 
+    def result_nbytes(self, args):
+        """
+        Estimate the size of the hazard curves returned by a task, with
+        the same formula used in
+        :func:`openquake.calculators.views.get_data_transfer`.
+
+        :param args: the arguments of the task, starting with the sources
+        :returns: the estimated size of the result in bytes
+        """
+        trt_id = args[0][0].trt_model_id
+        num_gsims = len(self.rlzs_assoc.gsims_by_trt_id.get(trt_id, ()))
+        num_levels = sum(len(imls) for imls in self.oqparam.imtls.values())
+        return len(self.sitecol.complete) * num_levels * num_gsims * 8
+
     def post_execute(self, curves_by_trt_gsim):
         """
         Collect the hazard curves by realization and export them.
@@ -150,12 +169,22 @@ class ClassicalCalculator(base.HazardCalculator):
             pass
         else:
             sources = self.csm.get_sources()
+            gsims_assoc = self.rlzs_assoc.gsims_by_trt_id
+            learned = self.oqparam.learned_weights
             info = []
             for i, dt in calc_times:
                 src = sources[i]
-                info.append((src.trt_model_id, src.source_id, dt))
-            info.sort(key=operator.itemgetter(2), reverse=True)
-            self.source_info = numpy.array(info, source_info_dt)
+                # the cost model is fitted on the static weights and on
+                # the number of sites affected by the source
+                weight = source.get_weight(src) if learned else src.weight
+                num_sites = getattr(src, 'num_sites', len(self.sitecol))
+                info.append((src.trt_model_id, src.source_id,
+                             src.__class__.__name__, weight or 0,
+                             len(gsims_assoc.get(src.trt_model_id, ())),
+                             num_sites, dt))
+            info = numpy.array(info, source_info_dt)
+            self.source_info = info[
+                numpy.argsort(info['calc_time'], kind='mergesort')[::-1]]
 
         # save curves_by_trt_gsim
         for sm in self.rlzs_assoc.csm_info.source_models:
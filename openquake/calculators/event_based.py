@@ -20,25 +20,24 @@ import os.path
 import random
 import operator
 import logging
-import itertools
 import collections
 
 import numpy
 
 from openquake.baselib.general import AccumDict, humansize
-from openquake.hazardlib.calc.filters import \
-    filter_sites_by_distance_to_rupture
 from openquake.hazardlib.calc.hazard_curve import zero_curves
 from openquake.hazardlib import geo, site, calc
 from openquake.hazardlib.gsim.base import gsim_imt_dt
-from openquake.commonlib import readinput, parallel, datastore
+from openquake.commonlib import readinput, parallel, datastore, logictree
 from openquake.commonlib.util import max_rel_diff_index
+from openquake.commonlib.siteindex import SiteIndex
 
 from openquake.calculators import base, views
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.calculators.calc import MAX_INT, gmvs_to_haz_curve
+from openquake.calculators.calc import (
+    MAX_INT, count_exceedances, counts_to_poes)
 from openquake.calculators.classical import (
-    ClassicalCalculator, store_source_chunks, agg_dicts)
+    ClassicalCalculator, store_source_chunks)
 
 # ######################## rupture calculator ############################ #
 
@@ -57,15 +56,18 @@ def num_affected_sites(rupture, num_sites):
             else num_sites)
 
 
-def get_site_ids(rupture, num_sites):
+def get_site_ids(rupture, num_sites, sids=None):
     """
     :param rupture: a SESRupture object
     :param num_sites: the total number of sites
+    :param sids: if not None, consider only the sites with these indices
     :returns: the indices of the sites affected by the rupture
     """
     if rupture.indices is None:
-        return list(range(num_sites))
-    return rupture.indices
+        return list(range(num_sites)) if sids is None else sids
+    elif sids is None:
+        return rupture.indices
+    return numpy.intersect1d(rupture.indices, sids)
 
 
 def counts_per_rlz(num_sites, rlzs_assoc, sescollection):
@@ -101,17 +103,28 @@ def get_gmfs_nbytes(num_sites, num_imts, rlzs_assoc, sescollection):
     :returns: the number of bytes required to store the GMFs
     """
     nbytes = 0
-    # iterating over the ses collections;
-    # the bytes needed to store the GMF generated by a singlerupture are
-    # num_affected_sites * bytes_per_record; the size of a record is
-    # 4 bytes for the idx + 8 bytes * number_of_gsims * number_of_imts
+    # iterating over the ses collections
     for sescol, gsims in zip(sescollection, rlzs_assoc.get_gsims_by_col()):
-        bytes_per_record = 4 + 8 * len(gsims) * num_imts
-        for tag, rup in sescol.items():
-            nbytes += bytes_per_record * num_affected_sites(rup, num_sites)
+        nbytes += get_block_nbytes(sescol.values(), num_sites, num_imts, gsims)
     return nbytes
 
 
+def get_block_nbytes(ses_ruptures, num_sites, num_imts, gsims):
+    """
+    :param ses_ruptures: SESRuptures of the same SESCollection
+    :param num_sites: the number of sites
+    :param num_imts: the number of IMTs
+    :param gsims: the GSIMs associated to the SESCollection
+    :returns: the number of bytes required to store the GMFs
+    """
+    # the bytes needed to store the GMF generated by a single rupture are
+    # num_affected_sites * bytes_per_record; the size of a record is
+    # 4 bytes for the idx + 8 bytes * number_of_gsims * number_of_imts
+    bytes_per_record = 4 + 8 * len(gsims) * num_imts
+    return bytes_per_record * sum(num_affected_sites(rup, num_sites)
+                                  for rup in ses_ruptures)
+
+
 @datastore.view.add('gmfs_total_size')
 def view_gmfs_total_size(name, dstore):
     """
@@ -269,12 +282,12 @@ class SESRupture(object):
 
 
 @parallel.litetask
-def compute_ruptures(sources, sitecol, info, monitor):
+def compute_ruptures(sources, siteidx, info, monitor):
     """
     :param sources:
         List of commonlib.source.Source tuples
-    :param sitecol:
-        a :class:`openquake.hazardlib.site.SiteCollection` instance
+    :param siteidx:
+        a :class:`openquake.commonlib.siteindex.SiteIndex` instance
     :param info:
         a :class:`openquake.commonlib.source.CompositionInfo` instance
     :param monitor:
@@ -290,8 +303,8 @@ def compute_ruptures(sources, sitecol, info, monitor):
 
     # Compute and save stochastic event sets
     for src in sources:
-        s_sites = src.filter_sites_by_distance_to_source(
-            oq.maximum_distance, sitecol)
+        s_sites = siteidx.filter_sites_by_distance_to_source(
+            src, oq.maximum_distance)
         if s_sites is None:
             continue
 
@@ -302,7 +315,7 @@ def compute_ruptures(sources, sitecol, info, monitor):
         # to call sample_ruptures *before* the filtering
 
         for rup, rups in build_ses_ruptures(
-                src, num_occ_by_rup, s_sites, oq.maximum_distance, sitecol):
+                src, num_occ_by_rup, siteidx, oq.maximum_distance):
             sesruptures.extend(rups)
 
     return {trt_model_id: sesruptures}
@@ -337,17 +350,25 @@ def sample_ruptures(src, num_ses, info):
     return num_occ_by_rup
 
 
-def build_ses_ruptures(
-        src, num_occ_by_rup, s_sites, maximum_distance, sitecol):
+def build_ses_ruptures(src, num_occ_by_rup, siteidx, maximum_distance):
     """
     Filter the ruptures stored in the dictionary num_occ_by_rup and
-    yield pairs (rupture, <list of associated SESRuptures>)
+    yield pairs (rupture, <list of associated SESRuptures>).
+    Since the enclosing polygon of the source contains the ruptures,
+    filtering on the whole site collection gives the same sites as
+    filtering on the sites affected by the source.
+
+    :param src: a hazardlib source object
+    :param num_occ_by_rup: a dictionary returned by :func:`sample_ruptures`
+    :param siteidx: a :class:`openquake.commonlib.siteindex.SiteIndex`
+    :param maximum_distance: the maximum distance in km
     """
     rnd = random.Random(src.seed)
+    sitecol = siteidx.sitecol
     for rup in sorted(num_occ_by_rup, key=operator.attrgetter('rup_no')):
         # filtering ruptures
-        r_sites = filter_sites_by_distance_to_rupture(
-            rup, maximum_distance, s_sites)
+        r_sites = siteidx.filter_sites_by_distance_to_rupture(
+            rup, maximum_distance)
         if r_sites is None:
             # ignore ruptures which are far away
             del num_occ_by_rup[rup]  # save memory
@@ -393,16 +414,18 @@ class EventBasedRuptureCalculator(base.HazardCalculator):
 
     def execute(self):
         """
-        Run in parallel `core_func(sources, sitecol, info, monitor)`, by
+        Run in parallel `core_func(sources, siteidx, info, monitor)`, by
         parallelizing on the sources according to their weight and
         tectonic region type.
         """
         monitor = self.monitor(self.core_func.__name__)
         monitor.oqparam = self.oqparam
         sources = self.csm.get_sources()
+        siteidx = SiteIndex(self.sitecol)
+        siteidx.tree  # build the tree once, it is sent to the tasks
         ruptures_by_trt = parallel.apply_reduce(
             self.core_func.__func__,
-            (sources, self.sitecol, self.rlzs_assoc.csm_info, monitor),
+            (sources, siteidx, self.rlzs_assoc.csm_info, monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             weight=operator.attrgetter('weight'),
             key=operator.attrgetter('trt_model_id'))
@@ -447,12 +470,13 @@ class EventBasedRuptureCalculator(base.HazardCalculator):
                 'gmfs_nbytes'] = get_gmfs_nbytes(
                 len(self.sitecol), len(self.oqparam.imtls),
                 self.rlzs_assoc, sescollection)
+        self.release('sescollection')  # it is read from the datastore
 
 
 # ######################## GMF calculator ############################ #
 
 def make_gmfs(ses_ruptures, sitecol, imts, gsims,
-              trunc_level, correl_model, monitor):
+              trunc_level, correl_model, monitor, sids=None):
     """
     :param ses_ruptures: a list of SESRuptures
     :param sitecol: a SiteCollection instance
@@ -461,27 +485,54 @@ def make_gmfs(ses_ruptures, sitecol, imts, gsims,
     :param trunc_level: truncation level
     :param correl_model: correlation model instance
     :param monitor: a monitor instance
-    :returns: a list of arrays, one for each rupture
+    :param sids: if not None, compute the GMFs only on these sites
+    :returns:
+        a pair (gmfa, site_ids) where gmfa is an array of dtype gmf_dt with
+        the GMFs of all the ruptures, in the same order of the SESRuptures,
+        and site_ids is an array with the site index of each row
     """
-    gmfs = []
+    num_sites = len(sitecol)
+    gmf_dt = gsim_imt_dt(gsims, imts)
+    # group the occurrences by rupture, even if they are not contiguous
+    # (the same rupture can occur in different SES) and determine the
+    # sites affected by each rupture
+    idxs_by_rup = collections.OrderedDict()
+    for i, sr in enumerate(ses_ruptures):
+        idxs_by_rup.setdefault(sr.rupture, []).append(i)
+    site_ids_by_rup = {
+        rupture: get_site_ids(ses_ruptures[idxs[0]], num_sites, sids)
+        for rupture, idxs in idxs_by_rup.items()}
+    # determine the slice of the output array associated to each SESRupture
+    sizes = numpy.array([len(site_ids_by_rup[sr.rupture])
+                         for sr in ses_ruptures], int)
+    stops = sizes.cumsum()
+    starts = stops - sizes
+    num_rows = stops[-1] if len(stops) else 0
+    gmfa = numpy.zeros(num_rows, gmf_dt)  # preallocated output arrays
+    site_ids = numpy.zeros(num_rows, numpy.uint32)
     ctx_mon = monitor('make contexts')
     gmf_mon = monitor('compute poes')
-    for rupture, group in itertools.groupby(
-            ses_ruptures, operator.attrgetter('rupture')):
-        sesruptures = list(group)
-        indices = sesruptures[0].indices
-        r_sites = (sitecol if indices is None else
-                   site.FilteredSiteCollection(indices, sitecol.complete))
+    for rupture, idxs in idxs_by_rup.items():
+        s_ids = site_ids_by_rup[rupture]
+        if len(s_ids) == 0:  # no sites of interest affected
+            continue
+        if sids is None and ses_ruptures[idxs[0]].indices is None:
+            r_sites = sitecol
+        else:
+            r_sites = site.FilteredSiteCollection(s_ids, sitecol.complete)
         with ctx_mon:
             computer = calc.gmf.GmfComputer(
                 rupture, r_sites, imts, gsims, trunc_level, correl_model)
         with gmf_mon:
-            for sr in sesruptures:
-                gmf = computer.compute([sr.seed])[0]
+            # compute all the occurrences of the rupture in a single call,
+            # getting back an array of shape (num_occurrences, num_sites)
+            gmfs = computer.compute([ses_ruptures[i].seed for i in idxs])
+            for i, gmf in zip(idxs, gmfs):
                 # TODO: change idx to rup_idx, also in hazardlib
-                gmf['idx'] = sr.ordinal
-                gmfs.append(gmf)
-    return gmfs
+                gmf['idx'] = ses_ruptures[i].ordinal
+                gmfa[starts[i]:stops[i]] = gmf
+                site_ids[starts[i]:stops[i]] = s_ids
+    return gmfa, site_ids
 
 
 @parallel.litetask
@@ -508,48 +559,33 @@ def compute_gmfs_and_curves(ses_ruptures, sitecol, rlzs_assoc, monitor):
     trunc_level = oq.truncation_level
     correl_model = readinput.get_correl_model(oq)
     tot_sites = len(sitecol.complete)
-    num_sites = len(sitecol)
-    gmfs = make_gmfs(ses_ruptures, sitecol, oq.imtls, gsims,
-                     trunc_level, correl_model, monitor)
-    result = {(trt_id, col_id): numpy.concatenate(gmfs)
-              if oq.ground_motion_fields else None}
+    gmfa, sids = make_gmfs(ses_ruptures, sitecol, oq.imtls, gsims,
+                           trunc_level, correl_model, monitor)
+    result = {(trt_id, col_id): gmfa if oq.ground_motion_fields else None}
     if oq.hazard_curves_from_gmfs:
         with monitor('bulding hazard curves', measuremem=False):
-            duration = oq.investigation_time * oq.ses_per_logic_tree_path * (
-                oq.number_of_logic_tree_samples or 1)
-            # collect the gmvs by site
-            gmvs_by_sid = collections.defaultdict(list)
-            for sr, gmf in zip(ses_ruptures, gmfs):
-                site_ids = get_site_ids(sr, num_sites)
-                for sid, gmv in zip(site_ids, gmf):
-                    gmvs_by_sid[sid].append(gmv)
-            # build the hazard curves for each GSIM
+            # count the exceedances for each GSIM; the counts are summed
+            # across tasks and converted into PoEs by the master node
             for gsim in gsims:
                 gs = str(gsim)
-                result[trt_id, gs] = to_haz_curves(
-                    tot_sites, gmvs_by_sid, gs, oq.imtls,
-                    oq.investigation_time, duration)
+                result[trt_id, gs] = to_haz_counts(
+                    tot_sites, gmfa[gs], sids, oq.imtls)
     return result
 
 
-def to_haz_curves(num_sites, gmvs_by_sid, gs, imtls,
-                  investigation_time, duration):
+def to_haz_counts(num_sites, gmvs, sids, imtls):
     """
     :param num_sites: length of the full site collection
-    :param gmvs_by_sid: dictionary site_id -> gmvs
-    :param gs: GSIM string
+    :param gmvs: a composite array IMT -> ground motion values
+    :param sids: the site indices, one for each ground motion value
     :param imtls: ordered dictionary {IMT: intensity measure levels}
-    :param investigation_time: investigation time
-    :param duration: investigation_time * number of Stochastic Event Sets
+    :returns: a composite array IMT -> exceedance counts of shape (N, L)
     """
-    curves = zero_curves(num_sites, imtls)
+    counts = zero_curves(num_sites, imtls)
     for imt in imtls:
-        curves[imt] = numpy.array([
-            gmvs_to_haz_curve(
-                [gmv[gs][imt] for gmv in gmvs_by_sid[sid]],
-                imtls[imt], investigation_time, duration)
-            for sid in range(num_sites)])
-    return curves
+        counts[imt] = count_exceedances(
+            gmvs[imt], sids, num_sites, imtls[imt])
+    return counts
 
 
 @base.calculators.add('event_based')
@@ -571,14 +607,20 @@ class EventBasedCalculator(ClassicalCalculator):
         self.sesruptures = []
         gsims_by_col = self.rlzs_assoc.get_gsims_by_col()
         self.datasets = {}
+        num_sites = len(self.sitecol.complete)
         for col_id, sescol in enumerate(self.datastore['sescollection']):
             gmf_dt = gsim_imt_dt(gsims_by_col[col_id], self.oqparam.imtls)
             for tag, sesrup in sorted(sescol.items()):
                 sesrup = sescol[tag]
                 self.sesruptures.append(sesrup)
             if self.oqparam.ground_motion_fields and sescol:
+                num_rows = sum(num_affected_sites(rup, num_sites)
+                               for rup in sescol.values())
                 self.datasets[col_id] = self.datastore.create_dset(
-                    'gmfs/col%02d' % col_id, gmf_dt)
+                    'gmfs/col%02d' % col_id, gmf_dt, expected_rows=num_rows)
+        # the rows of each event, filled while saving the GMFs
+        self.gmf_index = numpy.zeros(
+            len(self.sesruptures), logictree.gmf_index_dt)
 
     def combine_curves_and_save_gmfs(self, acc, res):
         """
@@ -586,8 +628,8 @@ class EventBasedCalculator(ClassicalCalculator):
         sequentially; notice that the gmfs may come from
         different tasks in any order.
 
-        :param acc: an accumulator for the hazard curves
-        :param res: a dictionary trt_id, gsim -> gmf_array or curves_by_imt
+        :param acc: an accumulator for the hazard curves counts
+        :param res: a dictionary trt_id, gsim -> gmf_array or counts_by_imt
         :returns: a new accumulator
         """
         sav_mon = self.monitor('saving gmfs')
@@ -599,18 +641,41 @@ class EventBasedCalculator(ClassicalCalculator):
                     gmfa = res[trt_id, gsim_or_col]
                     dataset = self.datasets[gsim_or_col]
                     dataset.attrs['trt_model_id'] = trt_id
-                    dataset.extend(gmfa)
+                    logictree.update_gmf_index(
+                        self.gmf_index, gsim_or_col, gmfa['idx'], len(dataset))
+                    dataset.extend(gmfa)  # buffered
                     self.nbytes += gmfa.nbytes
-                    self.datastore.hdf5.flush()
-            elif isinstance(gsim_or_col, str):  # aggregate hcurves
+            elif isinstance(gsim_or_col, str):  # aggregate hcurves counts
                 with agg_mon:
-                    curves_by_imt = res[trt_id, gsim_or_col]
-                    acc = agg_dicts(
-                        acc, AccumDict({(trt_id, gsim_or_col): curves_by_imt}))
+                    counts = res[trt_id, gsim_or_col]
+                    acc_counts = acc[trt_id, gsim_or_col]
+                    for imt in counts.dtype.fields:
+                        acc_counts[imt] += counts[imt]
         sav_mon.flush()
         agg_mon.flush()
         return acc
 
+    def result_nbytes(self, args):
+        """
+        Estimate the size of the GMFs and of the hazard curves counts
+        returned by a task.
+
+        :param args: the arguments of the task, starting with the ruptures
+        :returns: the estimated size of the result in bytes
+        """
+        oq = self.oqparam
+        ses_ruptures = args[0]
+        gsims = self.rlzs_assoc.get_gsims_by_col()[ses_ruptures[0].col_id]
+        num_sites = len(self.sitecol.complete)
+        nbytes = 0
+        if oq.ground_motion_fields:
+            nbytes += get_block_nbytes(
+                ses_ruptures, num_sites, len(oq.imtls), gsims)
+        if oq.hazard_curves_from_gmfs:
+            num_levels = sum(len(imls) for imls in oq.imtls.values())
+            nbytes += num_sites * num_levels * len(gsims) * 8
+        return nbytes
+
     def execute(self):
         """
         Run in parallel `core_func(sources, sitecol, monitor)`, by
@@ -623,14 +688,17 @@ class EventBasedCalculator(ClassicalCalculator):
         monitor = self.monitor(self.core_func.__name__)
         monitor.oqparam = oq
         zc = zero_curves(len(self.sitecol.complete), self.oqparam.imtls)
-        zerodict = AccumDict((key, zc) for key in self.rlzs_assoc)
+        # the counts are updated in place, so each key needs its own array
+        zerodict = AccumDict((key, zc.copy()) for key in self.rlzs_assoc)
         self.nbytes = 0
         curves_by_trt_gsim = parallel.apply_reduce(
             self.core_func.__func__,
             (self.sesruptures, self.sitecol, self.rlzs_assoc, monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             acc=zerodict, agg=self.combine_curves_and_save_gmfs,
-            key=operator.attrgetter('col_id'))
+            key=operator.attrgetter('col_id'),
+            result_nbytes=self.result_nbytes)
+        self.datastore.flush()  # write the buffered gmfs
         if oq.ground_motion_fields:
             # sanity check on the saved gmfs size
             expected_nbytes = self.datastore[
@@ -638,8 +706,40 @@ class EventBasedCalculator(ClassicalCalculator):
             self.datastore['gmfs'].attrs['nbytes'] = self.nbytes
             assert self.nbytes == expected_nbytes, (
                 self.nbytes, expected_nbytes)
+            self.datastore['gmf_index'] = self.gmf_index
+            if oq.gmfs_by_site:
+                self.save_gmfs_by_site()
+        if oq.hazard_curves_from_gmfs:
+            # convert the exceedance counts into PoEs
+            duration = oq.investigation_time * oq.ses_per_logic_tree_path * (
+                oq.number_of_logic_tree_samples or 1)
+            for key in curves_by_trt_gsim:
+                curves_by_trt_gsim[key] = counts_to_poes(
+                    curves_by_trt_gsim[key], oq.investigation_time, duration)
         return curves_by_trt_gsim
 
+    def save_gmfs_by_site(self):
+        """
+        Store for each collection the GMF rows of each site, i.e. the
+        datasets gmfs_by_site/colXX/rows and gmfs_by_site/colXX/index,
+        see :func:`openquake.commonlib.datastore.build_index`.
+        """
+        num_sites = len(self.sitecol)
+        sids = {col_id: numpy.zeros(len(dset), numpy.uint32)
+                for col_id, dset in self.datasets.items()}
+        # the rows of each event are in the order of the affected sites
+        for sr in self.sesruptures:
+            rec = self.gmf_index[sr.ordinal]
+            if rec['stop'] > rec['start']:
+                sids[rec['col_id']][rec['start']:rec['stop']] = get_site_ids(
+                    sr, num_sites)
+        for col_id in sids:
+            rows, index = datastore.build_index(
+                sids[col_id], len(self.sitecol.complete))
+            key = 'gmfs_by_site/col%02d/' % col_id
+            self.datastore[key + 'rows'] = rows
+            self.datastore[key + 'index'] = index
+
     def post_execute(self, result):
         """
         :param result:
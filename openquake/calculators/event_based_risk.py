@@ -22,9 +22,9 @@ import collections
 
 import numpy
 
-from openquake.baselib.general import AccumDict, humansize
+from openquake.baselib.general import AccumDict, humansize, groupby
 from openquake.calculators import base
-from openquake.commonlib import readinput, parallel, datastore
+from openquake.commonlib import readinput, parallel, datastore, logictree
 from openquake.risklib import riskinput, scientific
 from openquake.commonlib.parallel import apply_reduce
 
@@ -208,12 +208,17 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             oq.truncation_level, correl_model, eps,
             oq.concurrent_tasks or 1))
         logging.info('Built %d risk inputs', len(self.riskinputs))
+        if 'gmfs' in self.datastore or 'gmfs' in self.datastore.parent:
+            # reuse the GMFs stored by a previous event_based calculation
+            with self.monitor('reading gmfs', autoflush=True):
+                self.read_gmfs()
 
         # preparing empty datasets
         loss_types = self.riskmodel.loss_types
         self.L = len(loss_types)
         self.R = len(self.rlzs_assoc.realizations)
         self.outs = OUTPUTS
+        self.flushed = {out: 0 for out in self.outs}  # bytes saved early
         self.datasets = {}
         # ugly: attaching an attribute needed in the task function
         self.monitor.num_outputs = len(self.outs)
@@ -229,6 +234,71 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                         dset = self.datastore.create_dset(out + key, ela_dt)
                     self.datasets[o, l, r] = dset
 
+    def read_gmfs(self):
+        """
+        Attach to each risk input the GMFs on its asset sites, as read from
+        the datasets gmfs/colXX saved by the event_based calculator, so that
+        the GMFs do not need to be recomputed in the workers. If the stored
+        GMFs do not contain all the IMTs required by the risk model, or if
+        the hazard site collection is not the risk one, nothing is done and
+        the GMFs will be recomputed. Only references to the GMFs are
+        attached and the workers read the slices they need; if the GMFs are
+        in the file of the current calculation, which is open for writing,
+        they are copied in a snapshot file first.
+        """
+        parent = self.datastore.parent
+        haz_sitecol = parent['sitecol'] if parent else self.sitecol
+        num_sites = len(haz_sitecol)
+        # the GMFs are stored by hazard site index, while the risk inputs
+        # use the indices of the risk site collection
+        risk_sites = self.sitecol.complete
+        haz_sites = haz_sitecol.complete
+        if len(risk_sites) != len(haz_sites) or not (
+                numpy.allclose(risk_sites.lons, haz_sites.lons) and
+                numpy.allclose(risk_sites.lats, haz_sites.lats)):
+            logging.warn('The hazard sites are not the risk sites, '
+                         'the GMFs will be recomputed')
+            return
+        # the GMF rows are identified by the ordinal of the rupture
+        # in the rupture calculator, i.e. by the position in /tags
+        tags = self.datastore['tags'].value
+        by_col = operator.attrgetter('col_id')
+        ris_by_col = groupby(self.riskinputs, by_col)
+        dsets = {col_id: self.datastore['gmfs/col%02d' % col_id]
+                 for col_id in ris_by_col}
+        for col_id, riskinputs in ris_by_col.items():
+            for gsim in map(str, riskinputs[0].gsims):
+                missing = set(riskinputs[0].imts) - set(
+                    dsets[col_id].dtype[gsim].names)
+                if missing:
+                    logging.warn('The stored GMFs do not contain %s, '
+                                 'they will be recomputed', missing)
+                    return
+        writing = [dset.name for dset in dsets.values()
+                   if dset.file.mode != 'r']
+        if writing:  # the workers cannot read a file open for writing
+            with self.monitor('saving gmfs snapshot', autoflush=True):
+                snapshot = self.datastore.snapshot(*writing)
+        index = logictree.get_gmf_index(self.datastore)
+        for col_id, riskinputs in ris_by_col.items():
+            dset = dsets[col_id]
+            rupids = numpy.flatnonzero((index['col_id'] == col_id) &
+                                       (index['stop'] > index['start']))
+            if len(rupids) == 0:
+                continue
+            slice_by_tag = {tags[rupid]: slice(int(index['start'][rupid]),
+                                               int(index['stop'][rupid]))
+                            for rupid in rupids}
+            if dset.name in writing:
+                ref = datastore.DatasetRef(snapshot, dset.name)
+            else:  # in the file of a previous calculation, read-only
+                ref = datastore.DatasetRef.from_dset(dset)
+            for ri in riskinputs:
+                ri.set_gmfs_ref(ref, slice_by_tag, num_sites,
+                                ri.get_sids(self.assets_by_site))
+        logging.info('Reusing the stored GMFs for %d risk inputs',
+                     len(self.riskinputs))
+
     def execute(self):
         """
         Run the event_based_risk calculator and aggregate the results
@@ -242,7 +312,28 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             agg=self.agg,
             acc=cube(self.monitor.num_outputs, self.L, self.R, list),
             weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('col_id'))
+            key=operator.attrgetter('col_id'),
+            flush=self.flush_losses)
+
+    def flush_losses(self, acc):
+        """
+        Save the loss tables and the specific losses accumulated so far
+        and free the memory. This is called by the task manager when the
+        memory budget is exceeded.
+
+        :param acc: accumulator array of shape (O, L, R)
+        :returns: the same accumulator, without the saved losses
+        """
+        with self.monitor('saving loss table',
+                          autoflush=True, measuremem=True):
+            for (o, l, r), data in numpy.ndenumerate(acc):
+                if o in (AGGLOSS, SPECLOSS) and data:
+                    losses = numpy.concatenate(data)
+                    self.datasets[o, l, r].extend(losses)
+                    self.flushed[self.outs[o]] += losses.nbytes
+                    del data[:]
+            self.datastore.flush()
+        return acc
 
     def agg(self, acc, result):
         """
@@ -266,9 +357,10 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         :param result:
             a numpy array of shape (O, L, R) containing lists of arrays
         """
+        self.release('epsilon_matrix')  # used only by the tasks
         insured_losses = self.oqparam.insured_losses
         ses_ratio = self.oqparam.ses_ratio
-        saved = {out: 0 for out in self.outs}
+        saved = dict(self.flushed)
         N = len(self.assetcol)
         R = len(self.rlzs_assoc.realizations)
         ltypes = self.riskmodel.loss_types
@@ -312,14 +404,13 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                     elif insured_losses:
                         icurves[lt][:, r] = poes
                     saved[self.outs[o]] += poes.nbytes
-                self.datastore.hdf5.flush()
 
         self.datastore['avg_losses-rlzs'] = avg_losses
         saved['avg_losses-rlzs'] = avg_losses.nbytes
         self.datastore['rcurves-rlzs'] = rcurves
         if insured_losses:
             self.datastore['icurves-rlzs'] = icurves
-        self.datastore.hdf5.flush()
+        self.datastore.flush()
 
         for out in self.outs:
             nbytes = saved[out]
@@ -364,7 +455,7 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         """
         oq = self.oqparam
         rlzs = self.datastore['rlzs_assoc'].realizations
-        curves = self.datastore[curves_key].value
+        curves = datastore.LazyArray(self.datastore[curves_key])
         N = len(self.assetcol)
         R = len(rlzs)
         P = len(oq.conditional_loss_poes)
@@ -372,20 +463,25 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             [(lt, (F32, P)) for lt in self.riskmodel.loss_types])
         maps = numpy.zeros((N, R), loss_map_dt)
         for cb in self.riskmodel.curve_builders:
-            asset_values = self.assetcol[cb.loss_type]
             curves_lt = curves[cb.loss_type]
-            maps_lt = maps[cb.loss_type]
-            for rlz in rlzs:
-                loss_maps = scientific.calc_loss_maps(
-                    oq.conditional_loss_poes, asset_values, cb.ratios,
-                    curves_lt[:, rlz.ordinal])
-                for i in range(N):
-                    # NB: it does not work without the loop, there is a
-                    # ValueError: could not broadcast input array from shape
-                    # (N,1) into shape (N)
-                    maps_lt[i, rlz.ordinal] = loss_maps[i]
+            for slc in curves_lt.slices():  # read a block of assets
+                self._build_loss_maps(
+                    cb, rlzs, self.assetcol[cb.loss_type][slc],
+                    curves_lt[slc].read(), maps[cb.loss_type][slc])
         self.datastore[maps_key] = maps
 
+    def _build_loss_maps(self, cb, rlzs, asset_values, curves_lt, maps_lt):
+        # populate the loss maps of the given assets and loss type
+        for rlz in rlzs:
+            loss_maps = scientific.calc_loss_maps(
+                self.oqparam.conditional_loss_poes, asset_values, cb.ratios,
+                curves_lt[:, rlz.ordinal])
+            for i in range(len(asset_values)):
+                # NB: it does not work without the loop, there is a
+                # ValueError: could not broadcast input array from shape
+                # (N,1) into shape (N)
+                maps_lt[i, rlz.ordinal] = loss_maps[i]
+
     # ################### methods to compute statistics  #################### #
 
     def _collect_all_data(self):
@@ -395,15 +491,18 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         all_data = []
         assets = self.assetcol['asset_ref']
         rlzs = self.rlzs_assoc.realizations
-        avg_losses = self.datastore['avg_losses-rlzs'].value
-        r_curves = self.datastore['rcurves-rlzs'].value
+        # only the arrays of the current loss type are read
+        avg_losses = datastore.LazyArray(self.datastore['avg_losses-rlzs'])
+        r_curves = datastore.LazyArray(self.datastore['rcurves-rlzs'])
         insured_losses = self.oqparam.insured_losses
-        i_curves = (self.datastore['icurves-rlzs'].value
+        i_curves = (datastore.LazyArray(self.datastore['icurves-rlzs'])
                     if insured_losses else None)
         for loss_type, cbuilder in zip(
                 self.riskmodel.loss_types, self.riskmodel.curve_builders):
-            avglosses = avg_losses[loss_type]
-            rcurves = r_curves[loss_type]
+            avglosses = avg_losses[loss_type].read()
+            rcurves = r_curves[loss_type].read()
+            icurves = (i_curves[loss_type].read()
+                       if i_curves is not None else None)
             asset_values = self.assetcol[loss_type]
             data = []
             for rlz in rlzs:
@@ -413,8 +512,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                     loss_curves=old_loss_curves(asset_values, rcurves,
                                                 rlz.ordinal, cbuilder.ratios),
                     insured_curves=old_loss_curves(
-                        asset_values, i_curves[loss_type], rlz.ordinal,
-                        cbuilder.ratios) if i_curves else None,
+                        asset_values, icurves, rlz.ordinal,
+                        cbuilder.ratios) if icurves is not None else None,
                     average_losses=average_losses[:, 0],
                     average_insured_losses=average_losses[:, 1])
                 data.append(out)
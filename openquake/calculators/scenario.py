@@ -22,9 +22,9 @@ import collections
 
 import numpy
 
-from openquake.hazardlib.calc import filters
 from openquake.hazardlib.calc.gmf import GmfComputer
-from openquake.commonlib import readinput, parallel, datastore
+from openquake.commonlib import readinput, parallel, datastore, logictree
+from openquake.commonlib.siteindex import SiteIndex
 
 from openquake.calculators import base, calc
 
@@ -72,8 +72,9 @@ class ScenarioCalculator(base.HazardCalculator):
         self.rlzs_assoc = readinput.get_rlzs_assoc(self.oqparam)
 
         with self.monitor('filtering sites', autoflush=True):
-            self.sitecol = filters.filter_sites_by_distance_to_rupture(
-                rupture, self.oqparam.maximum_distance, self.sitecol)
+            self.sitecol = SiteIndex(
+                self.sitecol).filter_sites_by_distance_to_rupture(
+                rupture, self.oqparam.maximum_distance)
         if self.sitecol is None:
             raise RuntimeError(
                 'All sites were filtered out! '
@@ -114,3 +115,13 @@ class ScenarioCalculator(base.HazardCalculator):
             gmfa = numpy.concatenate(data)
             self.datastore['gmfs/col00'] = gmfa
             self.datastore['gmfs'].attrs['nbytes'] = gmfa.nbytes
+            index = numpy.zeros(len(data), logictree.gmf_index_dt)
+            logictree.update_gmf_index(index, 0, gmfa['idx'])
+            self.datastore['gmf_index'] = index
+            if self.oqparam.gmfs_by_site:
+                # the rows of each event are in the order of the sites
+                sids = numpy.tile(self.sitecol.indices, len(data))
+                rows, site_index = datastore.build_index(
+                    sids, len(self.sitecol.complete))
+                self.datastore['gmfs_by_site/col00/rows'] = rows
+                self.datastore['gmfs_by_site/col00/index'] = site_index
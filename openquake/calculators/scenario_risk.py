@@ -114,6 +114,7 @@ class ScenarioRiskCalculator(base.RiskCalculator):
         Compute stats for the aggregated distributions and save
         the results on the datastore.
         """
+        self.release('epsilon_matrix')  # used only by the tasks
         ltypes = self.riskmodel.loss_types
         multi_stat_dt = numpy.dtype([(lt, stat_dt) for lt in ltypes])
         with self.monitor('saving outputs', autoflush=True):
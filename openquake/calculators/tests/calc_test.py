@@ -38,3 +38,23 @@ class HazardMapsTestCase(unittest.TestCase):
         ]
         actual = calc.compute_hazard_maps(curves, imls, poes)
         aaae(expected, actual.T)
+
+
+class GmvsToHazCurveTestCase(unittest.TestCase):
+
+    def test_count_exceedances(self):
+        # the vectorized counts must agree with gmvs_to_haz_curve
+        gmvs = numpy.array([0.04, 0.1, 0.01, 0.03, 0.2, 0.05])
+        sids = numpy.array([0, 0, 2, 2, 2, 0])
+        imls = [0.03, 0.05, 0.1]
+        counts = calc.count_exceedances(gmvs, sids, 3, imls)
+        numpy.testing.assert_equal(counts, [[3, 2, 1], [0, 0, 0], [2, 1, 1]])
+
+        imt_dt = numpy.dtype([('PGA', (float, 3))])
+        counts_by_imt = numpy.zeros(3, imt_dt)
+        counts_by_imt['PGA'] = counts
+        poes = calc.counts_to_poes(counts_by_imt, 50., 500.)
+        for sid in range(3):
+            expected = calc.gmvs_to_haz_curve(
+                gmvs[sids == sid], imls, 50., 500.)
+            aaae(poes['PGA'][sid], expected)
@@ -0,0 +1,209 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A catalog of the calculations in a data directory, stored in the sqlite
+file `catalog.sqlite` and updated when a calculation starts and finishes,
+so that listing the calculations does not require opening all the
+calc_XXX.hdf5 files. The calculations run before the catalog existed
+are registered when the catalog is created. The catalog also keeps
+the fingerprints of the hazard computed by each calculation, used to
+reuse a previous hazard calculation with the same parameters and inputs.
+"""
+import os
+import ast
+import time
+import sqlite3
+import collections
+
+from openquake.commonlib import datastore
+
+CATALOG = 'catalog.sqlite'
+TIMEOUT = 30  # seconds waiting for a lock held by another process
+
+CalcInfo = collections.namedtuple(
+    'CalcInfo', 'calc_id calculation_mode description status size '
+    'start_time stop_time')
+
+SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS calc(
+  calc_id INTEGER PRIMARY KEY,
+  calculation_mode TEXT,
+  description TEXT,
+  status TEXT,
+  size INTEGER,
+  start_time REAL,
+  stop_time REAL)'''
+
+FINGERPRINT_SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS fingerprint(
+  calc_id INTEGER,
+  fingerprint TEXT,
+  PRIMARY KEY (calc_id, fingerprint))'''
+
+INSERT = 'INSERT OR %s INTO calc VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+
+def _literal(value):
+    # the parameters are stored as Python literals in the HDF5 attributes
+    if isinstance(value, bytes):
+        value = value.decode('utf8')
+    return ast.literal_eval(value)
+
+
+def read_calc_info(datadir, calc_id):
+    """
+    :param datadir: the data directory
+    :param calc_id: the ID of a calculation in the data directory
+    :returns: a CalcInfo object read from the file calc_<calc_id>.hdf5;
+              the status is 'invalid' if the file cannot be read
+    """
+    path = os.path.join(datadir, 'calc_%d.hdf5' % calc_id)
+    size, mtime = os.path.getsize(path), os.path.getmtime(path)
+    try:
+        with datastore.h5py.File(path, 'r') as f:
+            mode = _literal(f.attrs['calculation_mode'])
+            descr = _literal(f.attrs['description'])
+            # the performance is saved at the end of the calculation
+            status = 'complete' if 'performance' in f else 'incomplete'
+    except Exception:  # broken file, or still open for writing
+        return CalcInfo(calc_id, None, None, 'invalid', size, None, mtime)
+    return CalcInfo(calc_id, mode, descr, status, size, None, mtime)
+
+
+class Catalog(object):
+    """
+    Access the catalog of the given data directory. Each method opens
+    and closes its own connection, so a Catalog instance can be shared
+    and concurrent calculations can update the same catalog.
+
+    :param datadir: the data directory (default datastore.DATADIR)
+    """
+    def __init__(self, datadir=None):
+        self.datadir = datadir or datastore.DATADIR
+        self.path = os.path.join(self.datadir, CATALOG)
+
+    def _connect(self):
+        if not os.path.exists(self.datadir):
+            os.makedirs(self.datadir)
+        new = not os.path.exists(self.path)
+        conn = sqlite3.connect(self.path, timeout=TIMEOUT)
+        with conn:
+            conn.execute(SCHEMA)
+            conn.execute(FINGERPRINT_SCHEMA)
+        if new:  # register the calculations run before the catalog
+            rows = [read_calc_info(self.datadir, calc_id)
+                    for calc_id in datastore.get_calc_ids(self.datadir)]
+            with conn:
+                conn.executemany(INSERT % 'IGNORE', rows)
+        return conn
+
+    def _execute(self, sql, *args):
+        conn = self._connect()
+        try:
+            with conn:  # commit or rollback
+                return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def start(self, calc_id, calculation_mode, description):
+        """
+        Register a calculation as executing
+        """
+        self._execute(INSERT % 'REPLACE', calc_id, calculation_mode,
+                      description, 'executing', None, time.time(), None)
+
+    def finish(self, calc_id, status, size):
+        """
+        Register the final status of a calculation
+
+        :param calc_id: the calculation ID
+        :param status: 'complete' or 'failed'
+        :param size: the size of the calculation file in bytes
+        """
+        self._execute('UPDATE calc SET status=?, size=?, stop_time=? '
+                      'WHERE calc_id=?', status, size, time.time(), calc_id)
+
+    def remove(self, calc_id):
+        """
+        Remove a calculation from the catalog
+        """
+        self._execute('DELETE FROM calc WHERE calc_id=?', calc_id)
+        self._execute('DELETE FROM fingerprint WHERE calc_id=?', calc_id)
+
+    def set_fingerprint(self, calc_id, fingerprint):
+        """
+        Register the fingerprint of the hazard computed by a calculation
+
+        :param calc_id: the calculation ID
+        :param fingerprint: a string, see OqParam.hazard_fingerprint
+        """
+        self._execute('INSERT OR IGNORE INTO fingerprint VALUES (?, ?)',
+                      calc_id, fingerprint)
+
+    def find(self, fingerprint):
+        """
+        :param fingerprint: a string, see OqParam.hazard_fingerprint
+        :returns: the ID of the most recent complete calculation with
+                  the given fingerprint, or None
+        """
+        rows = self._execute(
+            'SELECT calc.calc_id FROM calc JOIN fingerprint '
+            'ON calc.calc_id=fingerprint.calc_id WHERE fingerprint=? '
+            "AND status='complete' ORDER BY calc.calc_id DESC", fingerprint)
+        for calc_id, in rows:
+            if os.path.exists(
+                    os.path.join(self.datadir, 'calc_%d.hdf5' % calc_id)):
+                return calc_id
+
+    def get_calcs(self):
+        """
+        :returns: a list of CalcInfo objects ordered by calculation ID
+
+        The calculations whose files were removed are removed from the
+        catalog too.
+        """
+        calcs = []
+        for row in self._execute('SELECT * FROM calc ORDER BY calc_id'):
+            info = CalcInfo(*row)
+            path = os.path.join(self.datadir, 'calc_%d.hdf5' % info.calc_id)
+            if os.path.exists(path):
+                calcs.append(info)
+            else:
+                self.remove(info.calc_id)
+        return calcs
+
+    def get_calc_ids(self):
+        """
+        :returns: the ordered IDs of the calculations in the catalog
+        """
+        return [info.calc_id for info in self.get_calcs()]
+
+    def get_calc_id(self, calc_id):
+        """
+        :param calc_id: a calculation ID; if negative, count from the end
+        :returns: a positive calculation ID
+        """
+        if calc_id >= 0:
+            return calc_id
+        calc_ids = self.get_calc_ids()
+        try:
+            return calc_ids[calc_id]
+        except IndexError:
+            raise IndexError('There are %d old calculations, cannot '
+                             'retrieve the %s' % (len(calc_ids), calc_id))
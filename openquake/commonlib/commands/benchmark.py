@@ -0,0 +1,56 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import logging
+from openquake.baselib.performance import PerformanceMonitor
+from openquake.baselib.general import humansize
+from openquake.commonlib import sap, readinput
+from openquake.calculators import base
+from openquake.calculators.views import rst_table
+
+
+def benchmark(job_ini, distribute='processpool,threadpool,no',
+              concurrent_tasks=None, loglevel='warn'):
+    """
+    Run the same calculation with different executors and print the
+    time and memory spent in each case. You can pass several job.ini
+    files, comma-separated, for instance the ones in qa_tests_data.
+    """
+    logging.basicConfig(level=getattr(logging, loglevel.upper()))
+    rows = []
+    for ini in job_ini.split(','):
+        for dist in distribute.split(','):
+            oqparam = readinput.get_oqparam(ini)
+            mon = PerformanceMonitor('total', measuremem=True)
+            calc = base.calculators(oqparam, mon)
+            with mon:
+                calc.run(concurrent_tasks=concurrent_tasks, exports='',
+                         distribute=dist)
+            rows.append((ini, dist, '%.2f' % mon.duration,
+                         humansize(mon.mem)))
+    print(rst_table(rows, ['job_ini', 'distribute', 'time_sec', 'memory']))
+
+parser = sap.Parser(benchmark)
+parser.arg('job_ini', 'calculation configuration file '
+           '(or files, comma-separated)')
+parser.opt('distribute', 'comma-separated executors to compare')
+parser.opt('concurrent_tasks', 'hint for the number of tasks to spawn',
+           type=int)
+parser.opt('loglevel', 'logging level',
+           choices='debug info warn error critical'.split())
@@ -0,0 +1,73 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import time
+import shutil
+import tempfile
+import numpy
+from openquake.baselib.general import humansize
+from openquake.commonlib import sap, datastore
+from openquake.calculators.views import rst_table
+
+
+def get_gmf_dt(num_gsims, num_imts):
+    """
+    :returns: a dtype similar to the one of the gmfs/colXX datasets
+    """
+    imt_dt = numpy.dtype([('IMT%d' % i, float) for i in range(num_imts)])
+    return numpy.dtype([('idx', numpy.uint32)] +
+                       [('GSIM%d' % i, imt_dt) for i in range(num_gsims)])
+
+
+def benchmark_writes(num_blocks=1000, block_size=100, num_gsims=2,
+                     num_imts=3, flush_threshold='0,65536,1048576,8388608'):
+    """
+    Measure the throughput of the writes in a GMF-like dataset, with
+    blocks of the given size (the GMFs returned by a task) and different
+    flush thresholds (0 means writing at each block).
+    """
+    dt = get_gmf_dt(num_gsims, num_imts)
+    block = numpy.zeros(block_size, dt)
+    rows = []
+    for threshold in map(int, flush_threshold.split(',')):
+        tmpdir = tempfile.mkdtemp()
+        dstore = datastore.DataStore(datadir=tmpdir)
+        try:
+            dset = dstore.create_dset('gmfs/col00', dt,
+                                      expected_rows=num_blocks * block_size)
+            dset.flush_threshold = threshold
+            t0 = time.time()
+            for _ in range(num_blocks):
+                dset.extend(block)
+            dstore.flush()
+            dt_sec = time.time() - t0
+        finally:
+            dstore.close()
+            shutil.rmtree(tmpdir)
+        nbytes = block.nbytes * num_blocks
+        rows.append((humansize(threshold), '%.3f' % dt_sec,
+                     humansize(int(nbytes / dt_sec)) + '/s'))
+    print(rst_table(rows, ['flush_threshold', 'time_sec', 'throughput']))
+
+parser = sap.Parser(benchmark_writes)
+parser.opt('num_blocks', 'number of blocks to write', type=int)
+parser.opt('block_size', 'number of rows per block', type=int)
+parser.opt('num_gsims', 'number of GSIMs', type=int)
+parser.opt('num_imts', 'number of IMTs', type=int)
+parser.opt('flush_threshold', 'comma-separated thresholds in bytes')
@@ -19,7 +19,7 @@
 from __future__ import print_function
 import os
 import shutil
-from openquake.commonlib import sap, datastore
+from openquake.commonlib import sap, datastore, catalog
 
 
 def purge(calc_id):
@@ -30,8 +30,11 @@ def purge(calc_id):
         shutil.rmtree(datastore.DATADIR)
         print('Removed %s' % datastore.DATADIR)
     else:
-        hdf5path = datastore.DataStore(calc_id).hdf5path
+        cat = catalog.Catalog()
+        calc_id = cat.get_calc_id(calc_id)
+        hdf5path = os.path.join(datastore.DATADIR, 'calc_%d.hdf5' % calc_id)
         os.remove(hdf5path)
+        cat.remove(calc_id)
         print('Removed %s' % hdf5path)
 
 
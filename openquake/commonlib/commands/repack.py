@@ -0,0 +1,46 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from openquake.baselib.general import humansize
+from openquake.commonlib import sap, datastore, valid
+from openquake.commonlib.oqvalidation import OqParam
+
+
+def repack(calc_id, filters=None):
+    """
+    Copy the live objects of a calculation into a fresh file, recovering
+    the space of the deleted and overwritten objects. The datasets are
+    compressed with the given filters, or with the hdf5_filters of the
+    calculation.
+    """
+    dstore = datastore.DataStore(calc_id)
+    if filters is None:
+        dstore.filters = OqParam.from_(dstore.attrs).hdf5_filters
+    else:
+        dstore.filters = valid.hdf5_filters(filters)
+    before, after = dstore.repack()
+    dstore.close()
+    print('Repacked %s: %s -> %s, recovered %s' % (
+        dstore.hdf5path, humansize(before), humansize(after),
+        humansize(max(before - after, 0))))
+
+
+parser = sap.Parser(repack)
+parser.arg('calc_id', 'calculation ID', type=int)
+parser.opt('filters', 'HDF5 filters, like "gmfs/*: gzip shuffle"')
@@ -19,7 +19,7 @@ from __future__ import print_function
 import logging
 
 from openquake.baselib import performance, general
-from openquake.commonlib import sap, readinput, valid, datastore
+from openquake.commonlib import sap, readinput, valid, catalog
 from openquake.calculators import base
 
 
@@ -52,12 +52,10 @@ def run(job_ini, concurrent_tasks=None, pdb=None,
     if len(job_inis) == 1:  # run hazard or risk
         oqparam = readinput.get_oqparam(job_inis[0], hc_id=hc)
         if hc and hc < 0:  # interpret negative calculation ids
-            calc_ids = datastore.get_calc_ids()
             try:
-                hc = calc_ids[hc]
-            except IndexError:
-                raise SystemExit('There are %d old calculations, cannot '
-                                 'retrieve the %s' % (len(calc_ids), hc))
+                hc = catalog.Catalog().get_calc_id(hc)
+            except IndexError as exc:
+                raise SystemExit(str(exc))
         calc = base.calculators(oqparam, monitor)
         with monitor:
             calc.run(concurrent_tasks=concurrent_tasks, pdb=pdb,
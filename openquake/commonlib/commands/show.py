@@ -19,10 +19,8 @@
 from __future__ import print_function
 import io
 import os
-import shutil
-import logging
 
-from openquake.commonlib import sap, datastore
+from openquake.commonlib import sap, datastore, catalog
 from openquake.baselib.general import humansize
 from openquake.commonlib.oqvalidation import OqParam
 from openquake.commonlib.commands.plot import combined_curves
@@ -41,19 +39,16 @@ def show(calc_id, key=None, rlzs=None):
     if not calc_id:
         if not os.path.exists(datastore.DATADIR):
             return
-        rows = []
-        for calc_id in datastore.get_calc_ids(datastore.DATADIR):
-            try:
-                oq = OqParam.from_(datastore.DataStore(calc_id).attrs)
-                cmode, descr = oq.calculation_mode, oq.description
-            except:  # invalid datastore directory
-                logging.warn('Removed invalid calculation %d', calc_id)
-                shutil.rmtree(os.path.join(
-                    datastore.DATADIR, 'calc_%s' % calc_id))
-            else:
-                rows.append((calc_id, cmode, descr))
-        for row in sorted(rows, key=lambda row: row[0]):  # by calc_id
-            print('#%d %s: %s' % row)
+        # the calculations are listed from the catalog, without opening
+        # their files
+        for info in catalog.Catalog().get_calcs():
+            extra = [info.status]
+            if info.size is not None:
+                extra.append(humansize(info.size))
+            if info.start_time and info.stop_time:
+                extra.append('%d s' % (info.stop_time - info.start_time))
+            print('#%d %s: %s [%s]' % (info.calc_id, info.calculation_mode,
+                                       info.description, ', '.join(extra)))
         return
     ds = datastore.DataStore(calc_id)
     if key:
@@ -0,0 +1,48 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import multiprocessing
+from openquake.commonlib import sap, workqueue
+
+
+def worker(address=None, num_workers=None, loglevel='info'):
+    """
+    Start worker processes pulling tasks from the work queue of a master
+    running with OQ_DISTRIBUTE=workqueue. The default address is taken
+    from the environment variable OQ_WORKQUEUE and the authentication key
+    from OQ_WORKQUEUE_AUTHKEY.
+    """
+    logging.basicConfig(level=getattr(logging, loglevel.upper()))
+    address = workqueue.get_address(address)
+    authkey = workqueue.get_authkey()
+    procs = [multiprocessing.Process(target=workqueue.run_worker,
+                                     args=(address, authkey))
+             for _ in range(num_workers or multiprocessing.cpu_count())]
+    for proc in procs:
+        proc.start()
+    logging.info('Started %d workers for %s:%d', len(procs), *address)
+    for proc in procs:
+        proc.join()
+
+parser = sap.Parser(worker)
+parser.arg('address', 'address of the master, in the form host:port')
+parser.opt('num_workers', 'number of worker processes (default all cores)',
+           type=int)
+parser.opt('loglevel', 'logging level',
+           choices='debug info warn error critical'.split())
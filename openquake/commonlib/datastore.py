@@ -19,7 +19,9 @@
 import os
 import re
 import ast
-from openquake.baselib.python3compat import pickle
+import fnmatch
+import importlib
+from openquake.baselib.python3compat import pickle, unicode
 import collections
 
 import numpy
@@ -32,7 +34,7 @@ except ImportError:
             raise ImportError('Could not import h5py.%s' % name)
     h5py = mock_h5py()
 
-from openquake.baselib.general import CallableDict
+from openquake.baselib.general import CallableDict, humansize
 from openquake.commonlib.writers import write_csv
 
 
@@ -41,6 +43,12 @@ view = CallableDict()
 
 DATADIR = os.environ.get('OQ_DATADIR', os.path.expanduser('~/oqdata'))
 
+# hdf5path -> (modification time, h5py.File), per process
+_read_only = {}
+
+# a range of rows start:stop
+index_dt = numpy.dtype([('start', numpy.uint64), ('stop', numpy.uint64)])
+
 
 def get_nbytes(dset):
     """
@@ -50,9 +58,9 @@ def get_nbytes(dset):
     if 'nbytes' in dset.attrs:
         # look if the dataset has an attribute nbytes
         return dset.attrs['nbytes']
-    elif hasattr(dset, 'value'):
-        # else extract nbytes from the underlying array
-        return dset.value.nbytes
+    elif hasattr(dset, 'shape'):
+        # else compute nbytes from the shape, without reading the array
+        return dset.size * dset.dtype.itemsize
 
 
 class ByteCounter(object):
@@ -86,7 +94,7 @@ def get_calc_ids(datadir=DATADIR):
     if not os.path.exists(datadir):
         return []
     calc_ids = []
-    for f in os.listdir(DATADIR):
+    for f in os.listdir(datadir):
         mo = re.match(r'calc_(\d+)\.hdf5', f)
         if mo:
             calc_ids.append(int(mo.group(1)))
@@ -104,22 +112,404 @@ def get_last_calc_id(datadir):
     return calcs[-1]
 
 
+def cls2dotname(cls):
+    """
+    :param cls: a class
+    :returns: the full name of the class, with the module name in front
+
+    >>> cls2dotname(ByteCounter)
+    'openquake.commonlib.datastore.ByteCounter'
+    """
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def dotname2cls(dotname):
+    """
+    :param dotname: the full name of a class, with the module name in front
+    :returns: the class, possibly imported
+
+    >>> dotname2cls('openquake.commonlib.datastore.ByteCounter')
+    <class 'openquake.commonlib.datastore.ByteCounter'>
+    """
+    if isinstance(dotname, bytes):
+        dotname = dotname.decode('utf8')
+    modname, clsname = dotname.rsplit('.', 1)
+    return getattr(importlib.import_module(modname), clsname)
+
+
+# converters for the classes of other libraries, which cannot implement
+# __toh5__/__fromh5__: class -> (toh5, fromh5)
+h5converters = {}
+
+
+def register_h5(cls, toh5, fromh5):
+    """
+    Store the instances of `cls` natively in the datastore.
+
+    :param cls: a class not implementing the `__toh5__` protocol
+    :param toh5: a function object -> (array or dictionary, attrs)
+    :param fromh5: a module-level function (data, attrs) -> object
+    """
+    h5converters[cls] = (toh5, fromh5)
+
+
+def get_chunk_rows(dtype, expected_rows=None, chunk_nbytes=256 * 1024):
+    """
+    :param dtype: the dtype of the dataset
+    :param expected_rows: the expected number of rows, if known
+    :param chunk_nbytes: the target size of a chunk in bytes
+    :returns: the number of rows in a chunk of the dataset
+
+    >>> get_chunk_rows(numpy.dtype(float))
+    32768
+    >>> get_chunk_rows(numpy.dtype(float), expected_rows=1000)
+    1000
+    """
+    rows = max(chunk_nbytes // numpy.dtype(dtype).itemsize, 1)
+    if expected_rows:
+        rows = min(rows, expected_rows)
+    return int(rows)
+
+
+def build_index(keys, num_keys):
+    """
+    Build an index key -> rows for a dataset with a key for each row.
+
+    :param keys: an array of integers in the range 0 .. num_keys - 1
+    :param num_keys: the number of possible keys
+    :returns: a pair (rows, index); the rows of the key k are
+              rows[index[k]['start']:index[k]['stop']], in increasing order
+
+    >>> rows, index = build_index(numpy.array([2, 0, 2]), 3)
+    >>> rows
+    array([1, 0, 2])
+    >>> [(int(rec['start']), int(rec['stop'])) for rec in index]
+    [(0, 1), (1, 1), (1, 3)]
+    """
+    rows = keys.argsort(kind='mergesort')  # stable, keeps the row order
+    counts = numpy.bincount(keys, minlength=num_keys)
+    index = numpy.zeros(num_keys, index_dt)
+    index['stop'] = counts.cumsum()
+    index['start'] = index['stop'] - counts
+    return rows, index
+
+
+def match_filters(filters, key):
+    """
+    :param filters: a list of pairs (pattern, filter options)
+    :param key: name of a dataset
+    :returns: the options of the first pattern matching the key (or {})
+
+    >>> match_filters([('gmfs/*', {'compression': 'lzf'})], '/gmfs/col00')
+    {'compression': 'lzf'}
+    """
+    key = key.lstrip('/')
+    for pattern, opts in filters:
+        if fnmatch.fnmatch(key, pattern):
+            return dict(opts)
+    return {}
+
+
+class Repacker(object):
+    """
+    A visitor copying the objects of a HDF5 file into another file.
+    Use it as hdf5.visititems(Repacker(dest, filters)). The chunked
+    datasets and the datasets matching the filters are written again,
+    with a chunk size based on their actual length, the others are
+    copied as they are.
+
+    :param dest: the destination h5py.File object
+    :param filters: a list of pairs (pattern, filter options)
+    """
+    block_nbytes = 8 * 1024 * 1024  # bytes copied at each step
+
+    def __init__(self, dest, filters=()):
+        self.dest = dest
+        self.filters = filters
+
+    def __call__(self, name, obj):
+        if not hasattr(obj, 'shape'):  # group
+            self.dest.require_group(name).attrs.update(obj.attrs)
+            return
+        opts = match_filters(self.filters, name)
+        if not obj.shape or not obj.size or not (opts or obj.chunks):
+            # scalar, empty or contiguous dataset: copy it as it is
+            obj.file.copy(obj, self.dest, name)
+            return
+        if len(obj.shape) == 1:
+            opts['chunks'] = (get_chunk_rows(obj.dtype, len(obj)),)
+        else:
+            opts['chunks'] = obj.chunks or True
+        dset = self.dest.create_dataset(
+            name, obj.shape, obj.dtype, maxshape=obj.maxshape, **opts)
+        rownbytes = obj.dtype.itemsize * numpy.prod(obj.shape[1:])
+        rows = max(int(self.block_nbytes // rownbytes), 1)
+        for start in range(0, len(obj), rows):
+            dset[start:start + rows] = obj[start:start + rows]
+        dset.attrs.update(obj.attrs)
+
+
+def repack(hdf5path, filters=()):
+    """
+    Copy the live objects of a closed HDF5 file into a new file which
+    replaces the original one. In this way the space of the deleted and
+    overwritten objects, which is never reused by HDF5, is recovered.
+
+    :param hdf5path: the path of the file
+    :param filters: a list of pairs (pattern, filter options)
+    :returns: the sizes of the file before and after, in bytes
+    """
+    # the cached read-only handle would keep pointing to the old file
+    close_read_only(hdf5path)
+    before = os.path.getsize(hdf5path)
+    tmppath = hdf5path + '.repack'
+    with h5py.File(hdf5path, 'r') as src:
+        with h5py.File(tmppath, 'w', libver='latest') as dest:
+            dest.attrs.update(src.attrs)
+            src.visititems(Repacker(dest, filters))
+    os.rename(tmppath, hdf5path)
+    return before, os.path.getsize(hdf5path)
+
+
+def read_only(hdf5path):
+    """
+    Open a HDF5 file in read-only mode. The file must not be open for
+    writing: HDF5 allows any number of concurrent readers, but not
+    readers concurrent with a writer. The handle is cached in the current
+    process and it is opened again if the file is modified.
+
+    :param hdf5path: the path of the file
+    :returns: a h5py.File object
+    """
+    mtime = os.path.getmtime(hdf5path)
+    try:
+        cached_mtime, hdf5 = _read_only[hdf5path]
+    except KeyError:
+        pass
+    else:
+        if cached_mtime == mtime:
+            return hdf5
+        hdf5.close()
+    hdf5 = h5py.File(hdf5path, 'r')
+    _read_only[hdf5path] = mtime, hdf5
+    return hdf5
+
+
+def close_read_only(hdf5path):
+    """
+    Close the read-only handle to the given file cached in the current
+    process by :func:`read_only`, if any.
+
+    :param hdf5path: the path of the file
+    """
+    try:
+        _mtime, hdf5 = _read_only.pop(hdf5path)
+    except KeyError:
+        return
+    hdf5.close()
+
+
+class DatasetRef(object):
+    """
+    A reference to a dataset in a file not open for writing, to be sent
+    to the workers in place of the data. The workers read only the
+    slices they need with `ref[start:stop]`, through a read-only handle.
+
+    :param hdf5path: the path of the file
+    :param key: the name of the dataset
+    """
+    def __init__(self, hdf5path, key):
+        self.hdf5path = hdf5path
+        self.key = key
+
+    @classmethod
+    def from_dset(cls, dset):
+        """
+        :param dset: a h5py.Dataset object
+        :returns: a reference to it
+        """
+        return cls(dset.file.filename, dset.name)
+
+    @property
+    def dset(self):
+        """The underlying h5py.Dataset, opened in read-only mode"""
+        return read_only(self.hdf5path)[self.key]
+
+    @property
+    def dtype(self):
+        return self.dset.dtype
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+    def __getitem__(self, idx):
+        return self.dset[idx]
+
+    def __len__(self):
+        return len(self.dset)
+
+    def __repr__(self):
+        return '<%s %s:%s>' % (self.__class__.__name__, self.hdf5path,
+                               self.key)
+
+
+class LazyArray(object):
+    """
+    A read-only view over a HDF5 dataset (or a DatasetRef) which reads
+    nothing until it is iterated on. Selecting fields or rows returns
+    a new view; the data are read in blocks of about `block_nbytes` bytes,
+    so that datasets larger than the memory can be processed a piece at
+    the time, for instance with
+
+        for block in LazyArray(dset)[['idx', 'PGA']][1000:].blocks():
+            ...
+
+    :param dset: a h5py.Dataset or DatasetRef object
+    :param fields: None, a field name or a tuple of field names
+    :param start: the first row of the view
+    :param stop: the row after the last one (None for the end of dataset)
+    :param rowshape: the shape of the rows (None for the original shape)
+    """
+    block_nbytes = 8 * 1024 * 1024  # bytes read at each step
+
+    def __init__(self, dset, fields=None, start=0, stop=None, rowshape=None):
+        self.dset = dset
+        self.fields = fields
+        self.start = start
+        self.stop = len(dset) if stop is None else stop
+        self.rowshape = rowshape
+
+    @property
+    def dtype(self):
+        """The dtype of the selected fields"""
+        dt = self.dset.dtype
+        if self.fields is None:
+            return dt
+        elif isinstance(self.fields, tuple):
+            return numpy.dtype([(f, dt.fields[f][0]) for f in self.fields])
+        return dt.fields[self.fields][0]
+
+    @property
+    def shape(self):
+        rowshape = self.dset.shape[1:] if self.rowshape is None \
+            else self.rowshape
+        return (len(self),) + tuple(rowshape)
+
+    def reshape(self, shape):
+        """
+        :param shape: the new shape, with the same number of rows
+        :returns: a view returning blocks with the given shape
+        """
+        if shape[0] != len(self):
+            raise ValueError('Cannot reshape %s into %s' % (self, shape))
+        return self.__class__(self.dset, self.fields, self.start, self.stop,
+                              tuple(shape[1:]))
+
+    def slices(self, nbytes=None):
+        """
+        :param nbytes: the size of a block in bytes (default block_nbytes)
+        :yields: slices of the view, each one of about `nbytes` bytes
+        """
+        rownbytes = self.dset.dtype.itemsize * numpy.prod(self.dset.shape[1:])
+        rows = max(int((nbytes or self.block_nbytes) // rownbytes), 1)
+        for start in range(0, len(self), rows):
+            yield slice(start, min(start + rows, len(self)))
+
+    def blocks(self, nbytes=None):
+        """
+        :param nbytes: the size of a block in bytes (default block_nbytes)
+        :yields: the view as numpy arrays of about `nbytes` bytes each
+        """
+        for slc in self.slices(nbytes):
+            yield self._read(self.start + slc.start, self.start + slc.stop)
+
+    def read(self):
+        """
+        :returns: the full view as a numpy array
+        """
+        return self._read(self.start, self.stop)
+
+    def _read(self, start, stop):
+        if self.fields is None:
+            array = self.dset[start:stop]
+        elif isinstance(self.fields, tuple):
+            array = self.dset[self.fields + (slice(start, stop),)]
+            if array.dtype.names is None:  # h5py strips a single field
+                record = numpy.zeros(
+                    (stop - start,) + self.dset.shape[1:], self.dtype)
+                record[self.fields[0]] = array
+                array = record
+        else:
+            array = self.dset[self.fields, start:stop]
+        if self.rowshape is not None:
+            array = array.reshape((len(array),) + self.rowshape)
+        return array
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (str, unicode)):
+            return self.__class__(self.dset, str(idx), self.start, self.stop)
+        elif isinstance(idx, list):
+            fields = tuple(str(f) for f in idx)
+            return self.__class__(self.dset, fields, self.start, self.stop)
+        elif isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError('Only slices with step 1 are supported')
+            return self.__class__(
+                self.dset, self.fields, self.start + start,
+                self.start + max(start, stop), self.rowshape)
+        # else an integer
+        n = len(self)
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError('index %d is out of bounds for %s' % (idx, self))
+        return self._read(self.start + idx, self.start + idx + 1)[0]
+
+    def __iter__(self):
+        for block in self.blocks():
+            for row in block:
+                yield row
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __repr__(self):
+        return '<%s %s[%d:%d]%s>' % (
+            self.__class__.__name__, getattr(self.dset, 'name', self.dset),
+            self.start, self.stop,
+            '' if self.fields is None else '[%r]' % (self.fields,))
+
+
 class Hdf5Dataset(object):
     """
-    Little wrapper around a one-dimensional HDF5 dataset.
+    Little wrapper around a one-dimensional HDF5 dataset. The arrays
+    passed to `.extend` are kept in a buffer and written when the buffer
+    exceeds `.flush_threshold` bytes, so that the dataset is resized
+    only a few times.
 
     :param hdf5: a h5py.File object
     :param key: an hdf5 key string
     :param dtype: dtype of the dataset (usually composite)
     :param shape: shape of the dataset (if None, the dataset is extendable)
+    :param expected_rows: used to determine the chunk size
+    :param filters: h5py filter options (compression, shuffle, ...)
     """
-    def __init__(self, hdf5, key, dtype, shape):
+    flush_threshold = 1024 * 1024  # bytes
+
+    def __init__(self, hdf5, key, dtype, shape, expected_rows=None,
+                 **filters):
         self.hdf5 = hdf5
         self.key = key
         self.dtype = dtype
+        self._buffer = []
+        self._buffered = 0  # number of bytes in the buffer
         if shape is None:  # extendable dataset
+            chunks = (get_chunk_rows(dtype, expected_rows),)
             self.dset = self.hdf5.create_dataset(
-                key, (0,), dtype, chunks=True, maxshape=(None,))
+                key, (0,), dtype, chunks=chunks, maxshape=(None,),
+                **filters)
             self.size = 0
             self.dset.attrs['nbytes'] = 0
         else:  # fixed-shape dataset
@@ -128,7 +518,9 @@ class Hdf5Dataset(object):
             else:  # integer shape
                 n = shape
                 shape = (n,)
-            self.dset = self.hdf5.create_dataset(key, shape, dtype)
+            if not n:  # empty datasets cannot be chunked
+                filters = {}
+            self.dset = self.hdf5.create_dataset(key, shape, dtype, **filters)
             self.size = n
             self.dset.attrs['nbytes'] = n * numpy.zeros(1, dtype).nbytes
         self.attrs = self.dset.attrs
@@ -139,11 +531,29 @@ class Hdf5Dataset(object):
         the expected dtype. This method will give an error if used
         with a fixed-shape dataset.
         """
+        self._buffer.append(array)
+        self._buffered += array.nbytes
+        if self._buffered >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered arrays in the dataset
+        """
+        if not self._buffer:
+            return
+        array = numpy.concatenate(self._buffer)
         newsize = self.size + len(array)
         self.dset.resize((newsize,))
         self.dset[self.size:newsize] = array
         self.size = newsize
         self.dset.attrs['nbytes'] += array.nbytes
+        self._buffer = []
+        self._buffered = 0
+
+    def __len__(self):
+        # the number of rows, including the buffered ones
+        return self.size + sum(len(array) for array in self._buffer)
 
 
 class DataStore(collections.MutableMapping):
@@ -161,9 +571,27 @@ class DataStore(collections.MutableMapping):
 
     When reading the items, the DataStore will return a generator. The
     items will be ordered lexicographically according to their name.
+
+    Objects with a method `__toh5__` are stored natively and not pickled.
+    The method must return a pair (obj, attrs) where `obj` is an array or
+    a dictionary name -> value, stored as a dataset or as a group, and
+    `attrs` is a dictionary of attributes. When reading, the class is
+    instantiated without calling `__init__` and its method `__fromh5__`
+    is called with the dataset (or a dictionary name -> value, for groups)
+    and the attributes. Since the arrays are not read, the object can
+    read them lazily and other tools can read them with any HDF5 library.
+    The classes of other libraries can be stored in the same way by
+    registering a pair of functions with :func:`register_h5`.
+
+    The datasets can be compressed by setting `.filters` to a list of
+    pairs (pattern, filter options), see
+    :func:`openquake.commonlib.valid.hdf5_filters`: the options of the
+    first pattern matching the name of the dataset are used.
     """
+    filters = []  # pairs (pattern, filter options)
+
     def __init__(self, calc_id=None, datadir=DATADIR, parent=(),
-                 export_dir='.', params=()):
+                 export_dir='.', params=(), mode=None):
         if not os.path.exists(datadir):
             os.makedirs(datadir)
         if calc_id is None:  # use a new datastore
@@ -182,15 +610,18 @@ class DataStore(collections.MutableMapping):
         self.calc_dir = os.path.join(datadir, 'calc_%s' % self.calc_id)
         self.export_dir = export_dir
         self.hdf5path = self.calc_dir + '.hdf5'
-        mode = 'r+' if os.path.exists(self.hdf5path) else 'w'
-        self.hdf5 = h5py.File(self.hdf5path, mode, libver='latest')
+        self.mode = mode or ('r+' if os.path.exists(self.hdf5path) else 'w')
+        self.hdf5 = h5py.File(self.hdf5path, self.mode, libver='latest')
+        self.dsets = []  # extendable datasets, see create_dset
+        self.snapshots = []  # files removed on close, see snapshot
+        self.cache = AttributeCache()  # used by persistent_attribute
         self.attrs = self.hdf5.attrs
         for name, value in params:
             self.attrs[name] = value
         if not parent and 'hazard_calculation_id' in self.attrs:
             parent_id = ast.literal_eval(self.attrs['hazard_calculation_id'])
             if parent_id:
-                self.parent = self.__class__(parent_id)
+                self.parent = self.__class__(parent_id, mode='r')
 
     def set_parent(self, parent):
         """
@@ -203,15 +634,74 @@ class DataStore(collections.MutableMapping):
             if name not in self.attrs:  # add missing parameter
                 self.attrs[name] = value
 
-    def create_dset(self, key, dtype, size=None):
+    def get_filters(self, key):
+        """
+        :param key: name of a dataset
+        :returns: the filter options associated to the dataset
+        """
+        return match_filters(self.filters, key)
+
+    def create_dset(self, key, dtype, size=None, expected_rows=None,
+                    **filters):
         """
         Create a one-dimensional HDF5 dataset.
 
         :param key: name of the dataset
         :param dtype: dtype of the dataset (usually composite)
         :param size: size of the dataset (if None, the dataset is extendable)
+        :param expected_rows: expected size of an extendable dataset
+        :param filters: filter options overriding the ones in .filters
+        """
+        opts = self.get_filters(key)
+        opts.update(filters)
+        dset = Hdf5Dataset(self.hdf5, key, dtype, size, expected_rows, **opts)
+        if size is None:
+            self.dsets.append(dset)
+        return dset
+
+    def flush(self):
+        """
+        Write the buffers of the extendable datasets and flush the file
+        """
+        for dset in self.dsets:
+            dset.flush()
+        self.hdf5.flush()
+
+    def snapshot(self, *keys):
         """
-        return Hdf5Dataset(self.hdf5, key, dtype, size)
+        Copy the given datasets in the file calc_XXX_snapshot.hdf5, which
+        is not open for writing, so that the workers can read them with
+        :class:`DatasetRef` objects while the datastore is written.
+        The file is removed when the datastore is closed.
+
+        :param keys: the names of the datasets to copy
+        :returns: the path of the snapshot file
+        """
+        self.flush()
+        path = self.calc_dir + '_snapshot.hdf5'
+        with h5py.File(path, 'w') as dest:
+            for key in keys:
+                self.hdf5.copy(key, dest, name=key)
+        if path not in self.snapshots:
+            self.snapshots.append(path)
+        return path
+
+    def repack(self):
+        """
+        Repack the underlying file by applying the .filters; the file is
+        closed and reopened, so the h5py objects read before are invalid.
+        There must be no other handles open for writing on the file.
+
+        :returns: the sizes of the file before and after, in bytes
+        """
+        self.flush()
+        self.hdf5.close()
+        try:
+            return repack(self.hdf5path, self.filters)
+        finally:
+            self.hdf5 = h5py.File(self.hdf5path, 'r+', libver='latest')
+            self.attrs = self.hdf5.attrs
+            self.dsets = []
 
     def export_path(self, relname, export_dir=None):
         """
@@ -237,15 +727,23 @@ class DataStore(collections.MutableMapping):
     def reopen(self):
         """Reopen a closed datastore"""
         parent = () if self.parent is () else self.parent.reopen()
-        return self.__class__(self.calc_id, self.datadir, parent,
-                              self.export_dir)
+        new = self.__class__(self.calc_id, self.datadir, parent,
+                             self.export_dir,
+                             mode='r' if self.mode == 'r' else None)
+        new.filters = self.filters
+        return new
 
     def close(self):
         """Close the underlying hdf5 file"""
         if self.parent:
             self.parent.close()
         if self.hdf5:  # is open
+            self.flush()
             self.hdf5.close()
+        for path in self.snapshots:
+            if os.path.exists(path):
+                os.remove(path)
+        del self.snapshots[:]
 
     def clear(self):
         """Remove the datastore from the file system"""
@@ -271,6 +769,8 @@ class DataStore(collections.MutableMapping):
             return default
 
     def __getitem__(self, key):
+        for dset in self.dsets:  # make sure the buffers are written
+            dset.flush()
         try:
             val = self.hdf5[key]
         except KeyError:
@@ -282,6 +782,8 @@ class DataStore(collections.MutableMapping):
                         'No %r found in %s' % (key, [self, self.parent]))
             else:
                 raise KeyError('No %r found in %s' % (key, self))
+        if '__pyclass__' in val.attrs or '__pyfunc__' in val.attrs:
+            return self._fromh5(val)
         try:
             shape = val.shape
         except AttributeError:  # val is a group
@@ -290,7 +792,36 @@ class DataStore(collections.MutableMapping):
             val = pickle.loads(val.value)
         return val
 
-    def __setitem__(self, key, value):
+    def set(self, key, value, **filters):
+        """
+        Store a value in the datastore. Arrays are compressed according
+        to the given filter options, or to the ones in .filters; other
+        objects are pickled and stored uncompressed.
+
+        :param key: name of the dataset
+        :param value: an array or a pickleable object
+        :param filters: filter options overriding the ones in .filters
+        """
+        conv = h5converters.get(value.__class__)
+        if conv or hasattr(value, '__toh5__'):
+            if conv:
+                obj, attrs = conv[0](value)
+                pyname = '__pyfunc__', cls2dotname(conv[1])
+            else:
+                obj, attrs = value.__toh5__()
+                pyname = '__pyclass__', cls2dotname(value.__class__)
+            if isinstance(obj, dict):  # store a group
+                if key in self.hdf5:
+                    del self[key]
+                for name, val in obj.items():
+                    self.set('%s/%s' % (key, name), val, **filters)
+            else:  # store a dataset
+                self.set(key, obj, **filters)
+            h5attrs = self.hdf5[key].attrs
+            h5attrs[pyname[0]] = pyname[1]
+            for name, val in attrs.items():
+                h5attrs[name] = val
+            return
         if (not isinstance(value, numpy.ndarray) or
                 value.dtype is numpy.dtype(object)):
             val = numpy.array(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
@@ -301,12 +832,34 @@ class DataStore(collections.MutableMapping):
             # arrays: is impossible to save twice the same key; so we remove
             # the key first, then it is possible to save it again
             del self[key]
+        opts = self.get_filters(key)
+        opts.update(filters)
         try:
-            self.hdf5[key] = val
+            if opts and val.size and val.shape:  # can be chunked
+                self.hdf5.create_dataset(key, data=val, **opts)
+            else:
+                self.hdf5[key] = val
         except RuntimeError as exc:
             raise RuntimeError('Could not save %s: %s in %s' %
                                (key, exc, self.hdf5path))
 
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def _fromh5(self, h5obj):
+        # build an object stored with __toh5__ or with a registered converter
+        attrs = dict(h5obj.attrs)
+        if hasattr(h5obj, 'shape'):  # dataset
+            data = h5obj
+        else:  # group
+            data = {name: self[h5obj.name + '/' + name] for name in h5obj}
+        if '__pyfunc__' in attrs:
+            return dotname2cls(attrs.pop('__pyfunc__'))(data, attrs)
+        cls = dotname2cls(attrs.pop('__pyclass__'))
+        obj = cls.__new__(cls)
+        obj.__fromh5__(data, attrs)
+        return obj
+
     def __delitem__(self, key):
         if (h5py.version.version <= '2.0.1' and not
                 hasattr(self.hdf5[key], 'shape')):
@@ -337,6 +890,87 @@ class Fake(dict):
         self.update(kwargs)
 
 
+class AttributeCache(object):
+    """
+    A LRU cache for the persistent attributes of a datastore. When the
+    size of the cached values exceeds `maxbytes`, the least recently used
+    values are evicted and they will be read again from the datastore at
+    the next access. The size of a value is the size of the array or of
+    the underlying object in the datastore; h5py datasets, which are
+    read lazily, count zero.
+
+    :param maxbytes: the budget in bytes (0 means no limit)
+    """
+    def __init__(self, maxbytes=0):
+        self.maxbytes = maxbytes
+        self.values = collections.OrderedDict()  # key -> (value, nbytes)
+        self.nbytes = 0
+        self.max_nbytes = 0  # the peak size of the cache
+
+    def get(self, key):
+        """
+        :returns: the cached value, or raise a KeyError
+        """
+        value, nbytes = self.values.pop(key)
+        self.values[key] = value, nbytes  # now the most recently used
+        return value
+
+    def set(self, key, value, nbytes):
+        """
+        Cache the value and evict the least recently used values if the
+        budget is exceeded; the new value is never evicted.
+        """
+        self.release(key)
+        self.values[key] = value, nbytes
+        self.nbytes += nbytes
+        self.max_nbytes = max(self.max_nbytes, self.nbytes)
+        while (self.maxbytes and self.nbytes > self.maxbytes and
+               len(self.values) > 1):
+            _, (_, evicted) = self.values.popitem(last=False)
+            self.nbytes -= evicted
+
+    def release(self, *keys):
+        """
+        Remove the given keys from the cache, if present
+        """
+        for key in keys:
+            try:
+                _, nbytes = self.values.pop(key)
+            except KeyError:
+                continue
+            self.nbytes -= nbytes
+
+    def __repr__(self):
+        return '<%s %s, %d value(s)>' % (
+            self.__class__.__name__, humansize(self.nbytes), len(self.values))
+
+
+def get_cache(dstore):
+    """
+    :param dstore: a DataStore or any dict-like object
+    :returns: the AttributeCache of the datastore, added if missing
+    """
+    try:
+        return dstore.cache
+    except AttributeError:
+        dstore.cache = AttributeCache()
+        return dstore.cache
+
+
+def get_value_nbytes(dstore, key, value):
+    """
+    :returns: the number of bytes used by a value of the datastore
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif hasattr(value, 'shape'):  # h5py dataset, not read
+        return 0
+    try:
+        return dstore.getsize(key)
+    except (AttributeError, KeyError):  # not a DataStore or a parent key
+        return 0
+
+
 def persistent_attribute(key):
     """
     Persistent attributes are persisted to the datastore and cached.
@@ -362,27 +996,29 @@ def persistent_attribute(key):
     >>> store.a.append(2)
     >>> store.a = store.a  # remember to store the modified attribute!
 
+    The values are kept in the :class:`AttributeCache` of the datastore,
+    so they can be evicted and read again: do not rely on modifications
+    of mutable objects which have not been stored.
+
     :param key: the name of the attribute to be made persistent
     :returns: a property to be added to a class with a .datastore attribute
     """
-    privatekey = '_' + key
-
     def getter(self):
-        # Try to get the value from the privatekey attribute (i.e. from
-        # the cache of the datastore); if not possible, get the value
-        # from the datastore and set the cache; if not possible, get the
-        # value from the parent and set the cache. If the value cannot
-        # be retrieved, raise an AttributeError.
+        # Try to get the value from the cache of the datastore; if not
+        # possible, get the value from the datastore (or from the parent)
+        # and set the cache.
+        cache = get_cache(self.datastore)
         try:
-            return getattr(self.datastore, privatekey)
-        except AttributeError:
+            return cache.get(key)
+        except KeyError:
             value = self.datastore[key]
-            setattr(self.datastore, privatekey, value)
+            cache.set(key, value, get_value_nbytes(self.datastore, key, value))
             return value
 
     def setter(self, value):
-        # Update the datastore and the private key
+        # Update the datastore and the cache
         self.datastore[key] = value
-        setattr(self.datastore, privatekey, value)
+        get_cache(self.datastore).set(
+            key, value, get_value_nbytes(self.datastore, key, value))
 
     return property(getter, setter)
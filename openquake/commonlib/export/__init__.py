@@ -18,6 +18,7 @@
 
 from openquake.baselib.general import import_all, CallableDict
 from openquake.commonlib.writers import write_csv
+from openquake.commonlib.datastore import LazyArray
 
 
 def export_csv(ekey, dstore):
@@ -29,11 +30,11 @@ def export_csv(ekey, dstore):
     :returns: a list with the path of the exported file
     """
     name = ekey[0] + '.csv'
-    try:
-        array = dstore[ekey[0]].value
-    except AttributeError:
+    dset = dstore[ekey[0]]
+    if not hasattr(dset, 'shape'):
         # this happens if the key correspond to a HDF5 group
         return []  # write a custom exporter in this case
+    array = LazyArray(dset)  # read in blocks while writing
     if len(array.shape) == 1:  # vector
         array = array.reshape((len(array), 1))
     return [write_csv(dstore.export_path(name), array)]
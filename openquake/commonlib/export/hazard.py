@@ -31,6 +31,7 @@ from openquake.commonlib.oqvalidation import OqParam
 from openquake.commonlib.writers import (
     scientificformat, floatformat, write_csv)
 from openquake.commonlib import hazard_writers
+from openquake.commonlib.logictree import get_gmf_index
 
 GMF_MAX_SIZE = 10 * 1024 * 1024  # 10 MB
 GMF_WARNING = '''\
@@ -454,9 +455,10 @@ def export_gmf(ekey, dstore):
     logging.info('Internal size of the GMFs: %s', humansize(nbytes))
     if nbytes > GMF_MAX_SIZE:
         logging.warn(GMF_WARNING, dstore.hdf5path)
+    gmf_index = get_gmf_index(dstore)
     fnames = []
-    for rlz, gmf_by_idx in zip(
-            rlzs_assoc.realizations, rlzs_assoc.combine_gmfs(gmfs)):
+    for rlz, gmf_by_idx in zip(rlzs_assoc.realizations,
+                               rlzs_assoc.combine_gmfs(gmfs, gmf_index)):
         tags = all_tags[list(gmf_by_idx)]
         gmfs = list(gmf_by_idx.values())
         if not gmfs:
@@ -349,9 +349,10 @@ def export_damage_total(ekey, dstore):
 def export_csq_csv(ekey, dstore):
     rlzs = dstore['rlzs_assoc'].realizations
     R = len(rlzs)
-    value = dstore[ekey[0]].value  # matrix N x R or T x R
+    dset = dstore[ekey[0]]  # matrix N x R or T x R
     fnames = []
-    for rlz, values in zip(rlzs, value.T):
+    for rlz in rlzs:
+        values = dset[:, rlz.ordinal]  # read one column at the time
         suffix = '.csv' if R == 1 else '-gsimltp_%s.csv' % rlz.uid
         fname = dstore.export_path(ekey[0] + suffix)
         writers.write_csv(fname, values)
@@ -363,12 +364,13 @@ def export_csq_csv(ekey, dstore):
 def export_csq_total_csv(ekey, dstore):
     rlzs = dstore['rlzs_assoc'].realizations
     R = len(rlzs)
-    value = dstore[ekey[0]].value
+    dset = dstore[ekey[0]]
     fnames = []
-    for rlz, values in zip(rlzs, value):
+    for rlz in rlzs:
+        values = dset[rlz.ordinal:rlz.ordinal + 1]  # read one row at the time
         suffix = '.csv' if R == 1 else '-gsimltp_%s.csv' % rlz.uid
         fname = dstore.export_path(ekey[0] + suffix)
-        writers.write_csv(fname, numpy.array([values], value.dtype))
+        writers.write_csv(fname, values)
         fnames.append(fname)
     return fnames
 
@@ -39,7 +39,7 @@ import numpy
 
 from openquake.baselib.general import groupby
 from openquake.baselib.python3compat import raise_
-from openquake.commonlib import nrml, valid
+from openquake.commonlib import nrml, valid, datastore
 from openquake.commonlib.node import node_from_xml, parse, iterparse
 
 import openquake.hazardlib
@@ -73,20 +73,14 @@ class RlzsAssoc(collections.Mapping):
         """
         return {self.rlzs_assoc[key][0]: result[key] for key in result}
 
-    def combine_gmfs(self, gmfs):  # this is used in the export
+    def combine_gmfs(self, gmfs, gmf_index):  # this is used in the export
         """
         :param gmfs: datastore /gmfs object
-        :returns: a list of dictionaries rupid -> gmf array
+        :param gmf_index: the event index of the GMFs
+        :yields: a dictionary rupid -> gmf array for each realization
         """
-        gmfs_by_rupid = groupby(
-            gmfs['col00'].value, lambda row: row['idx'], list)
-        dicts = [{} for rlz in self.realizations]
         for rlz in self.realizations:
-            gs = str(rlz)
-            for rupid, rows in gmfs_by_rupid.items():
-                dicts[rlz.ordinal][rupid] = numpy.array(
-                    [r[gs] for r in rows], rows[0][gs].dtype)
-        return dicts
+            yield get_gmvs_by_rupid(gmfs['col00'], str(rlz), gmf_index)
 
     def __iter__(self):
         return iter(self.rlzs_assoc.keys())
@@ -106,6 +100,110 @@ class RlzsAssoc(collections.Mapping):
                                  '\n'.join('%s: %s' % pair for pair in pairs))
 
 
+# the GMFs of the event `idx` are the rows gmfs/colXX[start:stop], XX=col_id
+gmf_index_dt = numpy.dtype([('col_id', numpy.uint16), ('start', numpy.uint64),
+                            ('stop', numpy.uint64)])
+
+
+def update_gmf_index(index, col_id, idxs, offset=0):
+    """
+    Register in the event index the rows of a block of GMFs, in which
+    the rows of each event are contiguous.
+
+    :param index: an array of dtype gmf_index_dt with a record per event
+    :param col_id: the collection of the block
+    :param idxs: the 'idx' column of the block
+    :param offset: the position of the block in the dataset gmfs/colXX
+
+    >>> index = numpy.zeros(4, gmf_index_dt)
+    >>> update_gmf_index(index, 1, numpy.array([3, 3, 0]))
+    >>> update_gmf_index(index, 1, numpy.array([0, 2]), offset=3)
+    >>> [(int(r['start']), int(r['stop'])) for r in index]
+    [(2, 4), (0, 0), (4, 5), (0, 2)]
+    """
+    if len(idxs) == 0:
+        return
+    starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(idxs)) + 1])
+    stops = numpy.concatenate([starts[1:], [len(idxs)]])
+    events = idxs[starts]
+    # an event can span two blocks: keep the start of the first one
+    new = index['start'][events] == index['stop'][events]
+    index['start'][events[new]] = starts[new] + offset
+    index['stop'][events] = stops + offset
+    index['col_id'][events] = col_id
+
+
+def get_gmf_index(dstore):
+    """
+    :param dstore: a datastore containing GMFs
+    :returns: the event index stored by the hazard calculator, as an array
+              of dtype gmf_index_dt with a record per event; the events
+              without GMFs have start == stop
+
+    If there is no index, as for old calculations, it is built by
+    scanning the 'idx' column of the GMFs.
+    """
+    try:
+        return dstore['gmf_index'].value
+    except KeyError:
+        pass
+    index = numpy.zeros(len(dstore['tags']), gmf_index_dt)
+    for key in dstore['gmfs']:
+        offset = 0
+        dset = dstore['gmfs/' + key]
+        for idxs in datastore.LazyArray(dset)['idx'].blocks():
+            update_gmf_index(index, int(key[3:]), idxs, offset)
+            offset += len(idxs)
+    return index
+
+
+def get_gmvs_by_rupid(dataset, gsim, index, col_id=0):
+    """
+    :param dataset: the GMF dataset of the collection `col_id`
+    :param gsim: the name of a GSIM
+    :param index: the event index, as returned by :func:`get_gmf_index`
+    :param col_id: the collection ID
+    :returns: a dictionary rupid -> array of ground motion values
+
+    Only the field `gsim` is read, by reading together the rows of
+    contiguous events up to a block of `LazyArray.block_nbytes` bytes.
+    """
+    ok = (index['col_id'] == col_id) & (index['stop'] > index['start'])
+    events = numpy.flatnonzero(ok)
+    events = events[index['start'][events].argsort()]
+    starts = index['start'][events].astype(int)
+    stops = index['stop'][events].astype(int)
+    gmvs = datastore.LazyArray(dataset)[gsim]
+    max_rows = max(gmvs.block_nbytes // dataset.dtype.itemsize, 1)
+    gmvs_by_rupid = {}
+    i = 0
+    while i < len(events):
+        j = i + 1
+        while j < len(events) and stops[j] - starts[i] <= max_rows:
+            j += 1
+        block = gmvs[starts[i]:stops[j - 1]].read()
+        for rupid, start, stop in zip(events[i:j], starts[i:j], stops[i:j]):
+            gmvs_by_rupid[rupid] = block[start - starts[i]:stop - starts[i]]
+        i = j
+    return gmvs_by_rupid
+
+
+def get_site_gmfs(dstore, col_id, sid):
+    """
+    :param dstore: a datastore containing GMFs stored with gmfs_by_site
+    :param col_id: the collection ID
+    :param sid: a site index
+    :returns: the GMF rows of the given site, one per event
+    """
+    group = dstore['gmfs_by_site/col%02d' % col_id]
+    rec = group['index'][sid]
+    rows = group['rows'][int(rec['start']):int(rec['stop'])]
+    dset = dstore['gmfs/col%02d' % col_id]
+    if len(rows) == 0:
+        return dset[0:0]
+    return dset[rows]  # the rows are in increasing order
+
+
 def get_effective_rlzs(rlzs):
     """
     Group together realizations with the same unique identifier (uid)
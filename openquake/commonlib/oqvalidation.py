@@ -17,13 +17,14 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 import logging
 import collections
 import numpy
 
 from openquake.commonlib import valid, parallel, logictree
 from openquake.commonlib.riskmodels import (
-    get_imtls, get_risk_files, get_risk_models)
+    LOSS_TYPE_KEY, get_imtls, get_risk_files, get_risk_models)
 
 GROUND_MOTION_CORRELATION_MODELS = ['JB2009']
 
@@ -37,6 +38,20 @@ RISK_CALCULATORS = [
 
 CALCULATORS = HAZARD_CALCULATORS + RISK_CALCULATORS
 
+# parameters which do not affect the hazard outputs, ignored when
+# looking for a previous calculation with the same hazard
+NON_HAZARD_PARAMS = set('''
+adaptive_chunks asset_correlation asset_hazard_distance asset_life_expectancy
+attribute_cache_mb base_path calculation_mode concurrent_tasks
+conditional_loss_poes continuous_fragility_discretization description
+distribute epsilon_sampling export_dir export_multi_curves exports
+gmfs_by_site hazard_calculation_id hazard_imtls hazard_output_id
+hdf5_filters ignore_missing_costs inputs insured_losses interest_rate
+learned_weights loss_curve_resolution loss_ratios lrem_steps_per_interval
+max_tasks_per_worker max_worker_rss_growth quantile_loss_curves repack
+reuse_hazard risk_imtls risk_investigation_time specific_assets
+steps_per_interval taxonomies_from_model time_event'''.split())
+
 # this global dictionary is populated with the risk model every time
 # an OqParam instance is created (i.e. once per calculation);
 # this is a suboptimal design but it is the best we can do without
@@ -53,10 +68,12 @@ class OqParam(valid.ParamSet):
         z2pt5='reference_depth_to_2pt5km_per_sec',
         backarc='reference_backarc',
     )
+    adaptive_chunks = valid.Param(valid.boolean, False)
     area_source_discretization = valid.Param(
         valid.NoneOr(valid.positivefloat), None)
     asset_correlation = valid.Param(valid.NoneOr(valid.FloatRange(0, 1)), 0)
     asset_life_expectancy = valid.Param(valid.positivefloat)
+    attribute_cache_mb = valid.Param(valid.NoneOr(valid.positivefloat), None)
     base_path = valid.Param(valid.utf8, '.')
     calculation_mode = valid.Param(valid.Choice(*CALCULATORS), '')
     coordinate_bin_width = valid.Param(valid.positivefloat)
@@ -67,11 +84,14 @@ class OqParam(valid.ParamSet):
     continuous_fragility_discretization = valid.Param(valid.positiveint, 20)
     description = valid.Param(valid.utf8_not_empty)
     distance_bin_width = valid.Param(valid.positivefloat)
+    distribute = valid.Param(
+        valid.NoneOr(valid.Choice(*parallel.DISTRIBUTE)), None)
     mag_bin_width = valid.Param(valid.positivefloat)
     epsilon_sampling = valid.Param(valid.positiveint, 1000)
     export_dir = valid.Param(valid.utf8, None)
     export_multi_curves = valid.Param(valid.boolean, False)
     exports = valid.Param(valid.export_formats, ())
+    gmfs_by_site = valid.Param(valid.boolean, False)
     ground_motion_correlation_model = valid.Param(
         valid.NoneOr(valid.Choice(*GROUND_MOTION_CORRELATION_MODELS)), None)
     ground_motion_correlation_params = valid.Param(valid.dictionary)
@@ -81,6 +101,7 @@ class OqParam(valid.ParamSet):
     hazard_curves_from_gmfs = valid.Param(valid.boolean, False)
     hazard_output_id = valid.Param(valid.NoneOr(valid.positiveint))
     hazard_maps = valid.Param(valid.boolean, False)
+    hdf5_filters = valid.Param(valid.hdf5_filters, [])
     hypocenter = valid.Param(valid.point3d)
     ignore_missing_costs = valid.Param(valid.namelist, [])
     individual_curves = valid.Param(valid.boolean, True)
@@ -92,11 +113,15 @@ class OqParam(valid.ParamSet):
     # hazard_imtls = valid.Param(valid.intensity_measure_types_and_levels, {})
     interest_rate = valid.Param(valid.positivefloat)
     investigation_time = valid.Param(valid.positivefloat, None)
+    learned_weights = valid.Param(valid.boolean, False)
     loss_curve_resolution = valid.Param(valid.positiveint, 50)
     loss_ratios = valid.Param(valid.loss_ratios, ())
     lrem_steps_per_interval = valid.Param(valid.positiveint, 0)
     steps_per_interval = valid.Param(valid.positiveint, 0)
     master_seed = valid.Param(valid.positiveint, 0)
+    max_tasks_per_worker = valid.Param(valid.NoneOr(valid.positiveint), None)
+    max_worker_rss_growth = valid.Param(
+        valid.NoneOr(valid.positivefloat), None)  # MB
     maximum_distance = valid.Param(valid.positivefloat)  # km
     asset_hazard_distance = valid.Param(valid.positivefloat, 5)  # km
     maximum_tile_weight = valid.Param(valid.positivefloat)
@@ -121,6 +146,8 @@ class OqParam(valid.ParamSet):
     region = valid.Param(valid.coordinates, None)
     region_constraint = valid.Param(valid.wkt_polygon, None)
     region_grid_spacing = valid.Param(valid.positivefloat, None)
+    repack = valid.Param(valid.boolean, False)
+    reuse_hazard = valid.Param(valid.boolean, False)
     risk_imtls = valid.Param(valid.intensity_measure_types_and_levels, {})
     risk_investigation_time = valid.Param(valid.positivefloat, None)
     rupture_mesh_spacing = valid.Param(valid.positivefloat, None)
@@ -235,6 +262,38 @@ class OqParam(valid.ParamSet):
         """
         return sorted(get_risk_files(self.inputs)[1])
 
+    def hazard_fingerprint(self, calculation_mode):
+        """
+        Return a SHA1 digest of the parameters and of the input files
+        determining the hazard computed by the given hazard calculator;
+        the risk parameters and the risk model files are ignored, except
+        for the intensity measure types and levels.
+
+        :param calculation_mode: the name of a hazard calculator
+        """
+        sha1 = hashlib.sha1(calculation_mode.encode('utf8'))
+        # the parameters set in the job.ini and the ones with a default,
+        # so that setting a parameter to its default does not matter
+        names = set(vars(self)).union(
+            name for name, val in vars(OqParam).items()
+            if isinstance(val, valid.Param))
+        for name in sorted(names - NON_HAZARD_PARAMS):
+            value = getattr(self, name, None)
+            sha1.update(('%s=%r\n' % (name, value)).encode('utf8'))
+        sha1.update(repr(list(self.imtls.items())).encode('utf8'))
+        for key, fnames in sorted(self.inputs.items()):
+            if key in ('job_ini', 'fragility', 'specific_assets') or \
+                    LOSS_TYPE_KEY.match(key):  # not a hazard input
+                continue
+            sha1.update(key.encode('utf8'))
+            if not isinstance(fnames, list):
+                fnames = [fnames]
+            for fname in fnames:
+                with open(os.path.join(self.base_path, fname), 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        sha1.update(block)
+        return sha1.hexdigest()
+
     def no_imls(self):
         """
         Return True if there are no intensity measure levels
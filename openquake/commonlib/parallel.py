@@ -20,18 +20,34 @@
 TODO: write documentation.
 """
 
+import io
 import os
 import sys
+import zlib
+import time
 import logging
 import operator
+import importlib
+import multiprocessing
+import tempfile
+import threading
 import traceback
-from concurrent.futures import as_completed, ProcessPoolExecutor
+import collections
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+from concurrent.futures import (
+    as_completed, wait, FIRST_COMPLETED, ProcessPoolExecutor,
+    ThreadPoolExecutor)
 from decorator import FunctionMaker
+import numpy
 import psutil
 
 from openquake.baselib.python3compat import pickle
 from openquake.baselib.performance import PerformanceMonitor, DummyMonitor
-from openquake.baselib.general import split_in_blocks, AccumDict, humansize
+from openquake.baselib.general import (
+    split_in_blocks, AccumDict, humansize, groupby)
 
 
 if psutil.__version__ > '2.0.0':  # Ubuntu 14.10
@@ -62,6 +78,56 @@ executor = ProcessPoolExecutor()
 # load good for our cluster; it has no more significance than that
 executor.num_tasks_hint = executor._max_workers * 8
 
+# the threads are started lazily, at the first submission
+thread_executor = ThreadPoolExecutor(executor._max_workers)
+
+# modules imported by the workers of the process pool when it is created,
+# so that the first tasks do not pay the import time
+WARM_UP_MODULES = ('openquake.hazardlib.calc', 'openquake.risklib.workflows',
+                   'openquake.risklib.riskinput')
+
+# the available executors: process pool, thread pool, in process and
+# TCP work queue (see openquake.commonlib.workqueue)
+DISTRIBUTE = ('processpool', 'threadpool', 'no', 'workqueue')
+
+
+def get_worker_pids(executor):
+    """
+    :param executor: a ProcessPoolExecutor instance
+    :returns: the PIDs of the processes in the pool
+    """
+    procs = getattr(executor, '_processes', None) or ()
+    if isinstance(procs, dict):  # pid -> process
+        return list(procs)
+    return [proc.pid for proc in procs]
+
+
+def warm_up(modules, started, go):
+    """
+    Import the given modules in a worker, then wait for all the workers
+    of the pool to be started, so that each worker runs exactly one
+    warm up task.
+
+    :param modules: a sequence of module names
+    :param started: a queue receiving the PIDs of the started workers
+    :param go: an event set by the master when all the workers started
+    :returns: the PID of the worker
+    """
+    for module in modules:
+        importlib.import_module(module)
+    started.put(os.getpid())
+    go.wait()
+    return os.getpid()
+
+
+def shutdown_when_done(manager, futures):
+    """
+    Wait for the given futures, ignoring their errors, then shut down
+    the manager used by them.
+    """
+    wait(futures)
+    manager.shutdown()
+
 
 def no_distribute():
     """
@@ -71,6 +137,21 @@ def no_distribute():
     return nd in ('1', 'true', 'yes')
 
 
+def oq_distribute():
+    """
+    Return the executor to use, i.e. 'no' if OQ_NO_DISTRIBUTE is true,
+    otherwise the value of the variable OQ_DISTRIBUTE (default
+    'processpool')
+    """
+    if no_distribute():
+        return 'no'
+    distribute = os.environ.get('OQ_DISTRIBUTE', 'processpool').lower()
+    if distribute not in DISTRIBUTE:
+        raise ValueError('Invalid OQ_DISTRIBUTE=%s, expected %s' %
+                         (distribute, '|'.join(DISTRIBUTE)))
+    return distribute
+
+
 def check_mem_usage(soft_percent=90, hard_percent=100):
     """
     Display a warning if we are running out of memory
@@ -86,6 +167,10 @@ def check_mem_usage(soft_percent=90, hard_percent=100):
                           (used_mem_percent, hard_percent))
 
 
+# False in the workers which do not share the filesystem with the master
+oob_results = True
+
+
 def safely_call(func, args, pickle=False):
     """
     Call the given function with the given arguments safely, i.e.
@@ -111,7 +196,7 @@ def safely_call(func, args, pickle=False):
         tb_str = ''.join(traceback.format_tb(tb))
         res = ('\n%s%s: %s' % (tb_str, etype.__name__, exc), etype, mon)
     if pickle:
-        return Pickled(res)
+        return Pickled(res, oob=oob_results)
     return res
 
 
@@ -142,19 +227,126 @@ def log_percent_gen(taskname, todo, progress):
     yield done
 
 
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+# name -> (compress, decompress)
+COMPRESSORS = {'zlib': (zlib.compress, zlib.decompress)}
+if lzma:
+    COMPRESSORS['lzma'] = (lzma.compress, lzma.decompress)
+
+
+def decompress(pik, compression):
+    """
+    :param pik: a bytestring
+    :param compression: None or a key in COMPRESSORS
+    :returns: the decompressed bytestring
+    """
+    if compression is None:
+        return pik
+    return COMPRESSORS[compression][1](pik)
+
+# directory for the out of band buffers; /dev/shm is backed by memory
+OOB_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+
+def dumps(obj, fnames=None, threshold=1024 * 1024):
+    """
+    Pickle an object with the highest protocol. If a list `fnames` is
+    passed, the numpy arrays larger than `threshold` bytes are saved out
+    of band in .npy files, whose names are appended to the list, and only
+    the names are pickled.
+
+    :param obj: the object to pickle
+    :param fnames: None or a list to be populated with file names
+    :param threshold: the minimum size of the arrays to save out of band
+    :returns: the pickled bytestring
+    """
+    if fnames is None:
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def persistent_id(obj):
+        if (isinstance(obj, numpy.ndarray) and obj.nbytes >= threshold
+                and not obj.dtype.hasobject):
+            fd, fname = tempfile.mkstemp(
+                prefix='oob-', suffix='.npy', dir=OOB_DIR)
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, obj)
+            fnames.append(fname)
+            return ('ndarray', fname)
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return f.getvalue()
+
+
+def _load_array(pid):
+    # memory map the array saved out of band; copy-on-write mode
+    # means that the changes are private and not saved in the file
+    kind, fname = pid
+    assert kind == 'ndarray', kind
+    return numpy.load(fname, mmap_mode='c').view(numpy.ndarray)
+
+
+def loads(pik):
+    """
+    Unpickle a bytestring returned by :func:`dumps`. The arrays saved
+    out of band are memory mapped, i.e. they are not copied.
+    """
+    unpickler = pickle.Unpickler(io.BytesIO(pik))
+    unpickler.persistent_load = _load_array
+    return unpickler.load()
+
+
 class Pickled(object):
     """
     An utility to manually pickling/unpickling objects.
     The reason is that celery does not use the HIGHEST_PROTOCOL,
     so relying on celery is slower. Moreover Pickled instances
     have a nice string representation and length giving the size
-    of the pickled bytestring.
+    of the pickled bytestring. If `oob` is true, the numpy arrays
+    larger than `Pickled.oob_threshold` are transferred out of band
+    (see :func:`dumps`) and `.remove()` must be called when the
+    object is not needed anymore.
+
+    If `Pickled.compression` is set (by default from the environment
+    variable OQ_COMPRESSION, 'zlib' or 'lzma') the bytestrings larger
+    than `Pickled.compression_threshold` are compressed; in that case
+    the arrays are not saved out of band, so that they are compressed
+    too. The compression ratio and the time spent are stored in the
+    attributes `.ratio` and `.compress_time`.
 
     :param obj: the object to pickle
+    :param oob: if true, save the large arrays out of band
     """
-    def __init__(self, obj):
+    oob_threshold = 1024 * 1024
+    compression = os.environ.get('OQ_COMPRESSION') or None
+    compression_threshold = 64 * 1024
+
+    def __init__(self, obj, oob=False):
         self.clsname = obj.__class__.__name__
-        self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        self.fnames = []
+        if self.compression and self.compression not in COMPRESSORS:
+            raise ValueError('Unknown compression %r, must be one of %s' %
+                             (self.compression, sorted(COMPRESSORS)))
+        oob = oob and not self.compression
+        self.pik = dumps(obj, self.fnames if oob else None,
+                         self.oob_threshold)
+        self.nbytes = len(self.pik)  # uncompressed size
+        self.compressed = None
+        self.ratio = 1.
+        self.compress_time = 0
+        if self.compression and self.nbytes >= self.compression_threshold:
+            t0 = time.time()
+            zpik = COMPRESSORS[self.compression][0](self.pik)
+            self.compress_time = time.time() - t0
+            if len(zpik) < self.nbytes:  # else keep the original
+                self.ratio = self.nbytes / float(len(zpik))
+                self.pik = zpik
+                self.compressed = self.compression
 
     def __repr__(self):
         """String representation of the pickled object"""
@@ -166,7 +358,73 @@ class Pickled(object):
 
     def unpickle(self):
         """Unpickle the underlying object"""
-        return pickle.loads(self.pik)
+        pik = decompress(self.pik, self.compressed)
+        if self.fnames:
+            return loads(pik)
+        return pickle.loads(pik)
+
+    def remove(self):
+        """
+        Remove the files of the arrays saved out of band; on POSIX
+        systems the arrays already unpickled are still valid.
+        """
+        for fname in self.fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+# process-local cache fname -> pickled bytes, used by the workers
+_broadcast_cache = collections.OrderedDict()
+BROADCAST_CACHE_SIZE = 16  # maximum number of entries in the cache
+
+
+class Broadcast(object):
+    """
+    A small handle to a pickled object stored in a temporary file, which
+    is meant to be shared by many tasks. The bytes are sent to the
+    workers only once: each worker reads the file at the first use and
+    keeps the bytes in a process-local cache. The object is unpickled
+    at each call, so that the tasks cannot see the changes made by
+    other tasks, as it happens with regular arguments.
+
+    :param pickled: a :class:`Pickled` instance
+    :param dirname: the directory where to store the file
+    """
+    def __init__(self, pickled, dirname=None):
+        self.clsname = pickled.clsname
+        self.size = len(pickled)
+        self.fnames = pickled.fnames
+        self.compressed = pickled.compressed
+        fd, self.fname = tempfile.mkstemp(
+            prefix='broadcast-', suffix='.pik', dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pickled.pik)
+        self.handle_size = len(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+
+    def __repr__(self):
+        """String representation of the broadcast object"""
+        return '<Broadcast %s %s>' % (self.clsname, humansize(self.size))
+
+    def __len__(self):
+        """Length of the pickled handle"""
+        return self.handle_size
+
+    def unpickle(self):
+        """Unpickle the underlying object, by reading it if needed"""
+        try:
+            pik = _broadcast_cache[self.fname]
+        except KeyError:
+            with open(self.fname, 'rb') as f:
+                pik = _broadcast_cache[self.fname] = f.read()
+            if len(_broadcast_cache) > BROADCAST_CACHE_SIZE:
+                _broadcast_cache.popitem(last=False)
+        return loads(decompress(pik, self.compressed))
+
+    def remove(self):
+        """Remove the underlying files"""
+        for fname in [self.fname] + self.fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
 
 
 def get_pickled_sizes(obj):
@@ -191,7 +449,7 @@ def get_pickled_sizes(obj):
         sizes, key=lambda pair: pair[1], reverse=True)
 
 
-def pickle_sequence(objects):
+def pickle_sequence(objects, oob=False):
     """
     Convert an iterable of objects into a list of pickled objects.
     If the iterable contains copies, the pickling will be done only once.
@@ -199,6 +457,7 @@ def pickle_sequence(objects):
     pickled again.
 
     :param objects: a sequence of objects to pickle
+    :param oob: if true, save the large arrays out of band
     """
     cache = {}
     out = []
@@ -208,7 +467,7 @@ def pickle_sequence(objects):
             if isinstance(obj, Pickled):  # already pickled
                 cache[obj_id] = obj
             else:  # pickle the object
-                cache[obj_id] = Pickled(obj)
+                cache[obj_id] = Pickled(obj, oob)
         out.append(cache[obj_id])
     return out
 
@@ -226,24 +485,164 @@ class TaskManager(object):
     Progress report is built-in.
     """
     executor = executor
+    thread_executor = thread_executor
+    workqueue_executor = None  # instantiated at the first usage
     progress = staticmethod(logging.info)
+    distribute = None  # if not set, use oq_distribute()
+    broadcast_threshold = 1024 * 1024  # broadcast arguments over 1 MB
+    in_flight = 0  # maximum number of tasks in flight, 0 means no limit
+    in_flight_mem_fraction = 0.25  # used when in_flight is 'auto'
+    adaptive = False  # if True, apply_reduce calibrates the chunks
+    adaptive_fraction = 0.1  # fraction of the weight in the first wave
+    mem_budget = 0.9  # fraction of the memory usable before throttling
+    max_tasks_per_worker = 0  # recycle the workers after N tasks each
+    max_worker_rss_growth = 0  # recycle the workers after M MB of growth
+    warm_up_modules = WARM_UP_MODULES
+    warm_up_timeout = 60  # seconds waiting for the workers to start
+    _pool_tasks = 0  # tasks submitted to the process pool since the start
+    _pool_rss = None  # pid -> RSS of the workers after the warm up
+
+    @classmethod
+    def shutdown_workqueue(cls):
+        """
+        Shut down the work queue executor, if any, closing its listener
+        and stopping its threads; a new executor will be instantiated at
+        the next usage.
+        """
+        if cls.workqueue_executor is not None:
+            cls.workqueue_executor.shutdown()
+            cls.workqueue_executor = None
 
     @classmethod
     def restart(cls):
         cls.executor.shutdown()
-        cls.executor = ProcessPoolExecutor()
+        cls.executor = ProcessPoolExecutor(cls.executor._max_workers)
+        cls._pool_tasks = 0
+        cls._pool_rss = None
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Start the workers of the process pool and import in them the
+        modules listed in `.warm_up_modules`; the modules are imported
+        in the master too, so that forked workers inherit them. Then
+        store the RSS of the workers, used by :meth:`recycle_if_needed`.
+        If the workers do not start within `.warm_up_timeout` seconds a
+        warning is logged and the pool is used as it is.
+        """
+        for module in cls.warm_up_modules:
+            importlib.import_module(module)
+        num_workers = cls.executor._max_workers
+        # a worker blocked in a warm up task cannot take another one,
+        # so the tasks are run by different workers
+        manager = multiprocessing.Manager()
+        started, go = manager.Queue(), manager.Event()
+        futures = [cls.executor.submit(
+            warm_up, cls.warm_up_modules, started, go)
+            for _ in range(num_workers)]
+        try:
+            for _ in range(num_workers):
+                started.get(timeout=cls.warm_up_timeout)
+        except queue.Empty:  # slow host: do not wait for the workers
+            logging.warn('The workers did not start in %d seconds, '
+                         'using a cold pool', cls.warm_up_timeout)
+            go.set()
+            # the pending warm up tasks still need the manager
+            thread = threading.Thread(
+                target=shutdown_when_done, args=(manager, futures))
+            thread.daemon = True
+            thread.start()
+        except:
+            go.set()
+            manager.shutdown()
+            raise
+        else:
+            go.set()  # release the workers
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                manager.shutdown()
+        cls._pool_rss = cls.get_workers_rss()
+
+    @classmethod
+    def get_workers_rss(cls):
+        """
+        :returns: a dictionary pid -> RSS in bytes of the process pool workers
+        """
+        rss = {}
+        for pid in get_worker_pids(cls.executor):
+            try:
+                rss[pid] = memory_info(psutil.Process(pid)).rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    @classmethod
+    def recycle_if_needed(cls):
+        """
+        Restart the process pool if the workers ran more than
+        `.max_tasks_per_worker` tasks each on average, or if the RSS of
+        a worker grew more than `.max_worker_rss_growth` MB since the
+        warm up. Must be called when no tasks are running.
+
+        :returns: True if the pool was restarted
+        """
+        reason = None
+        num_workers = cls.executor._max_workers
+        if (cls.max_tasks_per_worker and cls._pool_tasks >=
+                cls.max_tasks_per_worker * num_workers):
+            reason = '%d tasks' % cls._pool_tasks
+        elif cls.max_worker_rss_growth and cls._pool_rss:
+            rss = cls.get_workers_rss()
+            growth = max(rss.get(pid, start) - start
+                         for pid, start in cls._pool_rss.items())
+            if growth > cls.max_worker_rss_growth * 1024 * 1024:
+                reason = 'a memory growth of %s' % humansize(growth)
+        if reason:
+            logging.info('Recycling the workers after %s', reason)
+            cls.restart()
+            return True
+        return False
 
     @classmethod
-    def starmap(cls, task, task_args, name=None):
+    def starmap(cls, task, task_args, name=None, broadcast=(),
+                in_flight=None, distribute=None, result_nbytes=None):
         """
-        Spawn a bunch of tasks with the given list of arguments
+        Spawn a bunch of tasks with the given list of arguments.
+        If `in_flight` is a positive number K, only K tasks are submitted
+        and the others are submitted by `.reduce` as soon as results
+        come back; if it is 'auto', K is derived from the available
+        memory and the size of the arguments of the first task.
+        Moreover, the submission is throttled when the used memory plus
+        the estimated size of the results in flight exceeds the fraction
+        `.mem_budget` of the total memory.
 
+        :param task: a task to run in parallel
+        :param task_args: an iterable over the arguments of the tasks
+        :param name: the name of the task (default the function name)
+        :param broadcast: arguments shared by all tasks
+        :param in_flight: the maximum number of tasks in flight
+        :param distribute: the executor to use ('processpool', 'threadpool'
+                           or 'no'); if None, use the default
+        :param result_nbytes: a function estimating the size in bytes
+                              of the result of a task from its arguments
         :returns: a TaskManager object with a .result method.
         """
-        self = cls(task, name)
-        for i, a in enumerate(task_args, 1):
-            cls.progress('Submitting task %s #%d', self.name, i)
-            self.submit(*a)
+        self = cls(task, name, broadcast, distribute)
+        if self.distribute == 'processpool':
+            cls.recycle_if_needed()
+        self.todo.extend(task_args)
+        self.result_nbytes = result_nbytes
+        if in_flight is None:
+            in_flight = cls.in_flight
+        if self.todo:
+            self.submit_next()
+        if in_flight == 'auto':
+            in_flight = self.get_in_flight()
+        self.in_flight = in_flight
+        while self.todo and self.can_submit():
+            self.submit_next()
         return self
 
     @classmethod
@@ -251,7 +650,8 @@ class TaskManager(object):
                      concurrent_tasks=executor._max_workers,
                      weight=lambda item: 1,
                      key=lambda item: 'Unspecified',
-                     name=None):
+                     name=None, in_flight=None, distribute=None,
+                     adaptive=None, result_nbytes=None, flush=None):
         """
         Apply a task to a tuple of the form (sequence, \*other_args)
         by first splitting the sequence in chunks, according to the weight
@@ -269,6 +669,17 @@ class TaskManager(object):
         :param concurrent_tasks: hint about how many tasks to generate
         :param weight: function to extract the weight of an item in arg0
         :param key: function to extract the kind of an item in arg0
+        :param name: the name of the task (default the function name)
+        :param in_flight: the maximum number of tasks in flight
+        :param distribute: the executor to use ('processpool', 'threadpool'
+                           or 'no'); if None, use the default
+        :param adaptive: if True, use the adaptive mode (see
+                         :meth:`apply_reduce_adaptive`); if None, use
+                         the class attribute `.adaptive`
+        :param result_nbytes: a function estimating the size in bytes
+                              of the result of a task from its arguments
+        :param flush: a function acc -> acc called when the memory
+                      budget is exceeded (see :meth:`reduce`)
         """
         arg0 = task_args[0]  # this is assumed to be a sequence
         num_items = len(arg0)
@@ -280,25 +691,245 @@ class TaskManager(object):
             return acc
         elif num_items == 1:  # apply the function in the master process
             return agg(acc, task_func(arg0, *args))
+        distribute = distribute or cls.distribute or oq_distribute()
+        if adaptive is None:
+            adaptive = cls.adaptive
+        if adaptive and concurrent_tasks and distribute != 'no':
+            return cls.apply_reduce_adaptive(
+                task, task_args, agg, acc, concurrent_tasks, weight, key,
+                name, in_flight, distribute, result_nbytes, flush)
         chunks = list(split_in_blocks(
             arg0, concurrent_tasks or 1, weight, key))
         cls.apply_reduce.__func__._chunks = chunks
-        if not concurrent_tasks or no_distribute():
+        if not concurrent_tasks or distribute == 'no':
             for chunk in chunks:
                 acc = agg(acc, task_func(chunk, *args))
             return acc
         logging.info('Starting %d tasks', len(chunks))
-        self = cls.starmap(task, [(chunk,) + args for chunk in chunks], name)
-        return self.reduce(agg, acc)
+        self = cls.starmap(task, [(chunk,) + args for chunk in chunks], name,
+                           broadcast=args, in_flight=in_flight,
+                           distribute=distribute, result_nbytes=result_nbytes)
+        return self.reduce(agg, acc, flush)
+
+    @classmethod
+    def apply_reduce_adaptive(cls, task, task_args, agg, acc,
+                              concurrent_tasks, weight, key, name=None,
+                              in_flight=None, distribute=None,
+                              result_nbytes=None, flush=None):
+        """
+        Adaptive version of :meth:`apply_reduce`. A first wave of small
+        chunks, containing `.adaptive_fraction` of the weight of each
+        kind of items, is run and the time spent per unit of weight is
+        measured for each kind. Then the remaining items are split by
+        using the measured times as weights, so that the remaining tasks
+        have similar durations even if the static weights are inaccurate.
+        The parameters are the same as in :meth:`apply_reduce`.
+        """
+        arg0 = task_args[0]
+        args = task_args[1:]
+        first, rest = [], []
+        for kind, items in groupby(arg0, key).items():
+            limit = sum(map(weight, items)) * cls.adaptive_fraction
+            tot = 0
+            for i, item in enumerate(items):
+                if i and tot >= limit:
+                    rest.extend(items[i:])
+                    break
+                first.append(item)
+                tot += weight(item)
+        # one small chunk per worker in the first wave
+        nchunks = min(cls.executor._max_workers, concurrent_tasks)
+        chunks = list(split_in_blocks(first, nchunks, weight, key))
+        durations = {}  # chunk index -> seconds
+
+        def agg_timed(acc, triple):
+            idx, duration, result = triple
+            durations[idx] = duration
+            return agg(acc, result)
+        logging.info('Starting %d calibration tasks', len(chunks))
+        self = cls.starmap(
+            timed_call, [(task, i, chunk) + args
+                         for i, chunk in enumerate(chunks)],
+            name or task.__name__, broadcast=(task,) + args,
+            in_flight=in_flight, distribute=distribute,
+            result_nbytes=result_nbytes and (
+                lambda args: result_nbytes(args[2:])))
+        acc = self.reduce(agg_timed, acc, flush)
+        if not rest:
+            cls.apply_reduce.__func__._chunks = chunks
+            return acc
 
-    def __init__(self, oqtask, name=None):
+        # seconds per unit of weight for each kind of items
+        time_weight = AccumDict()
+        for idx, chunk in enumerate(chunks):
+            time_weight += {key(chunk[0]): numpy.array(
+                [durations[idx], sum(map(weight, chunk))])}
+        speed = {kind: t / w for kind, (t, w) in time_weight.items()
+                 if t and w}
+        default = numpy.mean(list(speed.values())) if speed else 1
+        for kind in speed:
+            logging.info('Measured %.3g s per unit of weight for %s',
+                         speed[kind], kind)
+
+        def expected_time(item):
+            return weight(item) * speed.get(key(item), default)
+        chunks2 = list(split_in_blocks(
+            rest, max(concurrent_tasks - len(chunks), 1), expected_time, key))
+        cls.apply_reduce.__func__._chunks = chunks + chunks2
+        logging.info('Starting %d tasks', len(chunks2))
+        self = cls.starmap(task, [(chunk,) + args for chunk in chunks2],
+                           name, broadcast=args, in_flight=in_flight,
+                           distribute=distribute, result_nbytes=result_nbytes)
+        return self.reduce(agg, acc, flush)
+
+    def __init__(self, oqtask, name=None, broadcast=(), distribute=None):
         self.oqtask = oqtask
         self.task_func = getattr(oqtask, 'task_func', oqtask)
         self.name = name or oqtask.__name__
         self.results = []
+        self.todo = collections.deque()  # arguments of tasks to submit
+        self.submitted = 0
+        self.done = 0  # number of results aggregated
+        self.result_nbytes = None  # estimate of the size of a result
+        self.pending_nbytes = 0  # estimated size of the results in flight
+        self._nbytes = {}  # future -> estimated size of the result
+        self.throttled = False
         self.sent = 0
         self.received = 0
-        self.no_distribute = no_distribute()
+        self.distribute = distribute or self.distribute or oq_distribute()
+        if self.distribute not in DISTRIBUTE:
+            raise ValueError('Invalid distribute=%s, expected %s' %
+                             (self.distribute, '|'.join(DISTRIBUTE)))
+        self.no_distribute = self.distribute == 'no'
+        # keep a reference to the shared objects, so that their ids
+        # cannot be reused during the lifetime of the TaskManager
+        self.broadcast = [obj for obj in broadcast
+                          if not isinstance(obj, PerformanceMonitor)]
+        # the broadcast and out of band files can be read only by
+        # processes running on the same machine as the master
+        self.oob = self.distribute == 'processpool'
+        self._broadcast_ids = set(map(id, self.broadcast))
+        self._shared = {}  # id(obj) -> Pickled or Broadcast instance
+        self._to_remove = {}  # id(pik) -> object with files to remove
+        self.broadcast_saved = 0
+        # uncompressed bytes, compressed bytes, compression time
+        self.compression_stats = numpy.zeros(3)
+
+    def pickle_args(self, args):
+        """
+        Pickle the arguments of a task. The shared arguments are pickled
+        only once; if they are larger than `.broadcast_threshold`, they
+        are stored in a temporary file and replaced by a
+        :class:`Broadcast` handle. The large arrays are saved out of band.
+
+        :param args: the arguments of a task
+        :returns: a list of Pickled or Broadcast instances
+        """
+        piks = []
+        for arg in args:
+            pik = self._shared.get(id(arg))
+            if pik is None and id(arg) in self._broadcast_ids:
+                pik = (arg if isinstance(arg, Pickled)
+                       else Pickled(arg, self.oob))
+                self.add_compression_stats(pik)
+                if self.oob and len(pik) >= self.broadcast_threshold:
+                    pik = Broadcast(pik)
+                self._shared[id(arg)] = pik
+            elif isinstance(pik, Broadcast):
+                self.broadcast_saved += pik.size - len(pik)
+            piks.append(pik)
+        # the other arguments are pickled as usual
+        others = pickle_sequence(
+            (arg for arg, pik in zip(args, piks) if pik is None), self.oob)
+        for pik in set(others):
+            self.add_compression_stats(pik)
+        others = iter(others)
+        piks = [next(others) if pik is None else pik for pik in piks]
+        for pik in piks:
+            if pik.fnames or isinstance(pik, Broadcast):
+                self._to_remove[id(pik)] = pik
+        return piks
+
+    def add_compression_stats(self, pik):
+        """
+        Update the compression statistics with the given Pickled object
+        """
+        if pik.compressed:
+            self.compression_stats += (
+                pik.nbytes, len(pik), pik.compress_time)
+
+    def clean_up(self):
+        """
+        Remove the files of the broadcast arguments and of the arrays
+        saved out of band, and report the saved bytes
+        """
+        if self.broadcast_saved:
+            self.progress('Broadcasting saved %s of data',
+                          humansize(self.broadcast_saved))
+        nbytes, zbytes, ztime = self.compression_stats
+        if zbytes:
+            self.progress('Compressed %s into %s (ratio %.1f) in %.1f s',
+                          humansize(nbytes), humansize(zbytes),
+                          nbytes / zbytes, ztime)
+        self.compression_stats[:] = 0
+        for pik in self._to_remove.values():
+            pik.remove()
+        self._to_remove.clear()
+        self._shared.clear()
+        self.broadcast_saved = 0
+
+    def get_in_flight(self):
+        """
+        :returns: the number of tasks in flight such that their arguments
+                  use at most `.in_flight_mem_fraction` of the available
+                  memory, but at least twice the number of workers
+        """
+        nbytes = max(self.sent / max(self.submitted, 1), 1)
+        avail = virtual_memory().available * self.in_flight_mem_fraction
+        return max(int(avail // nbytes), 2 * self.executor._max_workers)
+
+    def over_budget(self, nbytes=0):
+        """
+        :param nbytes: the size of the data that would be added
+        :returns: True if the used memory plus the estimated size of the
+                  results in flight plus `nbytes` exceeds `.mem_budget`
+        """
+        mem = virtual_memory()
+        return (mem.used + self.pending_nbytes + nbytes >
+                mem.total * self.mem_budget)
+
+    def can_submit(self):
+        """
+        :returns: True if the next task in `.todo` can be submitted
+                  without exceeding the number of tasks in flight and
+                  the memory budget; at least a task is always in flight
+        """
+        running = self.submitted - self.done
+        if self.no_distribute or not running:
+            return True
+        elif self.in_flight and running >= self.in_flight:
+            return False
+        nbytes = self.result_nbytes(self.todo[0]) if self.result_nbytes else 0
+        if self.over_budget(nbytes):
+            if not self.throttled:
+                logging.warn('Memory budget exceeded, throttling the '
+                             'submission of %s tasks', self.name)
+                self.throttled = True
+            return False
+        return True
+
+    def submit_next(self):
+        """
+        Submit the next task in the queue `.todo`
+        """
+        self.submitted += 1
+        self.progress('Submitting task %s #%d', self.name, self.submitted)
+        args = self.todo.popleft()
+        self.submit(*args)
+        if self.result_nbytes and not self.no_distribute:
+            nbytes = self.result_nbytes(args)
+            self._nbytes[self.results[-1]] = nbytes
+            self.pending_nbytes += nbytes
 
     def submit(self, *args):
         """
@@ -311,52 +942,114 @@ class TaskManager(object):
         # log a warning if too much memory is used
         if self.no_distribute:
             res = safely_call(self.task_func, args)
+        elif self.distribute == 'threadpool':
+            # the arguments are passed without pickling, except the
+            # monitor which is copied since it is modified by the task
+            if args and isinstance(args[-1], PerformanceMonitor):
+                args = args[:-1] + (pickle.loads(pickle.dumps(
+                    args[-1], pickle.HIGHEST_PROTOCOL)),)
+            res = self.thread_executor.submit(
+                safely_call, self.task_func, args)
         else:
-            piks = pickle_sequence(args)
+            piks = self.pickle_args(args)
             self.sent += sum(len(p) for p in piks)
             res = self._submit(piks)
         self.results.append(res)
 
+    def get_executor(self):
+        """
+        :returns: the executor used to submit the pickled tasks
+        """
+        if self.distribute == 'workqueue':
+            cls = self.__class__
+            if cls.workqueue_executor is None:
+                from openquake.commonlib import workqueue
+                cls.workqueue_executor = workqueue.WorkQueueExecutor(
+                    workqueue.get_address(), workqueue.get_authkey())
+            return cls.workqueue_executor
+        if self._pool_rss is None:  # first usage of the process pool
+            self.warm_up()
+        return self.executor
+
     def _submit(self, piks):
-        # submit tasks by using the ProcessPoolExecutor
+        # submit tasks by using the ProcessPoolExecutor or the work queue
+        executor = self.get_executor()
+        if self.distribute == 'processpool':
+            self.__class__._pool_tasks += 1
         if self.oqtask is self.task_func:
-            return self.executor.submit(
-                safely_call, self.task_func, piks, True)
+            return executor.submit(safely_call, self.task_func, piks, True)
         else:  # call the decorated task
-            return self.executor.submit(self.oqtask, *piks)
+            return executor.submit(self.oqtask, *piks)
 
-    def aggregate_result_set(self, agg, acc):
+    def aggregate_result_set(self, agg, acc, flush=None):
         """
         Loop on a set of futures and update the accumulator
         by using the aggregation function.
 
         :param agg: the aggregation function, (acc, val) -> new acc
         :param acc: the initial value of the accumulator
+        :param flush: a function acc -> acc called when over budget
         :returns: the final value of the accumulator
         """
-        for future in as_completed(self.results):
-            check_mem_usage()
-            # log a warning if too much memory is used
-            result = future.result()
-            if isinstance(result, BaseException):
-                raise result
-            self.received += len(result)
-            acc = agg(acc, result.unpickle())
+        if not self.todo:
+            for future in as_completed(self.results):
+                acc = self._agg_future(agg, acc, future)
+                if flush and self.over_budget():
+                    acc = flush(acc)
+            return acc
+        # sliding window: submit new tasks as the results are received;
+        # the futures are not kept in `.results`, so that the memory
+        # occupation is proportional to the number of tasks in flight
+        pending = set(self.results)
+        del self.results[:]
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                acc = self._agg_future(agg, acc, future)
+            if flush and self.todo and self.over_budget():
+                acc = flush(acc)
+            while self.todo and self.can_submit():
+                self.submit_next()
+                pending.add(self.results.pop())
         return acc
 
-    def reduce(self, agg=operator.add, acc=None):
+    def _agg_future(self, agg, acc, future):
+        check_mem_usage()
+        # log a warning if too much memory is used
+        self.done += 1
+        self.pending_nbytes -= self._nbytes.pop(future, 0)
+        result = future.result()
+        if isinstance(result, BaseException):
+            raise result
+        elif self.distribute == 'threadpool':  # not pickled
+            return agg(acc, result)
+        self.received += len(result)
+        val = result.unpickle()
+        result.remove()  # the memory mapped arrays are still valid
+        if result.compressed:
+            # record the time spent by the worker to compress the result
+            self.add_compression_stats(result)
+            mon = val[2]
+            mon('compressing result').duration += result.compress_time
+        return agg(acc, val)
+
+    def reduce(self, agg=operator.add, acc=None, flush=None):
         """
         Loop on a set of results and update the accumulator
-        by using the aggregation function.
+        by using the aggregation function. If a `flush` function is
+        given, it is called when the memory budget is exceeded, to give
+        the caller a chance to save the partial results (for instance in
+        the datastore) and to free memory.
 
         :param agg: the aggregation function, (acc, val) -> new acc
         :param acc: the initial value of the accumulator
+        :param flush: a function acc -> acc
         :returns: the final value of the accumulator
         """
         if acc is None:
             acc = AccumDict()
         log_percent = log_percent_gen(
-            self.name, len(self.results), self.progress)
+            self.name, len(self.results) + len(self.todo), self.progress)
         next(log_percent)
 
         def agg_and_percent(acc, triple):
@@ -371,9 +1064,16 @@ class TaskManager(object):
         if self.no_distribute:
             agg_result = reduce(agg_and_percent, self.results, acc)
         else:
-            self.progress('Sent %s of data', humansize(self.sent))
-            agg_result = self.aggregate_result_set(agg_and_percent, acc)
-            self.progress('Received %s of data', humansize(self.received))
+            try:
+                agg_result = self.aggregate_result_set(
+                    agg_and_percent, acc, flush)
+            finally:
+                self.clean_up()
+            if self.distribute in ('processpool', 'workqueue'):
+                # NB: with a sliding window the data is sent while reducing
+                self.progress('Sent %s of data', humansize(self.sent))
+                self.progress('Received %s of data',
+                              humansize(self.received))
         self.results = []
         return agg_result
 
@@ -409,6 +1109,30 @@ def do_not_aggregate(acc, value):
     return acc
 
 
+def timed_call(task, idx, chunk, *args):
+    """
+    Call the task on the given chunk and measure the time spent.
+    Used in the first wave of :meth:`TaskManager.apply_reduce_adaptive`.
+
+    :param task: a task function, possibly decorated with `litetask`
+    :param idx: the index of the chunk
+    :param chunk: the first argument of the task
+    :param args: the other arguments of the task
+    :returns: a triple (idx, duration, result)
+    """
+    task_func = getattr(task, 'task_func', task)
+    t0 = time.time()
+    if task_func is not task:  # litetask, the last argument is a monitor
+        monitor = args[-1]
+        monitor.flush = noflush
+        with monitor('total ' + task_func.__name__, measuremem=True):
+            result = task_func(chunk, *args)
+        delattr(monitor, 'flush')
+    else:
+        result = task_func(chunk, *args)
+    return idx, time.time() - t0, result
+
+
 def noflush():
     # this is set by the litetask decorator
     raise RuntimeError('PerformanceMonitor.flush() must not be called '
@@ -30,7 +30,7 @@ from shapely import wkt, geometry
 from openquake.hazardlib import geo, site, correlation, imt
 from openquake.risklib import workflows, riskinput
 
-from openquake.commonlib.datastore import DataStore
+from openquake.commonlib.datastore import DataStore, register_h5
 from openquake.commonlib.oqvalidation import OqParam, rmdict
 from openquake.commonlib.node import read_nodes, LiteralNode, context
 from openquake.commonlib import nrml, valid, logictree, InvalidFile, parallel
@@ -288,6 +288,51 @@ def get_site_collection(oqparam, mesh=None, site_ids=None,
         mesh.lons, mesh.lats, site_ids, oqparam)
 
 
+site_dt = numpy.dtype([('sid', numpy.uint32), ('lon', float), ('lat', float),
+                       ('vs30', float), ('vs30measured', bool),
+                       ('z1pt0', float), ('z2pt5', float), ('backarc', bool)])
+
+
+def sitecol_toh5(sitecol):
+    """
+    Convert a SiteCollection into a composite array with dtype `site_dt`;
+    a FilteredSiteCollection is converted into a dictionary with keys
+    `complete` and `indices`.
+
+    :param sitecol: a SiteCollection or FilteredSiteCollection instance
+    :returns: a pair (array or dictionary, attrs)
+    """
+    complete = sitecol.complete
+    array = numpy.zeros(len(complete), site_dt)
+    array['sid'] = complete.sids
+    array['lon'] = complete.lons
+    array['lat'] = complete.lats
+    for name in site_dt.names[3:]:
+        array[name] = getattr(complete, name)
+    if complete is sitecol:
+        return array, {}
+    return dict(complete=array,
+                indices=numpy.array(sitecol.indices, numpy.uint32)), {}
+
+
+def sitecol_fromh5(data, attrs):
+    """
+    Build a SiteCollection or FilteredSiteCollection from the data
+    returned by :func:`sitecol_toh5`.
+    """
+    if isinstance(data, dict):
+        return site.FilteredSiteCollection(
+            data['indices'].value, sitecol_fromh5(data['complete'], attrs))
+    return site.SiteCollection(
+        [site.Site(geo.Point(rec['lon'], rec['lat']), float(rec['vs30']),
+                   bool(rec['vs30measured']), float(rec['z1pt0']),
+                   float(rec['z2pt5']), bool(rec['backarc']), int(rec['sid']))
+         for rec in data.value])
+
+register_h5(site.SiteCollection, sitecol_toh5, sitecol_fromh5)
+register_h5(site.FilteredSiteCollection, sitecol_toh5, sitecol_fromh5)
+
+
 def get_gsims(oqparam):
     """
     Return an ordered list of GSIM instances from the gsim name in the
@@ -493,6 +538,9 @@ def get_composite_source_model(
     """
     processor = SourceProcessor(sitecol, oqparam.maximum_distance,
                                 oqparam.area_source_discretization)
+    if oqparam.learned_weights:
+        processor.cost_model = source.CostModel.from_datadir()
+        logging.info('Using the cost model %s', processor.cost_model)
     source_model_lt = get_source_model_lt(oqparam)
     smodels = []
     trt_id = 0
@@ -0,0 +1,168 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A spatial index over the sites of a site collection, used to prefilter
+the sites close to a source or to a rupture before computing the exact
+distances with hazardlib.
+"""
+from __future__ import division
+import numpy
+from scipy.spatial import cKDTree
+
+from openquake.hazardlib.geo.geodetic import EARTH_RADIUS
+from openquake.hazardlib.calc import filters
+
+
+def unit_vectors(lons, lats):
+    """
+    :param lons: an array of longitudes in degrees
+    :param lats: an array of latitudes in degrees
+    :returns: an array of shape (N, 3) with the corresponding points
+              on the unit sphere, in Cartesian coordinates
+
+    >>> unit_vectors([0, 90], [0, 0]).round(6)
+    array([[ 1.,  0.,  0.],
+           [ 0.,  1.,  0.]])
+    """
+    lons = numpy.radians(lons)
+    lats = numpy.radians(lats)
+    cos_lats = numpy.cos(lats)
+    return numpy.column_stack(
+        [cos_lats * numpy.cos(lons), cos_lats * numpy.sin(lons),
+         numpy.sin(lats)])
+
+
+def get_surface_points(surface):
+    """
+    :param surface: a hazardlib surface object
+    :returns: longitudes and latitudes of points whose convex hull contains
+              the surface projection of the rupture
+    """
+    if hasattr(surface, 'corner_lons'):  # planar surface
+        return surface.corner_lons, surface.corner_lats
+    elif hasattr(surface, 'surfaces'):  # multi surface
+        return (numpy.concatenate([get_surface_points(s)[0]
+                                   for s in surface.surfaces]),
+                numpy.concatenate([get_surface_points(s)[1]
+                                   for s in surface.surfaces]))
+    mesh = surface.get_mesh()  # simple and complex fault surfaces
+    return mesh.lons.flatten(), mesh.lats.flatten()
+
+
+class SiteIndex(object):
+    """
+    A KD-tree over the 3D Cartesian coordinates of the sites. Given a
+    geometry, i.e. the vertices of a polygon or the points of a rupture
+    surface, the index returns the sites inside the spherical cap
+    containing the geometry, enlarged by the maximum distance. This is
+    a superset of the sites within the maximum distance, so the exact
+    distances must be computed only on the candidates. The tree is
+    built lazily and it is pickled with the index, so an index built
+    by the master can be sent to the workers without rebuilding it.
+
+    :param sitecol: a SiteCollection or FilteredSiteCollection instance
+    """
+    def __init__(self, sitecol):
+        self.sitecol = sitecol
+
+    @property
+    def tree(self):
+        """The underlying cKDTree, built at the first access"""
+        try:
+            return self._tree
+        except AttributeError:
+            self._tree = cKDTree(
+                unit_vectors(self.sitecol.lons, self.sitecol.lats))
+            return self._tree
+
+    def __len__(self):
+        return len(self.sitecol)
+
+    def get_candidates(self, lons, lats, maxdist):
+        """
+        :param lons: longitudes of the vertices of the geometry
+        :param lats: latitudes of the vertices of the geometry
+        :param maxdist: the maximum distance in km
+        :returns: the sorted positions of the candidate sites in the
+                  underlying site collection
+        """
+        vectors = unit_vectors(lons, lats)
+        center = vectors.mean(axis=0)
+        norm = numpy.linalg.norm(center)
+        if norm == 0:  # degenerate geometry
+            return numpy.arange(len(self.sitecol))
+        center /= norm
+        radius = numpy.arccos(numpy.clip(vectors.dot(center), -1, 1)).max()
+        if radius >= numpy.pi / 2:
+            # the cap is not convex and may not contain the geometry
+            return numpy.arange(len(self.sitecol))
+        angle = min(radius + maxdist / EARTH_RADIUS, numpy.pi)
+        chord = 2 * numpy.sin(angle / 2) * (1 + 1E-6)  # tolerance
+        return numpy.array(
+            sorted(self.tree.query_ball_point(center, chord)), int)
+
+    def prefilter(self, lons, lats, maxdist):
+        """
+        :returns: the collection of candidate sites or None
+        """
+        idxs = self.get_candidates(lons, lats, maxdist)
+        if len(idxs) == 0:
+            return None
+        mask = numpy.zeros(len(self.sitecol), bool)
+        mask[idxs] = True
+        return self.sitecol.filter(mask)
+
+    def filter_sites_by_distance_to_source(self, src, maxdist):
+        """
+        Equivalent to `src.filter_sites_by_distance_to_source(maxdist,
+        sitecol)`, but the exact filtering is performed only on the
+        candidate sites; the rupture enclosing polygon is built once,
+        for the prefiltering and for the exact test.
+
+        :param src: a hazardlib source object
+        :param maxdist: the maximum distance in km
+        :returns: a filtered site collection or None
+        """
+        if not hasattr(src, 'get_rupture_enclosing_polygon'):
+            # a source with its own filtering, for instance a rupture
+            return src.filter_sites_by_distance_to_source(
+                maxdist, self.sitecol)
+        poly = src.get_rupture_enclosing_polygon(maxdist)
+        sites = self.prefilter(poly.lons, poly.lats, 0)
+        if sites is None:
+            return None
+        # the same test performed by SeismicSource
+        return sites.filter(poly.intersects(sites.mesh))
+
+    def filter_sites_by_distance_to_rupture(self, rupture, maxdist):
+        """
+        Equivalent to `filter_sites_by_distance_to_rupture(rupture,
+        maxdist, sitecol)`, but the exact filtering is performed only on
+        the candidate sites.
+
+        :param rupture: a hazardlib rupture object
+        :param maxdist: the maximum distance in km
+        :returns: a filtered site collection or None
+        """
+        lons, lats = get_surface_points(rupture.surface)
+        sites = self.prefilter(lons, lats, maxdist)
+        if sites is None:
+            return None
+        return filters.filter_sites_by_distance_to_rupture(
+            rupture, maxdist, sites)
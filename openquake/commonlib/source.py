@@ -15,6 +15,7 @@ from __future__ import division
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import mock
+import os
 import time
 import logging
 import operator
@@ -27,7 +28,9 @@ import numpy
 
 from openquake.baselib.general import AccumDict, groupby
 from openquake.commonlib.node import read_nodes
-from openquake.commonlib import valid, logictree, sourceconverter, parallel
+from openquake.commonlib import (
+    valid, logictree, sourceconverter, parallel, datastore)
+from openquake.commonlib.siteindex import SiteIndex
 from openquake.commonlib.nrml import nodefactory, PARSE_NS_MAP
 from functools import reduce
 
@@ -100,6 +103,95 @@ def get_weight(src, point_source_weight=1/40., num_ruptures=None):
     return weight
 
 
+class CostModel(object):
+    """
+    A model for the time spent in computing the hazard curves generated
+    by a source, assumed to be proportional to the weight of the source
+    (see :func:`get_weight`), to the number of GSIMs and to the number of
+    sites affected by the source, with a coefficient depending on the
+    source class. The
+    coefficients are fitted on the `source_info` arrays stored by previous
+    classical calculations.
+
+    :param coeffs:
+        a dictionary source_class -> seconds per unit of weight, GSIM and site
+    :param default:
+        the coefficient used for the source classes not in `coeffs`
+    """
+    def __init__(self, coeffs, default):
+        self.coeffs = coeffs
+        self.default = default
+
+    @classmethod
+    def fit(cls, infos):
+        """
+        :param infos:
+            a composite array with fields source_class, weight, num_gsims,
+            num_sites and calc_time
+        :returns: a CostModel instance or None if there is no usable data
+        """
+        times = AccumDict()
+        units = AccumDict()
+        for rec in infos:
+            unit = rec['weight'] * rec['num_gsims'] * rec['num_sites']
+            if unit > 0:
+                times += {rec['source_class']: rec['calc_time']}
+                units += {rec['source_class']: unit}
+        coeffs = {cls_.decode('utf8'): times[cls_] / units[cls_]
+                  for cls_ in times if times[cls_] > 0}
+        if not coeffs:
+            return None
+        return cls(coeffs, sum(times.values()) / sum(units.values()))
+
+    @classmethod
+    def from_datadir(cls, datadir=None, max_calcs=10):
+        """
+        Fit the coefficients on the `source_info` arrays of the most
+        recent classical calculations in the given directory.
+
+        :param datadir:
+            the directory containing the calc_XXX.hdf5 files; if None,
+            the current datastore.DATADIR is used
+        :param max_calcs: the maximum number of calculations to read
+        :returns: a CostModel instance or None
+        """
+        datadir = datadir or datastore.DATADIR
+        infos = []
+        for calc_id in reversed(datastore.get_calc_ids(datadir)):
+            fname = os.path.join(datadir, 'calc_%d.hdf5' % calc_id)
+            try:
+                with datastore.h5py.File(fname, 'r') as f:
+                    if 'source_info' not in f:
+                        continue
+                    info = f['source_info'][()]
+            except IOError:  # calculation still running, or broken file
+                continue
+            if info.dtype.names and 'num_gsims' in info.dtype.names:
+                infos.append(info)
+                if len(infos) == max_calcs:
+                    break
+        if infos:
+            return cls.fit(numpy.concatenate(infos))
+
+    def get_weight(self, src, num_gsims=1, num_sites=1):
+        """
+        :param src: a hazardlib source object
+        :param num_gsims: the number of GSIMs for the source
+        :param num_sites: the number of sites affected by the source
+        :returns:
+            the weight returned by :func:`get_weight`, multiplied by the
+            number of GSIMs and of sites and corrected with the relative
+            cost of the source class
+        """
+        coeff = self.coeffs.get(src.__class__.__name__, self.default)
+        return (get_weight(src) * num_gsims * num_sites * coeff /
+                self.default)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ', '.join(
+            '%s=%.3g' % item for item in sorted(self.coeffs.items())))
+
+
 class TrtModel(collections.Sequence):
     """
     A container for the following parameters:
@@ -249,6 +341,32 @@ def agg_prob(acc, prob):
     return 1. - (1. - acc) * (1. - prob)
 
 
+def build_array(rows, dtlist):
+    """
+    :param rows: a list of tuples
+    :param dtlist: a list of pairs (fieldname, fieldtype); the fieldtype
+                   `bytes` means a string long enough for all the rows
+    :returns: a structured array
+
+    >>> build_array([(1, 'a'), (2, 'bcd')], [('x', int), ('y', bytes)]).dtype
+    dtype([('x', '<i8'), ('y', 'S3')])
+    """
+    dt = []
+    for i, (name, fieldtype) in enumerate(dtlist):
+        if fieldtype is bytes:
+            fieldtype = (bytes, max([len(row[i]) for row in rows] or [1]))
+        dt.append((name, fieldtype))
+    return numpy.array(rows, dt)
+
+
+def decode(value):
+    """
+    :param value: a field of a record read from the datastore
+    :returns: the corresponding text string
+    """
+    return value.decode('utf8')
+
+
 class RlzsAssoc(collections.Mapping):
     """
     Realization association class. It should not be instantiated directly,
@@ -348,30 +466,33 @@ class RlzsAssoc(collections.Mapping):
                 ad[rlz] = agg(ad[rlz], value)
         return ad
 
-    def combine_gmfs(self, gmfs):
+    def combine_gmfs(self, gmfs, gmf_index):
         """
         :param gmfs: datastore /gmfs object
-        :returns: a list of dictionaries rupid -> gmf array
+        :param gmf_index: the event index of the GMFs
+        :yields: a dictionary rupid -> gmf array for each realization
+
+        The datasets are read in blocks and only the GSIM columns of
+        the current realization are kept in memory.
         """
         gsims_by_col = self.get_gsims_by_col()
-        dicts = [{} for rlz in self.realizations]
-        for col_id, gsims in enumerate(gsims_by_col):
-            try:
-                dataset = gmfs['col%02d' % col_id]
-            except KeyError:  # empty dataset
-                continue
-            trt_id = self.csm_info.get_trt_id(col_id)
-            gmfs_by_rupid = groupby(
-                dataset.value, lambda row: row['idx'], list)
-            for gsim in gsims:
-                gs = str(gsim)
-                for rlz in self.rlzs_assoc[trt_id, gs]:
-                    col_ids = self.col_ids_by_rlz[rlz]
-                    if not col_ids or col_id in col_ids:
-                        for rupid, rows in gmfs_by_rupid.items():
-                            dicts[rlz.ordinal][rupid] = numpy.array(
-                                [r[gs] for r in rows], rows[0][gs].dtype)
-        return dicts
+        for rlz in self.realizations:
+            col_ids = self.col_ids_by_rlz[rlz]
+            gmf_by_rupid = {}
+            for col_id, gsims in enumerate(gsims_by_col):
+                if col_ids and col_id not in col_ids:
+                    continue
+                try:
+                    dataset = gmfs['col%02d' % col_id]
+                except KeyError:  # empty dataset
+                    continue
+                trt_id = self.csm_info.get_trt_id(col_id)
+                for gsim in gsims:
+                    gs = str(gsim)
+                    if rlz in self.rlzs_assoc[trt_id, gs]:
+                        gmf_by_rupid.update(logictree.get_gmvs_by_rupid(
+                            dataset, gs, gmf_index, col_id))
+            yield gmf_by_rupid
 
     def combine(self, results, agg=agg_prob):
         """
@@ -444,6 +565,69 @@ class RlzsAssoc(collections.Mapping):
         return '<%s(%d)\n%s>' % (self.__class__.__name__, len(self),
                                  '\n'.join('%s: %s' % pair for pair in pairs))
 
+    def __toh5__(self):
+        # the realizations and the associations are stored as arrays,
+        # readable without unpickling; only the csm_info is pickled
+        sm_ids = {rlz: sm_id for sm_id, rlzs in enumerate(self.rlzs_by_smodel)
+                  for rlz in rlzs}
+        rlzs = build_array(
+            [(rlz.ordinal, sm_ids[rlz], ' '.join(rlz.sm_lt_path), rlz.weight,
+              '|'.join(rlz.gsim_rlz.value), float(rlz.gsim_rlz.weight),
+              ' '.join(rlz.gsim_rlz.lt_path), rlz.gsim_rlz.ordinal,
+              ' '.join(rlz.gsim_rlz.lt_uid)) for rlz in self.realizations],
+            [('ordinal', numpy.uint32), ('sm_id', numpy.uint32),
+             ('sm_lt_path', bytes), ('weight', float),
+             ('gsims', bytes), ('gsim_weight', float),
+             ('gsim_lt_path', bytes), ('gsim_ordinal', numpy.uint32),
+             ('gsim_lt_uid', bytes)])
+        assoc = build_array(
+            [(trt_id, gsim, rlz.ordinal)
+             for (trt_id, gsim), rlzs in self.rlzs_assoc.items()
+             for rlz in rlzs],
+            [('trt_id', numpy.uint32), ('gsim', bytes),
+             ('rlz', numpy.uint32)])
+        gsim_by_trt = build_array(
+            [(ordinal, trt, gsim)
+             for ordinal, dic in enumerate(self.gsim_by_trt)
+             for trt, gsim in sorted(dic.items())],
+            [('rlz', numpy.uint32), ('trt', bytes), ('gsim', bytes)])
+        col_ids = build_array(
+            [(rlz.ordinal, col_id)
+             for rlz, ids in self.col_ids_by_rlz.items()
+             for col_id in sorted(ids)],
+            [('rlz', numpy.uint32), ('col_id', numpy.uint32)])
+        return dict(realizations=rlzs, assoc=assoc, gsim_by_trt=gsim_by_trt,
+                    col_ids=col_ids, csm_info=self.csm_info), {}
+
+    def __fromh5__(self, dic, attrs):
+        self.__init__(dic['csm_info'])
+        rlzs = []
+        for rec in dic['realizations'].value:
+            gsims = decode(rec['gsims'])
+            gsim_rlz = logictree.Realization(
+                tuple(gsims.split('|')) if gsims else (),
+                float(rec['gsim_weight']),
+                tuple(decode(rec['gsim_lt_path']).split()),
+                int(rec['gsim_ordinal']),
+                tuple(decode(rec['gsim_lt_uid']).split()))
+            rlz = LtRealization(
+                int(rec['ordinal']), tuple(decode(rec['sm_lt_path']).split()),
+                gsim_rlz, float(rec['weight']))
+            self.rlzs_by_smodel[int(rec['sm_id'])].append(rlz)
+            rlzs.append(rlz)
+        for rec in dic['assoc'].value:
+            self.rlzs_assoc[int(rec['trt_id']), decode(rec['gsim'])].append(
+                rlzs[rec['rlz']])
+        self.gsim_by_trt = [{} for rlz in rlzs]
+        for rec in dic['gsim_by_trt'].value:
+            self.gsim_by_trt[rec['rlz']][decode(rec['trt'])] = decode(
+                rec['gsim'])
+        for rec in dic['col_ids'].value:
+            self.col_ids_by_rlz[rlzs[rec['rlz']]].add(int(rec['col_id']))
+        self.gsims_by_trt_id = groupby(
+            self.rlzs_assoc, operator.itemgetter(0),
+            lambda group: sorted(valid.gsim(gsim) for trt_id, gsim in group))
+
 # collection <-> trt model associations
 col_dt = numpy.dtype([('trt_id', numpy.uint32), ('sample', numpy.uint32)])
 
@@ -722,10 +906,13 @@ def filter_and_split(src, sourceprocessor):
     out = []
     weight_time = 0
     weight = 0
+    num_sites = getattr(src, 'num_sites', None)
     for ss in sourceconverter.split_source(src, sourceprocessor.asd):
+        if num_sites is not None:  # upper limit for the sub source
+            ss.num_sites = num_sites
         if sourceprocessor.weight:
             t = time.time()
-            ss.weight = get_weight(ss)
+            ss.weight = sourceprocessor.get_weight(ss)
             weight_time += time.time() - t
             weight += ss.weight
         out.append(ss)
@@ -762,11 +949,36 @@ class BaseSourceProcessor(object):
         area source discretization
     """
     weight = False  # when True, set the weight on each source
+    cost_model = None  # when set, used to compute the weights
 
     def __init__(self, sitecol, maxdist, area_source_discretization=None):
         self.sitecol = sitecol
+        self.siteidx = SiteIndex(sitecol) if sitecol else None
         self.maxdist = maxdist
         self.asd = area_source_discretization
+        self.num_gsims = {}  # trt_model_id -> number of GSIMs
+
+    def set_num_gsims(self, csm):
+        """
+        Store the number of GSIMs per TRT model, used by the cost model
+
+        :param csm: a CompositeSourceModel instance
+        """
+        for source_model in csm:
+            for trt_model in source_model.trt_models:
+                self.num_gsims[trt_model.id] = len(trt_model.gsims or ())
+
+    def get_weight(self, src):
+        """
+        :param src: a hazardlib source object
+        :returns: the weight of the source, by using the cost model if set
+        """
+        if self.cost_model is None:
+            return get_weight(src)
+        num_sites = getattr(src, 'num_sites', None) or (
+            len(self.sitecol) if self.sitecol else 1)
+        return self.cost_model.get_weight(
+            src, self.num_gsims.get(src.trt_model_id) or 1, num_sites)
 
 
 class SourceFilter(BaseSourceProcessor):
@@ -777,13 +989,15 @@ class SourceFilter(BaseSourceProcessor):
     """
     def filter(self, src):
         t0 = time.time()
-        sites = src.filter_sites_by_distance_to_source(
-            self.maxdist, self.sitecol)
+        sites = self.siteidx.filter_sites_by_distance_to_source(
+            src, self.maxdist)
         t1 = time.time()
         filter_time = t1 - t0
+        if sites is not None:  # used by the cost model
+            src.num_sites = len(sites)
         if sites is not None and self.weight:
             t2 = time.time()
-            weight = get_weight(src)
+            weight = self.get_weight(src)
             src.weight = weight
             weight_time = time.time() - t2
         else:
@@ -812,6 +1026,7 @@ class SourceFilter(BaseSourceProcessor):
         """
         sources = csm.get_sources()
         self.infos = []
+        self.set_num_gsims(csm)
         seqtime, partime = 0, 0
         sources_by_trt = AccumDict()
 
@@ -884,6 +1099,7 @@ class SourceFilterSplitter(SourceFilterWeighter):
                         if src.__class__.__name__ not in
                         ('PointSource', 'AreaSource')]
         self.infos = []
+        self.set_num_gsims(csm)
         seqtime, partime = 0, 0
         sources_by_trt = AccumDict()
 
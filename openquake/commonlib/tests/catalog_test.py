@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from openquake.commonlib.datastore import DataStore
+from openquake.commonlib.catalog import Catalog
+
+
+class CatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        # a calculation run before the catalog existed
+        dstore = DataStore(datadir=self.datadir, params=[
+            ('calculation_mode', "'classical'"), ('description', "'old'")])
+        dstore.close()
+        self.catalog = Catalog(self.datadir)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_start_finish(self):
+        [old] = self.catalog.get_calcs()  # registered by scanning
+        self.assertEqual((old.calc_id, old.calculation_mode, old.status),
+                         (1, 'classical', 'incomplete'))
+        dstore = DataStore(datadir=self.datadir)
+        self.catalog.start(dstore.calc_id, 'scenario', 'new')
+        self.assertEqual(self.catalog.get_calcs()[-1].status, 'executing')
+        self.catalog.finish(dstore.calc_id, 'complete', 1024)
+        new = self.catalog.get_calcs()[-1]
+        self.assertEqual((new.calc_id, new.status, new.size),
+                         (2, 'complete', 1024))
+        self.assertGreaterEqual(new.stop_time, new.start_time)
+        self.assertEqual(self.catalog.get_calc_id(-1), 2)
+        dstore.clear()  # the removed calculations are not listed
+        self.assertEqual(self.catalog.get_calc_ids(), [1])
+        with self.assertRaises(IndexError):
+            self.catalog.get_calc_id(-2)
+
+    def test_fingerprint(self):
+        dstore = DataStore(datadir=self.datadir)
+        self.catalog.start(dstore.calc_id, 'classical', 'hazard')
+        self.catalog.set_fingerprint(dstore.calc_id, 'abc')
+        self.assertIsNone(self.catalog.find('abc'))  # not complete yet
+        self.catalog.finish(dstore.calc_id, 'complete', 1024)
+        self.assertEqual(self.catalog.find('abc'), 2)
+        self.assertIsNone(self.catalog.find('xyz'))
+        dstore.clear()  # the removed calculations cannot be reused
+        self.assertIsNone(self.catalog.find('abc'))
@@ -10,6 +10,8 @@ from openquake.commonlib.commands.show import show
 from openquake.commonlib.commands.export import export
 from openquake.commonlib.commands.reduce import reduce
 from openquake.commonlib.commands.run import run
+from openquake.commonlib.commands.benchmark import benchmark
+from openquake.commonlib.commands.benchmark_writes import benchmark_writes
 from openquake.qa_tests_data.classical import case_1
 from openquake.qa_tests_data.classical_risk import case_3
 from openquake.qa_tests_data.scenario import case_4
@@ -111,6 +113,22 @@ lon:float64:,lat:float64:
         shutil.rmtree(tempdir)
 
 
+class BenchmarkTestCase(unittest.TestCase):
+    def test_classical(self):
+        job_ini = os.path.join(os.path.dirname(case_1.__file__), 'job.ini')
+        with Print.patch() as p:
+            benchmark(job_ini, 'threadpool,no')
+        self.assertIn('threadpool', str(p))
+        self.assertIn('time_sec', str(p))
+
+
+class BenchmarkWritesTestCase(unittest.TestCase):
+    def test_small(self):
+        with Print.patch() as p:
+            benchmark_writes(num_blocks=10, flush_threshold='0,1024')
+        self.assertIn('throughput', str(p))
+
+
 class ReduceTestCase(unittest.TestCase):
     TESTDIR = os.path.dirname(case_3.__file__)
 
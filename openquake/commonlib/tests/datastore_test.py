@@ -1,7 +1,11 @@
+import os
 import re
 import unittest
 import numpy
-from openquake.commonlib.datastore import DataStore, view
+from openquake.baselib.python3compat import pickle
+from openquake.commonlib import datastore
+from openquake.commonlib.datastore import (
+    DataStore, DatasetRef, LazyArray, view, persistent_attribute)
 
 
 @view.add('key1_upper')
@@ -9,6 +13,47 @@ def view_key1_upper(key, dstore):
     return dstore['key1'].upper()
 
 
+class Point(object):
+    # an object stored natively in the datastore
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __toh5__(self):
+        return numpy.array([self.x, self.y]), dict(name='point')
+
+    def __fromh5__(self, array, attrs):
+        self.x, self.y = array.value
+        self.name = attrs['name']
+
+
+class Pair(object):
+    # an object without the __toh5__ protocol, stored via a converter
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+
+def pair_toh5(pair):
+    return dict(a=numpy.array(pair.a), b=numpy.array(pair.b)), dict(n=2)
+
+
+def pair_fromh5(data, attrs):
+    pair = Pair(data['a'].value, data['b'].value)
+    pair.n = attrs['n']
+    return pair
+
+datastore.register_h5(Pair, pair_toh5, pair_fromh5)
+
+
+class Store(object):
+    a = persistent_attribute('a')
+    b = persistent_attribute('b')
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+
+
 class DataStoreTestCase(unittest.TestCase):
     def setUp(self):
         self.dstore = DataStore()
@@ -57,6 +102,143 @@ class DataStoreTestCase(unittest.TestCase):
         self.dstore['a/b'] = 42
         self.assertTrue('a/b' in self.dstore)
 
+    def test_extend(self):
+        dset = self.dstore.create_dset('dset', float)
+        dset.flush_threshold = 80  # 10 floats
+        dset.extend(numpy.arange(5.))
+        self.assertEqual(self.dstore.hdf5['dset'].shape, (0,))  # buffered
+        dset.extend(numpy.arange(5.))
+        self.assertEqual(self.dstore.hdf5['dset'].shape, (10,))
+        dset.extend(numpy.arange(3.))
+        # the buffers are flushed before reading
+        numpy.testing.assert_equal(self.dstore['dset'][10:], [0, 1, 2])
+        self.assertEqual(self.dstore['dset'].attrs['nbytes'], 104)
+        self.assertEqual(self.dstore['dset'].chunks, (32768,))
+
+        dset = self.dstore.create_dset('dset2', float, expected_rows=100)
+        self.assertEqual(self.dstore['dset2'].chunks, (100,))
+
+    def test_filters(self):
+        self.dstore.filters = [('gmfs/*', dict(compression='gzip',
+                                               shuffle=True))]
+        self.dstore.create_dset('gmfs/col00', float)
+        self.dstore.create_dset('gmfs/col01', float, compression='lzf')
+        self.dstore['gmfs/col02'] = numpy.zeros(100)
+        self.dstore['curves'] = numpy.zeros(100)
+        self.dstore.set('maps', numpy.zeros(100), compression='lzf')
+        self.dstore['gmfs/info'] = 'pickled'
+        hdf5 = self.dstore.hdf5
+        self.assertEqual(hdf5['gmfs/col00'].compression, 'gzip')
+        self.assertTrue(hdf5['gmfs/col00'].shuffle)
+        self.assertEqual(hdf5['gmfs/col01'].compression, 'lzf')
+        self.assertEqual(hdf5['gmfs/col02'].compression, 'gzip')
+        self.assertIsNone(hdf5['curves'].compression)
+        self.assertEqual(hdf5['maps'].compression, 'lzf')
+        self.assertEqual(self.dstore['gmfs/info'], 'pickled')
+        numpy.testing.assert_equal(self.dstore['gmfs/col02'][:], 0)
+
+    def test_toh5(self):
+        self.dstore['point'] = Point(1, 2)
+        self.dstore['points'] = dict(a=Point(3, 4))  # pickled
+        numpy.testing.assert_equal(self.dstore.hdf5['point'].value, [1, 2])
+        point = self.dstore['point']
+        self.assertEqual((point.x, point.y, point.name), (1, 2, 'point'))
+        self.assertEqual(self.dstore['points']['a'].y, 4)
+
+    def test_register_h5(self):
+        self.dstore['pair'] = Pair([1, 2], [3])
+        self.assertEqual(self.dstore.hdf5['pair'].attrs['__pyfunc__'],
+                         '%s.pair_fromh5' % __name__)
+        numpy.testing.assert_equal(self.dstore.hdf5['pair/b'].value, [3])
+        pair = self.dstore['pair']
+        numpy.testing.assert_equal(pair.a, [1, 2])
+        self.assertEqual(pair.n, 2)
+
+    def test_repack(self):
+        for i in range(3):  # overwrite the same key, wasting space
+            self.dstore['a'] = numpy.arange(100000.)
+        dset = self.dstore.create_dset('gmfs/col00', float)
+        dset.extend(numpy.zeros(1000))
+        self.dstore['gmfs'].attrs['nbytes'] = 8000
+        self.dstore.filters = [('gmfs/*', dict(compression='gzip'))]
+        before, after = self.dstore.repack()
+        self.assertLess(after, before)
+        numpy.testing.assert_equal(self.dstore['a'][:], numpy.arange(100000.))
+        gmfs = self.dstore['gmfs/col00']
+        self.assertEqual(gmfs.compression, 'gzip')
+        self.assertEqual(gmfs.chunks, (1000,))
+        self.assertEqual(gmfs.attrs['nbytes'], 8000)
+        self.assertEqual(self.dstore['gmfs'].attrs['nbytes'], 8000)
+
+    def test_repack_closed(self):
+        self.dstore['a'] = numpy.arange(10.)
+        self.dstore.close()
+        handle = datastore.read_only(self.dstore.hdf5path)
+        datastore.repack(self.dstore.hdf5path)
+        self.assertFalse(handle)  # the cached handle was closed
+        ref = DatasetRef(self.dstore.hdf5path, 'a')
+        numpy.testing.assert_equal(ref[:3], [0., 1., 2.])
+
+    def test_read_only(self):
+        self.dstore['gmfs'] = numpy.arange(10.)
+        self.dstore.close()
+        parent = DataStore(self.dstore.calc_id, mode='r')
+        ref = pickle.loads(pickle.dumps(
+            DatasetRef.from_dset(parent['gmfs'])))
+        numpy.testing.assert_equal(ref[2:4], [2., 3.])
+        self.assertEqual(len(ref), 10)
+        self.assertEqual(ref.dtype, numpy.float64)
+        parent.close()
+
+    def test_snapshot(self):
+        self.dstore['gmfs/col00'] = numpy.arange(10.)
+        path = self.dstore.snapshot('gmfs/col00')
+        ref = DatasetRef(path, 'gmfs/col00')
+        numpy.testing.assert_equal(ref[2:4], [2., 3.])
+        self.dstore.close()  # the snapshot is removed
+        self.assertFalse(os.path.exists(path))
+
+    def test_lazy_array(self):
+        gmf_dt = numpy.dtype([('idx', numpy.uint32), ('PGA', float, 2)])
+        gmfs = numpy.zeros(10, gmf_dt)
+        gmfs['idx'] = numpy.arange(10)
+        gmfs['PGA'][:, 1] = 0.1
+        self.dstore['gmfs'] = gmfs
+        array = LazyArray(self.dstore['gmfs'])
+        self.assertEqual(array.shape, (10,))
+        idx = array['idx'][2:]
+        self.assertEqual(len(idx), 8)
+        self.assertEqual(idx[-1], 9)
+        # blocks of 3 rows of 20 bytes each
+        blocks = list(idx.blocks(nbytes=60))
+        self.assertEqual(list(map(len, blocks)), [3, 3, 2])
+        numpy.testing.assert_equal(numpy.concatenate(blocks), range(2, 10))
+        pga = array[['PGA']][:2].read()
+        self.assertEqual(pga.dtype.names, ('PGA',))
+        numpy.testing.assert_equal(pga['PGA'], [[0, 0.1], [0, 0.1]])
+        column = array['idx'].reshape((10, 1))
+        numpy.testing.assert_equal(list(column)[3], [3])
+        with self.assertRaises(ValueError):
+            array[::2]
+
+    def test_attribute_cache(self):
+        store = Store(self.dstore)
+        cache = self.dstore.cache
+        cache.maxbytes = 1000
+        store.a = numpy.zeros(100)  # 800 bytes
+        self.assertEqual(list(cache.values), ['a'])
+        store.b = numpy.ones(100)  # 'a' is evicted
+        self.assertEqual(list(cache.values), ['b'])
+        self.assertEqual(cache.nbytes, 800)
+        self.assertEqual(cache.max_nbytes, 1600)
+        # 'a' is read again from the datastore, lazily
+        self.assertEqual(store.a[5], 0)
+        self.assertEqual(list(cache.values), ['b', 'a'])
+        self.assertEqual(cache.nbytes, 800)
+        cache.release('b', 'c')
+        self.assertEqual(list(cache.values), ['a'])
+        self.assertEqual(store.b[5], 1)
+
     def test_parent(self):
         # copy the attributes of the parent datastore on the child datastore,
         # without overriding the attributes with the same name
@@ -35,7 +35,8 @@ from mock import Mock
 
 import openquake.hazardlib
 from openquake.baselib.general import writetmp
-from openquake.commonlib import logictree, readinput, tests, source, valid
+from openquake.commonlib import (
+    logictree, readinput, tests, source, valid, datastore)
 from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.pmf import PMF
 from openquake.hazardlib.mfd import TruncatedGRMFD, EvenlyDiscretizedMFD
@@ -1925,3 +1926,36 @@ class LogicTreeProcessorParsePathTestCase(unittest.TestCase):
         self.assertIn('ParseError:', msg)
         # make sure the file name is in the error message
         self.assertIn('source_model_logic_tree.xml', msg)
+
+
+class GmfIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dstore = datastore.DataStore()
+        gmf_dt = numpy.dtype([('b1', [('PGA', float)]), ('idx', numpy.uint32)])
+        gmfs = numpy.zeros(5, gmf_dt)
+        gmfs['idx'] = [2, 2, 0, 0, 0]
+        gmfs['b1']['PGA'] = numpy.arange(5)
+        self.dstore['gmfs/col00'] = gmfs
+        self.dstore['tags'] = numpy.array(['a', 'b', 'c'], (bytes, 100))
+
+    def tearDown(self):
+        self.dstore.clear()
+
+    def test_index(self):
+        index = logictree.get_gmf_index(self.dstore)  # built on the fly
+        self.dstore['gmf_index'] = index
+        index = logictree.get_gmf_index(self.dstore)  # stored
+        self.assertEqual(list(index['start']), [2, 0, 0])
+        self.assertEqual(list(index['stop']), [5, 0, 2])
+        gmvs = logictree.get_gmvs_by_rupid(
+            self.dstore['gmfs/col00'], 'b1', index)
+        self.assertEqual(sorted(gmvs), [0, 2])
+        self.assertEqual(list(gmvs[0]['PGA']), [2, 3, 4])
+        self.assertEqual(list(gmvs[2]['PGA']), [0, 1])
+
+    def test_site_index(self):
+        rows, index = datastore.build_index(numpy.array([1, 0, 1, 0, 1]), 2)
+        self.dstore['gmfs_by_site/col00/rows'] = rows
+        self.dstore['gmfs_by_site/col00/index'] = index
+        gmfs = logictree.get_site_gmfs(self.dstore, 0, 1)
+        self.assertEqual(list(gmfs['b1']['PGA']), [0, 2, 4])
@@ -223,3 +223,28 @@ class OqParamTestCase(unittest.TestCase):
         self.assertIn("Please set a value for 'reference_vs30_value', this is"
                       " required by the GSIM AbrahamsonSilva1997",
                       str(ctx.exception))
+
+    def test_hazard_fingerprint(self):
+        def oqparam(**kw):
+            params = dict(
+                calculation_mode='event_based', inputs={},
+                sites='0.1 0.2', maximum_distance=400,
+                intensity_measure_types_and_levels="{'PGA': [0.1, 0.2]}",
+                investigation_time='50', random_seed='42')
+            params.update(kw)
+            return OqParam(**params)
+        fingerprint = oqparam().hazard_fingerprint('event_based')
+        # the hazard parameters change the fingerprint
+        self.assertNotEqual(
+            oqparam(random_seed='43').hazard_fingerprint('event_based'),
+            fingerprint)
+        self.assertNotEqual(
+            oqparam(investigation_time='1').hazard_fingerprint('event_based'),
+            fingerprint)
+        # the risk parameters, the description and the parameters set
+        # to their default do not change the fingerprint
+        self.assertEqual(
+            oqparam(conditional_loss_poes='0.1', description='risk',
+                    insured_losses='true', ses_per_logic_tree_path='1',
+                    ).hazard_fingerprint('event_based'),
+            fingerprint)
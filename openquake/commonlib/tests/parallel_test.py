@@ -1,3 +1,4 @@
+import os
 import unittest
 import numpy
 from openquake.commonlib import parallel
@@ -7,6 +8,10 @@ def get_length(data):
     return {'n': len(data)}
 
 
+def get_length_plus(data, array):
+    return {'n': len(data) + len(array)}
+
+
 @parallel.litetask
 def get_len(data, monitor):
     with monitor:
@@ -15,6 +20,12 @@ def get_len(data, monitor):
     return result
 
 
+@parallel.litetask
+def count_items(data, monitor):
+    with monitor('counting'):
+        return {'n': len(data)}
+
+
 class TaskManagerTestCase(unittest.TestCase):
     monitor = parallel.DummyMonitor()
 
@@ -35,6 +46,17 @@ class TaskManagerTestCase(unittest.TestCase):
         self.assertEqual(parallel.apply_reduce._chunks,
                          [['a', 'a', 'a'], ['b', 'b']])
 
+    def test_apply_reduce_adaptive(self):
+        data = list(range(100))
+        res = parallel.apply_reduce(
+            count_items, (data, self.monitor), concurrent_tasks=8,
+            key=lambda i: i % 2, adaptive=True)
+        self.assertEqual(res, {'n': 100})
+        chunks = parallel.apply_reduce._chunks
+        self.assertEqual(sorted(sum(chunks, [])), data)
+        for chunk in chunks:  # the kinds of items are not mixed
+            self.assertEqual(len(set(i % 2 for i in chunk)), 1)
+
     def test_spawn(self):
         all_data = [
             ('a', list(range(10))), ('b', list(range(20))),
@@ -46,6 +68,136 @@ class TaskManagerTestCase(unittest.TestCase):
         parallel.TaskManager.restart()
         self.assertEqual(res, {'a': {'n': 10}, 'c': {'n': 15}, 'b': {'n': 20}})
 
+    def test_broadcast(self):
+        array = numpy.arange(1000)
+        tm = parallel.TaskManager(get_length_plus, broadcast=[array])
+        tm.broadcast_threshold = 0
+        piks1 = tm.pickle_args(('a', array))
+        piks2 = tm.pickle_args(('bc', array))
+        handle = piks1[1]
+        self.assertIsInstance(handle, parallel.Broadcast)
+        self.assertIs(piks2[1], handle)
+        self.assertEqual(piks2[0].unpickle(), 'bc')
+        numpy.testing.assert_equal(handle.unpickle(), array)
+        self.assertEqual(tm.broadcast_saved, handle.size - len(handle))
+        tm.clean_up()
+        self.assertFalse(os.path.exists(handle.fname))
+
+    def test_apply_reduce_broadcast(self):
+        res = parallel.apply_reduce(
+            get_length_plus, (numpy.arange(10), numpy.arange(5)),
+            concurrent_tasks=3)
+        self.assertEqual(res, {'n': 25})
+
+    def test_out_of_band(self):
+        array = numpy.arange(300000)  # 2.4 MB
+        pik = parallel.Pickled({'array': array, 'x': 1}, oob=True)
+        self.assertEqual(len(pik.fnames), 1)
+        self.assertLess(len(pik), 1000)  # the array is not in the pickle
+        dic = pik.unpickle()
+        numpy.testing.assert_equal(dic['array'], array)
+        dic['array'][0] = 42  # the changes are private
+        numpy.testing.assert_equal(pik.unpickle()['array'], array)
+        pik.remove()
+        self.assertFalse(os.path.exists(pik.fnames[0]))
+        self.assertEqual(dic['array'][1], 1)  # still valid
+
+    def test_apply_reduce_out_of_band(self):
+        res = parallel.apply_reduce(
+            get_length_plus, (numpy.arange(10), numpy.zeros(300000)),
+            concurrent_tasks=3)
+        self.assertEqual(res, {'n': 900010})
+
+    def test_compression(self):
+        array = numpy.zeros(300000)
+        orig = parallel.Pickled.compression
+        try:
+            parallel.Pickled.compression = 'zlib'
+            pik = parallel.Pickled(array, oob=True)
+            self.assertEqual(pik.compressed, 'zlib')
+            self.assertEqual(pik.fnames, [])  # compressed in band
+            self.assertGreater(pik.ratio, 100)
+            self.assertEqual(pik.nbytes, len(pik) * pik.ratio)
+            numpy.testing.assert_equal(pik.unpickle(), array)
+
+            # small objects are not compressed
+            self.assertIsNone(parallel.Pickled('ab').compressed)
+
+            parallel.Pickled.compression = 'gzip'
+            with self.assertRaises(ValueError):
+                parallel.Pickled(array)
+        finally:
+            parallel.Pickled.compression = orig
+
+    def test_distribute(self):
+        for distribute in ('processpool', 'threadpool', 'no'):
+            res = parallel.apply_reduce(
+                get_length_plus, (numpy.arange(10), numpy.arange(5)),
+                concurrent_tasks=3, distribute=distribute)
+            self.assertEqual(res, {'n': 25})
+        with self.assertRaises(ValueError):
+            parallel.starmap(get_length, [('ab',)], distribute='celery')
+
+    def test_starmap_in_flight(self):
+        all_args = [(list(range(i)),) for i in range(10)]
+        tm = parallel.starmap(get_length, all_args, in_flight=2)
+        self.assertEqual(len(tm.results), 2)
+        self.assertEqual(len(tm.todo), 8)
+        self.assertEqual(tm.reduce(), {'n': 45})
+        self.assertEqual(tm.submitted, 10)
+
+    def test_memory_budget(self):
+        class ThrottledManager(parallel.TaskManager):
+            mem_budget = 0  # always over budget
+        all_args = [(list(range(i)),) for i in range(10)]
+        tm = ThrottledManager.starmap(
+            get_length, all_args, result_nbytes=lambda args: len(args[0]))
+        self.assertEqual(len(tm.results), 1)  # a single task in flight
+        flushed = []
+
+        def flush(acc):
+            flushed.append(acc['n'])
+            return acc
+        self.assertEqual(tm.reduce(flush=flush), {'n': 45})
+        self.assertTrue(tm.throttled)
+        self.assertEqual(len(flushed), 9)
+        self.assertEqual(tm.pending_nbytes, 0)
+
+    def test_recycle_workers(self):
+        class RecyclingManager(parallel.TaskManager):
+            executor = parallel.ProcessPoolExecutor(2)
+            max_tasks_per_worker = 2
+            _pool_tasks = 0
+            _pool_rss = None
+        try:
+            tm = RecyclingManager.starmap(
+                get_length, [(list(range(i)),) for i in range(3)])
+            self.assertEqual(tm.reduce(), {'n': 3})
+            self.assertEqual(len(RecyclingManager._pool_rss), 2)  # warm
+            self.assertEqual(RecyclingManager._pool_tasks, 3)
+            self.assertFalse(RecyclingManager.recycle_if_needed())
+            tm = RecyclingManager.starmap(get_length, [('a',)])
+            self.assertEqual(tm.reduce(), {'n': 1})
+            executor = RecyclingManager.executor
+            self.assertTrue(RecyclingManager.recycle_if_needed())
+            self.assertIsNot(RecyclingManager.executor, executor)
+            self.assertEqual(RecyclingManager._pool_tasks, 0)
+        finally:
+            RecyclingManager.executor.shutdown()
+
+    def test_warm_up_timeout(self):
+        class SlowManager(parallel.TaskManager):
+            executor = parallel.ProcessPoolExecutor(2)
+            warm_up_timeout = 0  # the workers cannot start in time
+            _pool_tasks = 0
+            _pool_rss = None
+        try:
+            SlowManager.warm_up()  # does not raise
+            tm = SlowManager.starmap(get_length, [('abc',)])
+            self.assertEqual(tm.reduce(), {'n': 3})
+        finally:
+            SlowManager.executor.shutdown()
+
     def test_litetask(self):
         # signature preservation
         self.assertEqual(get_len.__code__.co_varnames, ('data', 'monitor'))
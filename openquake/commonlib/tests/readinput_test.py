@@ -22,11 +22,12 @@ import tempfile
 import mock
 import unittest
 import collections
+import numpy
 from io import BytesIO, StringIO
 
 from numpy.testing import assert_allclose
 
-from openquake.commonlib import readinput, valid, writers
+from openquake.commonlib import readinput, valid, writers, datastore
 from openquake.baselib import general
 
 TMP = tempfile.gettempdir()
@@ -249,6 +250,34 @@ class ClosestSiteModelTestCase(unittest.TestCase):
             'came from a distance of 111 km!')
 
 
+class SiteCollectionToh5TestCase(unittest.TestCase):
+
+    def test_store_sitecol(self):
+        oqparam = mock.Mock()
+        oqparam.base_path = '/'
+        oqparam.sites = [(0.0, 0.0), (0.0, 0.1), (0.0, 0.2)]
+        oqparam.inputs = dict(site_model=sitemodel())
+        sitecol = readinput.get_site_collection(oqparam)
+        filtered = sitecol.filter(numpy.array([True, False, True]))
+        dstore = datastore.DataStore()
+        try:
+            dstore['sitecol'] = sitecol
+            dstore['filtered'] = filtered
+            # the site parameters are readable without unpickling
+            assert_allclose(dstore.hdf5['sitecol']['vs30'],
+                            [1200., 600., 200.])
+            col = dstore['sitecol']
+            assert_allclose(col.lats, sitecol.lats)
+            assert_allclose(col.vs30, sitecol.vs30)
+            self.assertEqual(list(col.backarc), [False, True, False])
+            col = dstore['filtered']
+            self.assertEqual(list(col.indices), [0, 2])
+            assert_allclose(col.vs30, [1200., 200.])
+            self.assertEqual(len(col.complete), 3)
+        finally:
+            dstore.clear()
+
+
 class ExposureTestCase(unittest.TestCase):
     exposure = general.writetmp('''\
 <?xml version='1.0' encoding='UTF-8'?>
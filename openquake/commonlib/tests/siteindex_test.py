@@ -0,0 +1,65 @@
+import pickle
+import unittest
+import numpy
+from openquake.hazardlib.geo.geodetic import geodetic_distance
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.polygon import Polygon
+from openquake.commonlib.siteindex import SiteIndex
+
+
+class FakeSource(object):
+    # a source counting how many times its polygon is built
+    def __init__(self, polygon):
+        self.polygon = polygon
+        self.num_polygons = 0
+
+    def get_rupture_enclosing_polygon(self, maxdist):
+        self.num_polygons += 1
+        return self.polygon.dilate(maxdist)
+
+
+class SiteIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.lons = rng.uniform(-10, 10, 1000)
+        self.lats = rng.uniform(35, 55, 1000)
+        self.sitecol = SiteCollection(
+            [Site(Point(lon, lat), 760., True, 100., 5.)
+             for lon, lat in zip(self.lons, self.lats)])
+
+    def test_candidates_are_a_superset(self):
+        index = SiteIndex(self.sitecol)
+        vlons = numpy.array([0, 1, 1, 0])
+        vlats = numpy.array([45, 45, 46, 46])
+        for maxdist in (0, 50, 200, 500):
+            cands = set(index.get_candidates(vlons, vlats, maxdist))
+            dists = numpy.array([
+                geodetic_distance(self.lons, self.lats, lon, lat)
+                for lon, lat in zip(vlons, vlats)]).min(axis=0)
+            close = set(numpy.where(dists <= maxdist)[0])
+            self.assertTrue(close <= cands)
+            self.assertLess(len(cands), len(self.sitecol))
+
+    def test_prefilter_far_away(self):
+        index = SiteIndex(self.sitecol)
+        self.assertIsNone(index.prefilter([120], [-30], 100))
+
+    def test_filter_by_source(self):
+        index = SiteIndex(self.sitecol)
+        src = FakeSource(Polygon([Point(0, 45), Point(1, 45),
+                                  Point(1, 46), Point(0, 46)]))
+        sites = index.filter_sites_by_distance_to_source(src, 100)
+        self.assertEqual(src.num_polygons, 1)
+        poly = src.polygon.dilate(100)
+        expected = self.sitecol.filter(poly.intersects(self.sitecol.mesh))
+        numpy.testing.assert_equal(sites.indices, expected.indices)
+
+    def test_pickle(self):
+        index = SiteIndex(self.sitecol)
+        index.tree  # build the tree
+        new = pickle.loads(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+        self.assertIn('_tree', vars(new))  # not rebuilt
+        numpy.testing.assert_equal(
+            new.get_candidates([0, 1], [45, 46], 50),
+            index.get_candidates([0, 1], [45, 46], 50))
@@ -15,9 +15,12 @@
 
 import os
 import mock
+import shutil
+import tempfile
 import unittest
 from io import StringIO, BytesIO
 
+import h5py
 import numpy
 from numpy.testing import assert_allclose
 
@@ -30,8 +33,10 @@ from openquake.hazardlib import source
 from openquake.hazardlib.tom import PoissonTOM
 
 from openquake.commonlib import tests, nrml_examples, readinput
+from openquake.commonlib.datastore import DataStore
 from openquake.commonlib import sourceconverter as s
-from openquake.commonlib.source import parse_source_model, DuplicatedID
+from openquake.commonlib.source import (
+    parse_source_model, DuplicatedID, CostModel, BaseSourceProcessor)
 from openquake.commonlib.nrml import nodefactory
 from openquake.commonlib.node import read_nodes
 from openquake.baselib.general import assert_close
@@ -693,6 +698,70 @@ class TrtModelTestCase(unittest.TestCase):
             '<TrtModel #0 Active Shallow Crust, 2 source(s), 0 rupture(s)>')
 
 
+class PointSource(object):
+    """Fake source with 400 ruptures"""
+    def count_ruptures(self):
+        return 400
+
+
+class SimpleFaultSource(PointSource):
+    """Fake source with 400 ruptures"""
+
+
+class CostModelTestCase(unittest.TestCase):
+    def setUp(self):
+        # the simple fault sources are twice as slow as the point sources
+        self.infos = numpy.array(
+            [(0, b'a', b'PointSource', 10, 2, 100, 2),
+             (0, b'b', b'PointSource', 20, 2, 100, 4),
+             (1, b'c', b'SimpleFaultSource', 5, 1, 100, 1),
+             (1, b'd', b'ComplexFaultSource', 0, 1, 100, 3)],
+            numpy.dtype([('trt_model_id', numpy.uint32),
+                         ('source_id', (bytes, 20)),
+                         ('source_class', (bytes, 20)),
+                         ('weight', numpy.float32),
+                         ('num_gsims', numpy.uint32),
+                         ('num_sites', numpy.uint32),
+                         ('calc_time', numpy.float32)]))
+
+    def test_fit(self):
+        model = CostModel.fit(self.infos)
+        self.assertEqual(sorted(model.coeffs), ['PointSource',
+                                                'SimpleFaultSource'])
+        assert_close(model.coeffs['PointSource'], 0.001)
+        assert_close(model.coeffs['SimpleFaultSource'], 0.002)
+        assert_close(model.default, 7 / 6500.)
+        # the weight of a point source is num_ruptures / 40
+        self.assertAlmostEqual(model.get_weight(PointSource(), 2),
+                               20 * 6.5 / 7)
+        self.assertAlmostEqual(model.get_weight(SimpleFaultSource()),
+                               400 * 13 / 7.)
+
+    def test_num_sites(self):
+        model = CostModel.fit(self.infos)
+        few, many = PointSource(), PointSource()
+        few.num_sites, many.num_sites = 1, 10000
+        few.trt_model_id = many.trt_model_id = 0
+        processor = BaseSourceProcessor(None, 100)
+        processor.cost_model = model
+        self.assertAlmostEqual(processor.get_weight(many),
+                               processor.get_weight(few) * 10000)
+        self.assertAlmostEqual(model.get_weight(PointSource(), 2, 100),
+                               2000 * 6.5 / 7)
+
+    def test_from_datadir(self):
+        datadir = tempfile.mkdtemp()
+        with h5py.File(os.path.join(datadir, 'calc_1.hdf5'), 'w') as f:
+            f['source_info'] = self.infos
+        with h5py.File(os.path.join(datadir, 'calc_2.hdf5'), 'w') as f:
+            pass  # a calculation without source_info
+        model = CostModel.from_datadir(datadir)
+        self.assertEqual(sorted(model.coeffs), ['PointSource',
+                                                'SimpleFaultSource'])
+        shutil.rmtree(datadir)
+        self.assertIsNone(CostModel.from_datadir(datadir))
+
+
 class RuptureConverterTestCase(unittest.TestCase):
 
     def test_well_formed_ruptures(self):
@@ -829,3 +898,17 @@ Subduction Interface,b3,SadighEtAl1997,w=1.0>''')
         self.assertEqual(col_ids_first, set([0]))
         col_ids_last = assoc.get_col_ids(assoc.realizations[-1])
         self.assertEqual(col_ids_last, set([4]))
+
+        # test the storage in the datastore, without pickling the assoc
+        tmpdir = tempfile.mkdtemp()
+        dstore = DataStore(datadir=tmpdir)
+        try:
+            dstore['rlzs_assoc'] = assoc
+            self.assertEqual(len(dstore['rlzs_assoc/realizations']), 5)
+            new = dstore['rlzs_assoc']
+            self.assertEqual(str(new), str(assoc))
+            self.assertEqual(new.get_col_ids(new.realizations[-1]), set([4]))
+            self.assertEqual(new.gsim_by_trt, assoc.gsim_by_trt)
+        finally:
+            dstore.clear()
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,107 @@
+import os
+import mock
+import socket
+import unittest
+import multiprocessing
+from openquake.commonlib import workqueue, parallel
+
+AUTHKEY = b'test'
+
+
+def double(x):
+    return 2 * x
+
+
+def get_length(data):
+    return {'n': len(data)}
+
+
+def start_worker(address):
+    proc = multiprocessing.Process(
+        target=workqueue.run_worker, args=(address, AUTHKEY, 0.2))
+    proc.daemon = True
+    proc.start()
+    return proc
+
+
+class WorkQueueTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = workqueue.WorkQueueExecutor(
+            ('localhost', 0), AUTHKEY, timeout=1)
+        cls.worker = start_worker(cls.executor.address)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.worker.terminate()
+        cls.executor.shutdown()
+
+    def test_submit(self):
+        futures = [self.executor.submit(double, i) for i in range(5)]
+        self.assertEqual([f.result(10) for f in futures], [0, 2, 4, 6, 8])
+
+    def test_error(self):
+        future = self.executor.submit(double, None)
+        with self.assertRaises(RuntimeError):
+            future.result(10)
+
+    def test_apply_reduce(self):
+        orig = parallel.TaskManager.workqueue_executor
+        parallel.TaskManager.workqueue_executor = self.executor
+        try:
+            res = parallel.apply_reduce(
+                get_length, ('abcdefghij',), concurrent_tasks=3,
+                distribute='workqueue')
+        finally:
+            parallel.TaskManager.workqueue_executor = orig
+        self.assertEqual(res, {'n': 10})
+
+
+class ResubmitTestCase(unittest.TestCase):
+    def test_lost_worker(self):
+        executor = workqueue.WorkQueueExecutor(
+            ('localhost', 0), AUTHKEY, timeout=1)
+        future = executor.submit(double, 21)
+        # a worker taking the task and dying without sending heartbeats
+        task_id, _ = executor.broker.fetch('dead-worker', 0)
+        worker = start_worker(executor.address)
+        try:
+            self.assertEqual(future.result(10), 42)
+        finally:
+            worker.terminate()
+            executor.shutdown()
+
+
+class ShutdownTestCase(unittest.TestCase):
+    def test_shutdown(self):
+        executor = workqueue.WorkQueueExecutor(
+            ('localhost', 0), AUTHKEY, timeout=1)
+        worker = start_worker(executor.address)
+        try:
+            self.assertEqual(executor.submit(double, 1).result(10), 2)
+        finally:
+            worker.terminate()
+            executor.shutdown()
+        self.assertFalse(any(t.is_alive() for t in executor._threads))
+        # the master is not listening anymore
+        with self.assertRaises(socket.error):
+            socket.create_connection(executor.address, 1)
+
+    def test_shutdown_workqueue(self):
+        tm = parallel.TaskManager
+        orig = tm.workqueue_executor
+        tm.workqueue_executor = executor = workqueue.WorkQueueExecutor(
+            ('localhost', 0), AUTHKEY, timeout=1)
+        try:
+            tm.shutdown_workqueue()
+            self.assertIsNone(tm.workqueue_executor)
+        finally:
+            tm.workqueue_executor = orig
+        self.assertFalse(any(t.is_alive() for t in executor._threads))
+
+    def test_authkey(self):
+        with mock.patch.dict(os.environ, OQ_WORKQUEUE_AUTHKEY=''):
+            with self.assertRaises(ValueError):
+                workqueue.get_authkey()
+        with mock.patch.dict(os.environ, OQ_WORKQUEUE_AUTHKEY='secret'):
+            self.assertEqual(workqueue.get_authkey(), b'secret')
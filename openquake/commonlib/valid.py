@@ -611,6 +611,53 @@ def dictionary(value):
     return dic
 
 
+def hdf5_filters(value):
+    """
+    :param value:
+        input string with comma-separated rules `pattern: filter ...`;
+        the pattern is matched against the dataset names and the filters
+        can be gzip (or gzip0 ... gzip9), lzf, shuffle or none
+    :returns:
+        a list of pairs (pattern, dictionary of h5py filter options)
+
+    >>> hdf5_filters('')
+    []
+    >>> hdf5_filters('gmfs/*: lzf, *: none')
+    [('gmfs/*', {'compression': 'lzf'}), ('*', {})]
+    >>> sorted(hdf5_filters('rcurves-*: gzip6 shuffle')[0][1].items())
+    [('compression', 'gzip'), ('compression_opts', 6), ('shuffle', True)]
+    >>> hdf5_filters('gmfs/*: bzip2')
+    Traceback (most recent call last):
+       ...
+    ValueError: Unknown HDF5 filter bzip2 in 'gmfs/*: bzip2'
+    """
+    rules = []
+    for rule in value.split(','):
+        if not rule.strip():
+            continue
+        try:
+            pattern, names = rule.split(':')
+        except ValueError:
+            raise ValueError('Invalid rule %r in %r' % (rule, value))
+        filters = {}
+        for name in names.split():
+            mo = re.match(r'gzip(\d)?$', name)
+            if mo:
+                filters['compression'] = 'gzip'
+                if mo.group(1):
+                    filters['compression_opts'] = int(mo.group(1))
+            elif name == 'lzf':
+                filters['compression'] = 'lzf'
+                filters.pop('compression_opts', None)
+            elif name == 'shuffle':
+                filters['shuffle'] = True
+            elif name != 'none':
+                raise ValueError('Unknown HDF5 filter %s in %r' %
+                                 (name, value))
+        rules.append((pattern.strip(), filters))
+    return rules
+
+
 # ########################### SOURCES/RUPTURES ############################# #
 
 def mag_scale_rel(value):
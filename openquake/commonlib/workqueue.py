@@ -0,0 +1,312 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A work queue over TCP, built on top of :mod:`multiprocessing.managers`.
+The master runs a :class:`WorkQueueExecutor`, which exposes a
+:class:`TaskBroker`; any number of workers, on the same machine or on
+other machines, connect to it with :func:`run_worker`, pull the pickled
+tasks and push back the results. The workers send a heartbeat
+periodically: the tasks taken by a worker which is silent for more than
+`timeout` seconds are submitted again.
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import itertools
+import traceback
+import collections
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+
+from openquake.baselib.python3compat import pickle
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+HEARTBEAT = 5  # seconds between two heartbeats
+TIMEOUT = 30  # seconds of silence after which a worker is considered lost
+
+
+def get_address(address=None):
+    """
+    :param address: a string host:port (default $OQ_WORKQUEUE)
+    :returns: a pair (host, port)
+    """
+    address = address or os.environ.get('OQ_WORKQUEUE', 'localhost:1907')
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def get_authkey():
+    """
+    :returns: the authentication key, from $OQ_WORKQUEUE_AUTHKEY
+
+    There is no default key: the tasks and the results are pickled, so
+    anybody knowing the key and reaching the port can run code on the
+    master and on the workers.
+    """
+    authkey = os.environ.get('OQ_WORKQUEUE_AUTHKEY')
+    if not authkey:
+        raise ValueError('The environment variable OQ_WORKQUEUE_AUTHKEY '
+                         'must be set to a secret key shared by the master '
+                         'and the workers')
+    return authkey.encode('utf8')
+
+
+class TaskBroker(object):
+    """
+    The object living in the master and accessed by the workers through
+    a proxy. It keeps the pickled tasks until their results arrive.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.todo = collections.deque()  # ids of the tasks to send
+        self.tasks = {}  # task_id -> pickled task
+        self.running = {}  # task_id -> worker_id
+        self.last_seen = {}  # worker_id -> time of the last message
+        self.results = queue.Queue()  # pairs (task_id, pickled result)
+
+    def put(self, task_id, payload):
+        """
+        Add a task to the queue (called by the master)
+        """
+        with self.cond:
+            self.tasks[task_id] = payload
+            self.todo.append(task_id)
+            self.cond.notify()
+
+    def fetch(self, worker_id, timeout):
+        """
+        :returns: a pair (task_id, pickled task) or None if there are no
+                  tasks to run after `timeout` seconds
+        """
+        with self.cond:
+            self.last_seen[worker_id] = time.time()
+            if not self.todo:
+                self.cond.wait(timeout)
+            while self.todo:
+                task_id = self.todo.popleft()
+                if task_id in self.tasks:  # else already done
+                    self.running[task_id] = worker_id
+                    return task_id, self.tasks[task_id]
+
+    def put_result(self, worker_id, task_id, payload):
+        """
+        Store the result of a task; duplicated results of tasks which
+        were submitted again are discarded
+        """
+        with self.cond:
+            self.last_seen[worker_id] = time.time()
+            if task_id not in self.tasks:
+                return
+            del self.tasks[task_id]
+            self.running.pop(task_id, None)
+        self.results.put((task_id, payload))
+
+    def heartbeat(self, worker_id):
+        """
+        Register the worker as alive
+        """
+        with self.cond:
+            self.last_seen[worker_id] = time.time()
+
+    def resubmit_lost(self, timeout):
+        """
+        Put back in the queue the tasks of the workers silent for more than
+        `timeout` seconds.
+
+        :returns: the list of resubmitted task IDs
+        """
+        now = time.time()
+        with self.cond:
+            lost = [task_id for task_id, worker_id in self.running.items()
+                    if now - self.last_seen[worker_id] > timeout]
+            for task_id in lost:
+                del self.running[task_id]
+                self.todo.appendleft(task_id)
+            if lost:
+                self.cond.notify_all()
+        return lost
+
+
+class WorkQueueManager(BaseManager):
+    """
+    Manager used by the workers to connect to the broker
+    """
+WorkQueueManager.register('get_broker')
+
+
+class WorkQueueExecutor(object):
+    """
+    An executor with the same `submit` interface as the ones in
+    :mod:`concurrent.futures`, sending the tasks to the workers
+    connected to the given address.
+
+    :param address: a pair (host, port); port 0 means a free port
+    :param authkey: the authentication key shared with the workers
+    :param timeout: seconds of silence after which a worker is lost
+    """
+    def __init__(self, address, authkey, timeout=TIMEOUT):
+        self.broker = TaskBroker()
+        self.timeout = timeout
+        self.futures = {}  # task_id -> Future
+        self._task_ids = itertools.count()
+        self._stop = threading.Event()
+
+        class Manager(BaseManager):
+            pass
+        Manager.register('get_broker', callable=lambda: self.broker)
+        self.server = Manager(address=address, authkey=authkey).get_server()
+        self.address = self.server.address
+        # checked by the threads serving the workers (Python 3)
+        self.server.stop_event = self._stop
+        self._threads = []
+        for target in (self._serve, self._collect, self._watch):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logging.info('Listening for workers on %s:%d', *self.address)
+
+    def submit(self, func, *args):
+        """
+        Send `func(*args)` to the workers.
+
+        :returns: a :class:`concurrent.futures.Future` instance
+        """
+        future = Future()
+        task_id = next(self._task_ids)
+        self.futures[task_id] = future
+        self.broker.put(
+            task_id, pickle.dumps((func, args), pickle.HIGHEST_PROTOCOL))
+        return future
+
+    def _serve(self):
+        # like Server.serve_forever, but it stops at shutdown
+        while not self._stop.is_set():
+            try:
+                conn = self.server.listener.accept()
+            except (OSError, IOError, EOFError, AuthenticationError):
+                continue  # failed connection or wake up from shutdown
+            if self._stop.is_set():
+                conn.close()
+                break
+            thread = threading.Thread(
+                target=self.server.handle_request, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _collect(self):
+        # set the results of the futures as they arrive
+        while not self._stop.is_set():
+            try:
+                task_id, payload = self.broker.results.get(timeout=1)
+            except queue.Empty:
+                continue
+            future = self.futures.pop(task_id)
+            ok, value = pickle.loads(payload)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _watch(self):
+        # resubmit the tasks of the workers without heartbeat
+        while not self._stop.wait(self.timeout / 2.):
+            lost = self.broker.resubmit_lost(self.timeout)
+            if lost:
+                logging.warn('Resubmitting %d task(s) of lost workers',
+                             len(lost))
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting connections and collecting results; the workers
+        will exit when they notice that the master is gone
+        """
+        self._stop.set()
+        self.server.stop = True  # checked by serve_client (Python 2)
+        try:  # wake up the thread blocked in accept
+            socket.create_connection(self.address, 1).close()
+        except (OSError, IOError):
+            pass
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self.server.listener.close()
+
+
+def _heartbeat(address, authkey, worker_id, stop, heartbeat):
+    # NB: a separate connection is needed, proxies are not thread-safe
+    manager = WorkQueueManager(address, authkey)
+    manager.connect()
+    broker = manager.get_broker()
+    while not stop.wait(heartbeat):
+        broker.heartbeat(worker_id)
+
+
+def run_worker(address, authkey, heartbeat=HEARTBEAT, max_tasks=None):
+    """
+    Connect to the master and run tasks until the master disappears
+    or `max_tasks` tasks have been run.
+
+    :param address: a pair (host, port)
+    :param authkey: the authentication key
+    :param heartbeat: seconds between two heartbeats
+    :param max_tasks: the maximum number of tasks to run (None for no limit)
+    :returns: the number of tasks run
+    """
+    from openquake.commonlib import parallel
+    # the out of band files would be on the worker filesystem
+    parallel.oob_results = False
+    worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+    manager = WorkQueueManager(address, authkey)
+    manager.connect()
+    broker = manager.get_broker()
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_heartbeat, args=(address, authkey, worker_id, stop, heartbeat))
+    thread.daemon = True
+    thread.start()
+    done = 0
+    try:
+        while max_tasks is None or done < max_tasks:
+            task = broker.fetch(worker_id, heartbeat)
+            if task is None:
+                continue
+            task_id, payload = task
+            try:
+                func, args = pickle.loads(payload)
+                res = (True, func(*args))
+            except Exception:
+                res = (False, ''.join(traceback.format_exception(
+                    *sys.exc_info())))
+            broker.put_result(
+                worker_id, task_id, pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+            done += 1
+    except (EOFError, IOError):  # the master is gone
+        logging.info('Worker %s: lost connection to the master', worker_id)
+    finally:
+        stop.set()
+    return done
@@ -367,6 +367,23 @@ def expand(array, N):
     return numpy.array([array[i % n] for i in range(N)])
 
 
+def group_by_site(rupids, site_ids, gmfa):
+    """
+    Build a sparse representation of a set of GMFs, grouped by site.
+
+    :param rupids: the rupture index of each row of the GMF array
+    :param site_ids: the site index of each row of the GMF array
+    :param gmfa: an array of GMFs
+    :returns: a dictionary site index -> (rupture indices, GMFs)
+    """
+    order = numpy.argsort(site_ids, kind='mergesort')
+    uniq, starts = numpy.unique(site_ids[order], return_index=True)
+    gmfs_by_sid = {}
+    for sid, rows in zip(uniq, numpy.split(order, starts[1:])):
+        gmfs_by_sid[sid] = rupids[rows], gmfa[rows]
+    return gmfs_by_sid
+
+
 class RiskInputFromRuptures(object):
     """
     Contains all the assets associated to the given IMT and a subsets of
@@ -395,6 +412,8 @@ class RiskInputFromRuptures(object):
         self.rup_slice = rup_slice
         self.imts = sorted(set(imt for imt, _ in imt_taxonomies))
         self.num_epsilons = num_epsilons
+        self.gmfs_by_sid = None  # set by .read_gmfs, if GMFs are stored
+        self.gmfs_ref = None  # set by .set_gmfs_ref, read by the workers
 
     @property
     def tags(self):
@@ -405,25 +424,77 @@ class RiskInputFromRuptures(object):
         """
         return [sr.tag for sr in self.ses_ruptures]
 
-    def compute_expand_gmfs(self):
+    def compute_gmfs(self, sids):
         """
+        Compute the GMFs only on the given sites, keeping them in a sparse
+        (rupture, site) representation, without expanding them to the
+        complete site collection.
+
+        :param sids: the indices of the sites of interest
         :returns:
-            an array R x N where N is the number of sites and
-            R is the number of ruptures.
+            a dictionary site index -> (rupture indices, GMFs) containing
+            only the sites affected by at least one rupture
         """
         from openquake.calculators.event_based import make_gmfs
-        gmfs = make_gmfs(
+        gmfa, site_ids = make_gmfs(
             self.ses_ruptures, self.sitecol, self.imts,
-            self.gsims, self.trunc_level, self.correl_model, DummyMonitor())
-        gmf_dt = gsim_imt_dt(self.gsims, self.imts)
-        N = len(self.sitecol.complete)
-        R = len(gmfs)
-        gmfa = numpy.zeros((R, N), gmf_dt)
-        for i, sesrup, gmf in zip(range(R), self.ses_ruptures, gmfs):
-            expanded_gmf = numpy.zeros(N, gmf_dt)
-            expanded_gmf[sesrup.indices] = gmf
-            gmfa[i] = expanded_gmf
-        return gmfa  # array R x N
+            self.gsims, self.trunc_level, self.correl_model, DummyMonitor(),
+            numpy.array(sids, numpy.uint32))
+        # position of the rupture of each row inside the risk input
+        ordinals = numpy.array([sr.ordinal for sr in self.ses_ruptures])
+        order = numpy.argsort(ordinals)
+        rupids = order[numpy.searchsorted(ordinals[order], gmfa['idx'])]
+        return group_by_site(rupids, site_ids, gmfa)
+
+    def read_gmfs(self, dset, slice_by_tag, num_sites, sids):
+        """
+        Read the GMFs of the ruptures of the risk input from a dataset
+        stored by a previous event_based calculation, restricted to the
+        given sites, and keep them in the attribute .gmfs_by_sid.
+
+        :param dset: the dataset of GMFs of the collection of the risk input
+        :param slice_by_tag: a dictionary rupture tag -> slice of dset
+        :param num_sites: the number of sites of the hazard site collection
+        :param sids: the indices of the sites of interest
+        """
+        from openquake.calculators.event_based import get_site_ids
+        rupids, site_ids, gmfs = [], [], []
+        for i, sr in enumerate(self.ses_ruptures):
+            if sr.tag not in slice_by_tag:  # no GMFs stored for the rupture
+                continue
+            s_ids = numpy.array(get_site_ids(sr, num_sites), numpy.uint32)
+            ok = numpy.in1d(s_ids, sids)
+            if ok.any():
+                gmfs.append(dset[slice_by_tag[sr.tag]][ok])
+                site_ids.append(s_ids[ok])
+                rupids.append(numpy.repeat(i, ok.sum()))
+        if gmfs:
+            self.gmfs_by_sid = group_by_site(
+                numpy.concatenate(rupids), numpy.concatenate(site_ids),
+                numpy.concatenate(gmfs))
+        else:
+            self.gmfs_by_sid = {}
+
+    def set_gmfs_ref(self, dset, slice_by_tag, num_sites, sids):
+        """
+        Same as .read_gmfs, but the GMFs are read later, by the worker
+        running the risk input: `dset` is a
+        :class:`openquake.commonlib.datastore.DatasetRef` and only the
+        slices of the ruptures of the risk input are kept.
+        """
+        slices = {sr.tag: slice_by_tag[sr.tag] for sr in self.ses_ruptures
+                  if sr.tag in slice_by_tag}
+        self.gmfs_ref = (dset, slices, num_sites, sids)
+
+    def get_sids(self, assets_by_site):
+        """
+        :param assets_by_site: a list of lists of assets
+        :returns: the indices of the sites with assets of the risk input
+        """
+        taxonomies = set(taxonomy for _imt, taxonomies in self.imt_taxonomies
+                         for taxonomy in taxonomies)
+        return [sid for sid, assets in enumerate(assets_by_site)
+                if any(a.taxonomy in taxonomies for a in assets)]
 
     def get_all(self, rlzs_assoc, assets_by_site, eps):
         """
@@ -433,16 +504,32 @@ class RiskInputFromRuptures(object):
         E = len(self.ses_ruptures)
         indices = [sr.ordinal % self.num_epsilons for sr in self.ses_ruptures]
         assets, hazards, epsilons = [], [], []
-        gmfs = self.compute_expand_gmfs()
+        # consider only the sites with assets of the relevant taxonomies
+        sids = self.get_sids(assets_by_site)
+        if self.gmfs_ref is not None:  # read the GMFs from the datastore
+            self.read_gmfs(*self.gmfs_ref)
+            self.gmfs_ref = None
+        if self.gmfs_by_sid is None:  # compute the GMFs
+            gmfs_by_sid = self.compute_gmfs(sids)
+        else:  # use the GMFs read from the datastore
+            gmfs_by_sid = self.gmfs_by_sid
+        gmf_dt = gsim_imt_dt(self.gsims, self.imts)
         gsims = list(map(str, self.gsims))
         trt_id = rlzs_assoc.csm_info.get_trt_id(self.col_id)
-        for assets_, hazard in zip(assets_by_site, gmfs.T):
+        for sid in sids:
+            # the ground motion is zero for the ruptures not affecting the site
+            if sid in gmfs_by_sid:
+                rupids, gmfs = gmfs_by_sid[sid]
+                hazard = numpy.zeros(E, gmfs.dtype)
+                hazard[rupids] = gmfs
+            else:
+                hazard = numpy.zeros(E, gmf_dt)
             haz_by_imt_rlz = {imt: {} for imt in self.imts}
             for gsim in gsims:
                 for imt in self.imts:
                     for rlz in rlzs_assoc[trt_id, gsim]:
                         haz_by_imt_rlz[imt][rlz] = hazard[gsim][imt]
-            for asset in assets_:
+            for asset in assets_by_site[sid]:
                 assets.append(asset)
                 hazards.append(haz_by_imt_rlz)
                 epsilons.append(expand(eps[asset.idx][indices], E))
@@ -102,3 +102,14 @@ a4,3,1,50,500000,2.0,6.0
         self.assertEqual(set(a.taxonomy for a in assets),
                          set(['RM', 'RC', 'W']))
         self.assertEqual(list(map(len, epsilons)), [20] * 5)
+
+    def test_group_by_site(self):
+        rupids = numpy.array([0, 0, 1, 2, 2])
+        site_ids = numpy.array([3, 5, 5, 3, 5])
+        gmfa = numpy.array([.1, .2, .3, .4, .5])
+        gmfs_by_sid = riskinput.group_by_site(rupids, site_ids, gmfa)
+        self.assertEqual(sorted(gmfs_by_sid), [3, 5])
+        numpy.testing.assert_equal(gmfs_by_sid[3][0], [0, 2])
+        numpy.testing.assert_equal(gmfs_by_sid[3][1], [.1, .4])
+        numpy.testing.assert_equal(gmfs_by_sid[5][0], [0, 1, 2])
+        numpy.testing.assert_equal(gmfs_by_sid[5][1], [.2, .3, .5])